@@ -1,13 +1,16 @@
 from datetime import datetime
 import os
+import threading
+import time
 import requests
 from flask import Flask, request, g
 import psycopg2
 from psycopg2.extras import DictCursor
+from psycopg2.pool import ThreadedConnectionPool
 
 from investment_horse_racing_crawler import VERSION
 from investment_horse_racing_crawler.app_logging import get_logger
-from investment_horse_racing_crawler.scrapy import crawler
+from investment_horse_racing_crawler.scrapy import crawl_jobs
 
 
 logger = get_logger(__name__)
@@ -16,13 +19,27 @@ logger = get_logger(__name__)
 app = Flask(__name__)
 
 
+_db_pool = None
+_db_pool_lock = threading.Lock()
+_db_pool_semaphore = None
+_db_pool_stats = {
+    "checkout_count": 0,
+    "in_use": 0,
+    "in_use_max": 0,
+    "wait_seconds_total": 0.0,
+    "wait_seconds_max": 0.0,
+    "timeout_count": 0,
+    "health_check_failures": 0,
+}
+
+
 @app.route("/api/health")
 def health():
     logger.info("#health: start")
 
     result = {"version": VERSION}
 
-    with get_db().cursor() as db_cursor:
+    with _get_db().cursor() as db_cursor:
         db_cursor.execute("select 1")
 
         result["database"] = True
@@ -44,16 +61,53 @@ def crawl():
     end_date = args.get("end_date", "2100-01-01")
     recache_race = args.get("recache_race", False)
     recache_horse = args.get("recache_horse", False)
+    bulk_ingest = args.get("bulk_ingest", False)
+    shard_unit = args.get("shard_unit", None)
+    shard_processes = args.get("shard_processes", None)
+    job_name = args.get("job_name", None)
+
+    try:
+        if start_date is not None:
+            start_date = datetime.strptime(start_date, "%Y-%m-%d")
+
+        if end_date is not None:
+            end_date = datetime.strptime(end_date, "%Y-%m-%d")
+
+        job_id = _crawl(start_url, start_date, end_date, recache_race, recache_horse, bulk_ingest, shard_unit, shard_processes, job_name)
+    except ValueError as err:
+        logger.warning(f"#crawl: invalid args: {err}")
+
+        return {"result": False, "error": str(err)}, 400
+
+    return {"result": True, "job_id": job_id}
+
+
+@app.route("/api/crawl")
+def find_crawl_jobs():
+    logger.info("#find_crawl_jobs: start")
+
+    return {"jobs": [_crawl_job_to_json(job) for job in crawl_jobs.list()]}
+
+
+@app.route("/api/crawl/<job_id>")
+def find_crawl_job(job_id):
+    logger.info(f"#find_crawl_job: start: job_id={job_id}")
 
-    if start_date is not None:
-        start_date = datetime.strptime(start_date, "%Y-%m-%d")
+    job = crawl_jobs.get(job_id)
+    if job is None:
+        return {"result": False}, 404
 
-    if end_date is not None:
-        end_date = datetime.strptime(end_date, "%Y-%m-%d")
+    return _crawl_job_to_json(job)
 
-    _crawl(start_url, start_date, end_date, recache_race, recache_horse)
 
-    return {"result": True}
+@app.route("/api/crawl/<job_id>", methods=["DELETE"])
+def cancel_crawl_job(job_id):
+    logger.info(f"#cancel_crawl_job: start: job_id={job_id}")
+
+    if not crawl_jobs.cancel(job_id):
+        return {"result": False}, 404
+
+    return {"result": True, "job_id": job_id}
 
 
 @app.route("/api/race_info")
@@ -66,12 +120,12 @@ def find_race_info():
     if target_date is not None:
         target_date = datetime.strptime(target_date, "%Y-%m-%d")
 
-        with get_db().cursor() as db_cursor:
+        with _get_db().cursor() as db_cursor:
             db_cursor.execute("select * from race_info where date(start_datetime)=%s order by start_datetime, race_id", (target_date,))
             race_infos = db_cursor.fetchall()
 
     elif race_id is not None:
-        with get_db().cursor() as db_cursor:
+        with _get_db().cursor() as db_cursor:
             db_cursor.execute("select * from race_info where race_id=%s order by start_datetime, race_id", (race_id,))
             race_infos = db_cursor.fetchall()
 
@@ -93,6 +147,23 @@ def find_race_info():
     return result
 
 
+@app.route("/api/db_pool")
+def db_pool_metrics():
+    logger.info("#db_pool_metrics: start")
+
+    pool = _get_db_pool()
+
+    with _db_pool_lock:
+        result = dict(_db_pool_stats)
+
+    result["min_size"] = pool.minconn
+    result["max_size"] = pool.maxconn
+    result["utilization"] = result["in_use"] / pool.maxconn
+    result["wait_seconds_avg"] = result["wait_seconds_total"] / result["checkout_count"] if result["checkout_count"] > 0 else 0.0
+
+    return result
+
+
 def get_db():
     db = psycopg2.connect(
         host=os.getenv("DB_HOST"),
@@ -108,9 +179,93 @@ def get_db():
     return db
 
 
+def _get_db_pool():
+    global _db_pool, _db_pool_semaphore
+
+    with _db_pool_lock:
+        if _db_pool is None:
+            min_size = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+            max_size = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+            logger.debug(f"#_get_db_pool: create pool: min_size={min_size}, max_size={max_size}")
+
+            _db_pool = ThreadedConnectionPool(
+                min_size,
+                max_size,
+                host=os.getenv("DB_HOST"),
+                port=os.getenv("DB_PORT"),
+                dbname=os.getenv("DB_DATABASE"),
+                user=os.getenv("DB_USERNAME"),
+                password=os.getenv("DB_PASSWORD"),
+                client_encoding="utf-8",
+                cursor_factory=DictCursor
+            )
+
+            # ThreadedConnectionPool raises PoolError when it is exhausted, so requests wait on the semaphore instead
+            _db_pool_semaphore = threading.BoundedSemaphore(max_size)
+
+    return _db_pool
+
+
+def _checkout_db():
+    pool = _get_db_pool()
+
+    start_time = time.monotonic()
+    if not _db_pool_semaphore.acquire(timeout=float(os.getenv("DB_POOL_TIMEOUT", "30"))):
+        with _db_pool_lock:
+            _db_pool_stats["timeout_count"] += 1
+
+        raise RuntimeError("Database connection pool exhausted")
+    wait_seconds = time.monotonic() - start_time
+
+    try:
+        db = pool.getconn()
+
+        try:
+            with db.cursor() as db_cursor:
+                db_cursor.execute("select 1")
+            db.rollback()
+        except psycopg2.Error:
+            logger.warning("#_checkout_db: health check failed, reconnect")
+
+            with _db_pool_lock:
+                _db_pool_stats["health_check_failures"] += 1
+
+            pool.putconn(db, close=True)
+            db = pool.getconn()
+    except Exception:
+        _db_pool_semaphore.release()
+        raise
+
+    with _db_pool_lock:
+        _db_pool_stats["checkout_count"] += 1
+        _db_pool_stats["in_use"] += 1
+        _db_pool_stats["in_use_max"] = max(_db_pool_stats["in_use_max"], _db_pool_stats["in_use"])
+        _db_pool_stats["wait_seconds_total"] += wait_seconds
+        _db_pool_stats["wait_seconds_max"] = max(_db_pool_stats["wait_seconds_max"], wait_seconds)
+
+    return db
+
+
+def _return_db(db):
+    try:
+        close = db.closed != 0
+        if not close:
+            try:
+                db.rollback()
+            except psycopg2.Error:
+                close = True
+
+        _get_db_pool().putconn(db, close=close)
+    finally:
+        with _db_pool_lock:
+            _db_pool_stats["in_use"] -= 1
+
+        _db_pool_semaphore.release()
+
+
 def _get_db():
     if "db" not in g:
-        g.db = get_db()
+        g.db = _checkout_db()
 
     return g.db
 
@@ -119,13 +274,29 @@ def _get_db():
 def _teardown_db(exc):
     db = g.pop("db", None)
     if db is not None:
-        db.close()
+        _return_db(db)
 
 
-def _crawl(start_url, start_date, end_date, recache_race, recache_horse):
-    logger.debug(f"#_crawl: start: start_url={start_url}, start_date={start_date}, end_date={end_date}, recache_race={recache_race}, recache_horse={recache_horse}")
+def _crawl(start_url, start_date, end_date, recache_race, recache_horse, bulk_ingest, shard_unit, shard_processes, job_name):
+    logger.debug(f"#_crawl: start: start_url={start_url}, start_date={start_date}, end_date={end_date}, recache_race={recache_race}, recache_horse={recache_horse}, bulk_ingest={bulk_ingest}, shard_unit={shard_unit}, shard_processes={shard_processes}, job_name={job_name}")
 
-    crawler.crawl(start_url, start_date, end_date, recache_race, recache_horse)
+    return crawl_jobs.submit(start_url, start_date, end_date, recache_race, recache_horse, bulk_ingest, shard_unit, shard_processes, job_name)
+
+
+def _crawl_job_to_json(job):
+    result = dict(job)
+    del result["cancel_requested"]
+
+    result["args"] = dict(job["args"])
+    for key in ("start_date", "end_date"):
+        if result["args"][key] is not None:
+            result["args"][key] = result["args"][key].strftime("%Y-%m-%d")
+
+    for key in ("created_at", "started_at", "finished_at"):
+        if result[key] is not None:
+            result[key] = result[key].strftime("%Y-%m-%d %H:%M:%S")
+
+    return result
 
 
 def _schedule_vote_close(start_date, end_date):
@@ -1,22 +1,340 @@
+from collections import OrderedDict, deque
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+import os
+import queue
+import re
+import signal
+import threading
+import time
+import uuid
+
+from scrapy import signals
 from scrapy.crawler import CrawlerProcess
-from scrapy.utils.project import get_project_settings
-from billiard import Process
+from scrapy.utils.project import data_path, get_project_settings
+from billiard import Manager, Process, Queue
+from twisted.internet import task
+
+from investment_horse_racing_crawler.app_logging import get_logger
+
+
+logger = get_logger(__name__)
+
+
+SCHEDULE_LIST_URL = "https://keiba.yahoo.co.jp/schedule/list/{year}/?month={month}"
+
+SHARD_UNITS = ("month", "week")
+
+JOB_NAME_RE = re.compile("^[0-9A-Za-z_.-]+$")
+
+
+def check_job_name(job_name):
+    if not JOB_NAME_RE.match(job_name):
+        raise ValueError(f"Invalid job name: {job_name}")
+
+
+def split_date_range(start_date, end_date, shard_unit):
+    if shard_unit not in SHARD_UNITS:
+        raise ValueError(f"Unknown shard unit: {shard_unit}")
+
+    shards = []
+    shard_start = start_date
+    while shard_start < end_date:
+        if shard_unit == "month":
+            shard_end = datetime(shard_start.year, shard_start.month, 1) + relativedelta(months=1)
+        else:
+            shard_end = shard_start + relativedelta(weeks=1)
+
+        shard_end = min(shard_end, end_date)
+        shards.append((shard_start, shard_end))
+
+        shard_start = shard_end
+
+    return shards
 
 
 class CrawlerScript():
     def __init__(self):
-        settings = get_project_settings()
-        self.crawler = CrawlerProcess(settings, install_root_handler=False)
+        self.settings = get_project_settings()
+        self.crawler = CrawlerProcess(self.settings, install_root_handler=False)
+
+    def crawl(self, start_url, start_date, end_date, recache_race, recache_horse, bulk_ingest=False, job_name=None):
+        process = Process(target=self._crawl, kwargs={"start_url": start_url, "start_date": start_date, "end_date": end_date, "recache_race": recache_race, "recache_horse": recache_horse, "bulk_ingest": bulk_ingest, "job_name": job_name})
+        process.start()
+        process.join()
+
+    def _crawl(self, start_url, start_date, end_date, recache_race, recache_horse, bulk_ingest, progress_queue=None, shard_id=None, shard_claims=None, job_name=None):
+        if job_name is not None:
+            # A named job keeps its scheduler queue and dupefilter in JOBDIR, so running it again resumes it
+            self.settings.set("JOBDIR", self.get_job_dir(job_name if shard_id is None else f"{job_name}-{shard_id}"))
+
+        crawler = self.crawler.create_crawler("horse_racing")
+        if progress_queue is not None:
+            CrawlProgressReporter(crawler, progress_queue, self.settings.getfloat("CRAWL_PROGRESS_INTERVAL", 5), shard_id)
 
-    def _crawl(self, start_url, start_date, end_date, recache_race, recache_horse):
-        self.crawler.crawl("horse_racing", start_url, start_date, end_date, recache_race, recache_horse)
+        spider_kwargs = {}
+        if shard_claims is not None:
+            spider_kwargs = {"shard_id": shard_id, "shard_claims": shard_claims}
+
+        self.crawler.crawl(crawler, start_url, start_date, end_date, recache_race, recache_horse, bulk_ingest, **spider_kwargs)
         self.crawler.start()
         self.crawler.stop()
 
-    def crawl(self, start_url, start_date, end_date, recache_race, recache_horse):
-        process = Process(target=self._crawl, kwargs={"start_url": start_url, "start_date": start_date, "end_date": end_date, "recache_race": recache_race, "recache_horse": recache_horse})
-        process.start()
+    def _crawl_sharded(self, start_date, end_date, recache_race, recache_horse, bulk_ingest, shard_unit, max_processes=None, progress_queue=None, job_name=None):
+        if max_processes is None:
+            max_processes = self.settings.getint("CRAWL_SHARD_PROCESSES", 1)
+
+        shards = deque(enumerate(split_date_range(start_date, end_date, shard_unit)))
+        logger.info(f"#_crawl_sharded: start: len(shards)={len(shards)}, shard_unit={shard_unit}, max_processes={max_processes}")
+
+        running = []
+        failed_count = 0
+
+        def _terminate(signum, frame):
+            logger.info("#_crawl_sharded: terminate shards")
+
+            shards.clear()
+            for process in running:
+                process.terminate()
+
+        signal.signal(signal.SIGTERM, _terminate)
+
+        # Shard processes share the claim table of directory pages through the manager process
+        with Manager() as manager:
+            shard_claims = manager.dict()
+
+            while shards or running:
+                while shards and len(running) < max_processes:
+                    shard_id, (shard_start, shard_end) = shards.popleft()
+                    logger.debug(f"#_crawl_sharded: start shard: shard_id={shard_id}, start_date={shard_start}, end_date={shard_end}")
+
+                    process = Process(target=self._crawl, kwargs={
+                        "start_url": SCHEDULE_LIST_URL.format(year=shard_start.year, month=shard_start.month),
+                        "start_date": shard_start,
+                        "end_date": shard_end,
+                        "recache_race": recache_race,
+                        "recache_horse": recache_horse,
+                        "bulk_ingest": bulk_ingest,
+                        "progress_queue": progress_queue,
+                        "shard_id": shard_id,
+                        "shard_claims": shard_claims,
+                        "job_name": job_name,
+                    })
+                    process.start()
+                    running.append(process)
+
+                for process in [p for p in running if not p.is_alive()]:
+                    process.join()
+                    running.remove(process)
+
+                    if process.exitcode != 0:
+                        failed_count += 1
+
+                time.sleep(0.5)
+
+        logger.info(f"#_crawl_sharded: end: failed_count={failed_count}")
+
+        if failed_count > 0:
+            raise RuntimeError(f"{failed_count} shards failed")
+
+    def get_job_dir(self, job_name):
+        check_job_name(job_name)
+
+        return data_path(os.path.join(self.settings.get("CRAWL_JOB_DIR", "crawl_jobs"), job_name), createdir=True)
+
+
+class CrawlProgressReporter(object):
+    def __init__(self, crawler, progress_queue, interval, shard_id=None):
+        self.crawler = crawler
+        self.progress_queue = progress_queue
+        self.interval = interval
+        self.shard_id = shard_id
+
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(self.item_scraped, signal=signals.item_scraped)
+
+    def spider_opened(self, spider):
+        self.report_loop = task.LoopingCall(self.report)
+        self.report_loop.start(self.interval)
+
+    def spider_closed(self, spider, reason):
+        if self.report_loop.running:
+            self.report_loop.stop()
+
+        self.report()
+
+    def item_scraped(self, item, spider):
+        # The pipelines hand over normalized values, which keep the name of the scraped item class
+        self.crawler.stats.inc_value(f"item_scraped_count/{getattr(item, 'item_type', type(item).__name__)}")
+
+    def report(self):
+        # Only numbers are reported, so the progress stays JSON serializable on the API side
+        progress = {k: v for k, v in self.crawler.stats.get_stats().items() if isinstance(v, (int, float)) and not isinstance(v, bool)}
+
+        self.progress_queue.put((self.shard_id, progress))
+
+
+class CrawlJobRegistry(object):
+    def __init__(self, crawler_script, max_jobs, max_history=100):
+        self.crawler_script = crawler_script
+        self.max_jobs = max_jobs
+        self.max_history = max_history
+
+        self.jobs = OrderedDict()
+        self.pending_job_ids = deque()
+        self.running_count = 0
+        self.lock = threading.RLock()
+
+    def submit(self, start_url, start_date, end_date, recache_race, recache_horse, bulk_ingest=False, shard_unit=None, shard_processes=None, job_name=None):
+        job_id = uuid.uuid4().hex
+        logger.debug(f"#submit: job_id={job_id}, start_url={start_url}, start_date={start_date}, end_date={end_date}, job_name={job_name}")
+
+        # Invalid arguments are rejected here, instead of failing the job process later
+        if shard_unit is not None and shard_unit not in SHARD_UNITS:
+            raise ValueError(f"Unknown shard unit: {shard_unit}")
+
+        # The job directory is created by the job process, so a rejected or cancelled job leaves nothing behind
+        if job_name is not None:
+            check_job_name(job_name)
+
+        with self.lock:
+            self.jobs[job_id] = {
+                "job_id": job_id,
+                "status": "pending",
+                "args": {
+                    "start_url": start_url,
+                    "start_date": start_date,
+                    "end_date": end_date,
+                    "recache_race": recache_race,
+                    "recache_horse": recache_horse,
+                    "bulk_ingest": bulk_ingest,
+                    "shard_unit": shard_unit,
+                    "shard_processes": shard_processes,
+                    "job_name": job_name,
+                },
+                "created_at": datetime.now(),
+                "started_at": None,
+                "finished_at": None,
+                "exit_code": None,
+                "progress": {},
+                "cancel_requested": False,
+                "process": None,
+            }
+            self.pending_job_ids.append(job_id)
+
+            self._trim_history()
+            self._dispatch()
+
+        return job_id
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+
+            return {k: (dict(v) if isinstance(v, dict) else v) for k, v in job.items() if k != "process"}
+
+    def list(self):
+        with self.lock:
+            return [self.get(job_id) for job_id in self.jobs]
+
+    def cancel(self, job_id):
+        logger.debug(f"#cancel: job_id={job_id}")
+
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return False
+
+            if job["status"] == "pending":
+                self.pending_job_ids.remove(job_id)
+                job["status"] = "cancelled"
+                job["finished_at"] = datetime.now()
+
+            elif job["status"] == "running":
+                # SIGTERM lets the crawler shut down gracefully, so buffered rows are still written
+                job["cancel_requested"] = True
+                job["status"] = "cancelling"
+                job["process"].terminate()
+
+            return True
+
+    def _dispatch(self):
+        with self.lock:
+            while self.pending_job_ids and self.running_count < self.max_jobs:
+                job = self.jobs[self.pending_job_ids.popleft()]
+
+                progress_queue = Queue()
+
+                kwargs = dict(job["args"], progress_queue=progress_queue)
+                shard_unit = kwargs.pop("shard_unit")
+                shard_processes = kwargs.pop("shard_processes")
+                if shard_unit is None:
+                    process = Process(target=self.crawler_script._crawl, kwargs=kwargs)
+                else:
+                    del kwargs["start_url"]
+                    process = Process(target=self.crawler_script._crawl_sharded, kwargs=dict(kwargs, shard_unit=shard_unit, max_processes=shard_processes))
+                process.start()
+
+                job["status"] = "running"
+                job["started_at"] = datetime.now()
+                job["process"] = process
+                self.running_count += 1
+
+                logger.debug(f"#_dispatch: job started: job_id={job['job_id']}, pid={process.pid}")
+
+                threading.Thread(target=self._watch, args=(job, progress_queue), name=f"CrawlJob-{job['job_id']}", daemon=True).start()
+
+    def _watch(self, job, progress_queue):
+        process = job["process"]
+        shard_progresses = {}
+
+        while True:
+            try:
+                shard_id, progress = progress_queue.get(timeout=1.0)
+            except queue.Empty:
+                if not process.is_alive():
+                    break
+                continue
+
+            # Sharded crawls report per shard, so the job progress is the sum over shards
+            shard_progresses[shard_id] = progress
+
+            merged_progress = {}
+            for shard_progress in shard_progresses.values():
+                for k, v in shard_progress.items():
+                    merged_progress[k] = merged_progress.get(k, 0) + v
+
+            with self.lock:
+                job["progress"] = merged_progress
+
         process.join()
 
+        with self.lock:
+            job["exit_code"] = process.exitcode
+            job["finished_at"] = datetime.now()
+            job["process"] = None
+
+            if job["cancel_requested"]:
+                job["status"] = "cancelled"
+            elif process.exitcode == 0:
+                job["status"] = "finished"
+            else:
+                job["status"] = "failed"
+
+            logger.debug(f"#_watch: job finished: job_id={job['job_id']}, status={job['status']}, exit_code={job['exit_code']}")
+
+            self.running_count -= 1
+            self._dispatch()
+
+    def _trim_history(self):
+        finished_job_ids = [job_id for job_id, job in self.jobs.items() if job["status"] in ("finished", "failed", "cancelled")]
+
+        for job_id in finished_job_ids[:max(0, len(finished_job_ids) - self.max_history)]:
+            del self.jobs[job_id]
+
 
 crawler = CrawlerScript()
+crawl_jobs = CrawlJobRegistry(crawler, crawler.settings.getint("CRAWL_MAX_JOBS", 1))
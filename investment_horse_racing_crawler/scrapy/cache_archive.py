@@ -0,0 +1,172 @@
+import mmap
+import struct
+import threading
+import zlib
+
+
+# Archive layout: records | index (zlib compressed entries) | trailer
+# Each record is an encoded cache record, so archives hold the same bytes as the loose S3 objects.
+ARCHIVE_MAGIC = b"HRCA\x01"
+INDEX_ENTRY = struct.Struct(">20sQI")
+TRAILER = struct.Struct(">QQ5s")
+
+
+class CacheArchiveWriter(object):
+    def __init__(self, f):
+        self.f = f
+        self.offset = 0
+        self.entries = []
+
+    def add(self, fingerprint, data_obj):
+        self.f.write(data_obj)
+        self.entries.append(INDEX_ENTRY.pack(bytes.fromhex(fingerprint), self.offset, len(data_obj)))
+        self.offset += len(data_obj)
+
+    def close(self):
+        index_obj = zlib.compress(b"".join(self.entries))
+
+        self.f.write(index_obj)
+        self.f.write(TRAILER.pack(self.offset, len(index_obj), ARCHIVE_MAGIC))
+
+        return len(self.entries)
+
+
+def read_archive_index(read_range, size):
+    """ Read the footer index with read_range(offset, length), returning an ArchiveIndex. """
+
+    index_offset, index_length, magic = TRAILER.unpack(read_range(size - TRAILER.size, TRAILER.size))
+    if magic != ARCHIVE_MAGIC:
+        raise ValueError("Not a cache archive")
+
+    return ArchiveIndex(zlib.decompress(read_range(index_offset, index_length)))
+
+
+class ArchiveIndex(object):
+    """ Index entries sorted by fingerprint in one bytes object, looked up by bisection.
+
+    An entry takes INDEX_ENTRY.size bytes, instead of the key, tuple and ints of a dict entry.
+    """
+
+    def __init__(self, index_obj):
+        size = INDEX_ENTRY.size
+
+        self.entries = b"".join(sorted(index_obj[i:i + size] for i in range(0, len(index_obj), size)))
+        self.count = len(self.entries) // size
+
+    def __len__(self):
+        return self.count
+
+    def get(self, fingerprint):
+        key = bytes.fromhex(fingerprint)
+        size = INDEX_ENTRY.size
+
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entries[mid * size:mid * size + 20] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == self.count or self.entries[lo * size:lo * size + 20] != key:
+            return None
+
+        _, offset, length = INDEX_ENTRY.unpack_from(self.entries, lo * size)
+
+        return offset, length
+
+
+class S3ArchiveReader(object):
+    def __init__(self, s3_client, bucket, key):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+
+    def read(self, offset, length):
+        return self.s3_client.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={offset}-{offset + length - 1}")["Body"].read()
+
+    def close(self):
+        pass
+
+
+class MmapArchiveReader(object):
+    def __init__(self, path):
+        self.f = open(path, "rb")
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, offset, length):
+        return self.mm[offset:offset + length]
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
+
+
+class CacheArchive(object):
+    """ Archive whose reader and index are opened by the first lookup, since a crawl only reads the archives of the months it visits. """
+
+    def __init__(self, open_reader, size):
+        self.open_reader = open_reader
+        self.size = size
+        self.reader = None
+        self.index = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        # Lookups run on the cache I/O threads, so an archive is opened once while the others wait
+        with self.lock:
+            if self.index is not None:
+                return
+
+            reader = self.open_reader()
+            index = read_archive_index(reader.read, self.size)
+
+            self.reader = reader
+            self.index = index
+
+    def get(self, fingerprint):
+        if self.index is None:
+            self.open()
+
+        entry = self.index.get(fingerprint)
+        if entry is None:
+            return None
+
+        offset, length = entry
+
+        return self.reader.read(offset, length)
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+
+
+class CacheArchiveSet(object):
+    def __init__(self):
+        # Month ("YYYY-MM") to archive
+        self.archives = {}
+
+    def add(self, month, open_reader, size):
+        self.archives[month] = CacheArchive(open_reader, size)
+
+    def get(self, fingerprint, months):
+        """ Look up the fingerprint in the archives of the months, returning the record bytes or None. """
+
+        for month in months:
+            archive = self.archives.get(month)
+            if archive is None:
+                continue
+
+            data_obj = archive.get(fingerprint)
+            if data_obj is not None:
+                return data_obj
+
+        return None
+
+    def get_race_year_months(self, race_year):
+        # Race ids hold the last 2 digits of the year
+        return [month for month in self.archives if month[2:4] == race_year]
+
+    def close(self):
+        for archive in self.archives.values():
+            archive.close()
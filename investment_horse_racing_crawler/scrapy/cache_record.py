@@ -0,0 +1,79 @@
+import json
+import pickle
+import struct
+import time
+import zlib
+
+
+# Record layout: MAGIC | header length (uint32, big endian) | header (JSON) | compressed body
+MAGIC = b"HRC\x01"
+HEADER_LENGTH = struct.Struct(">I")
+
+COMPRESSION_LEVEL = 6
+
+
+def encode_record(status, url, headers, body, stored_at=None):
+    header = {
+        "status": status,
+        "url": url,
+        "stored_at": stored_at if stored_at is not None else time.time(),
+        "headers": {_to_str(k): [_to_str(v) for v in values] for k, values in headers.items()},
+        "compression": "zlib",
+        "body_length": len(body),
+    }
+    header_obj = json.dumps(header, separators=(",", ":")).encode("utf-8")
+
+    return MAGIC + HEADER_LENGTH.pack(len(header_obj)) + header_obj + zlib.compress(body, COMPRESSION_LEVEL)
+
+
+def is_legacy_record(data):
+    return not data.startswith(MAGIC)
+
+
+def decode_header(data):
+    """ Decode the header without decompressing the body, returning (header, body offset). """
+
+    if is_legacy_record(data):
+        raise ValueError("Legacy record has no header")
+
+    header_start = len(MAGIC) + HEADER_LENGTH.size
+    (header_length,) = HEADER_LENGTH.unpack_from(data, len(MAGIC))
+    header = json.loads(data[header_start:header_start + header_length].decode("utf-8"))
+
+    return header, header_start + header_length
+
+
+def get_stored_at(data):
+    if is_legacy_record(data):
+        return None
+
+    header, _ = decode_header(data)
+
+    return header.get("stored_at")
+
+
+def decode_record(data, allow_legacy=False):
+    if is_legacy_record(data):
+        # Records written before the versioned format are pickled dicts. Unpickling can run any code, so they are only read to migrate them.
+        if not allow_legacy:
+            raise ValueError("Legacy record is not allowed")
+
+        return pickle.loads(data)
+
+    header, body_offset = decode_header(data)
+    if header["compression"] != "zlib":
+        raise ValueError(f"Unknown compression: {header['compression']}")
+
+    return {
+        "status": header["status"],
+        "url": header["url"],
+        "headers": {k.encode("latin-1"): [v.encode("latin-1") for v in values] for k, values in header["headers"].items()},
+        "body": zlib.decompress(data[body_offset:]),
+    }
+
+
+def _to_str(value):
+    if isinstance(value, bytes):
+        return value.decode("latin-1")
+
+    return value
@@ -0,0 +1,114 @@
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from investment_horse_racing_crawler.app_logging import get_logger
+from investment_horse_racing_crawler.scrapy.cache_record import encode_record, decode_record, is_legacy_record
+from investment_horse_racing_crawler.scrapy.middlewares import ARCHIVE_SUFFIX, S3CacheStorage
+
+
+logger = get_logger(__name__)
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Rewrite pickled cache records in the compressed record format"
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option("--workers", dest="workers", type="int", default=8, help="number of concurrent S3 requests")
+        parser.add_option("--dry-run", dest="dry_run", action="store_true", default=False, help="count records without rewriting them")
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+
+        logger.info(f"#run: start: workers={opts.workers}, dry_run={opts.dry_run}")
+
+        storage = S3CacheStorage(self.settings)
+        storage.open_bucket()
+
+        self.dry_run = opts.dry_run
+        self.stats = {"count": 0, "migrated": 0, "bytes_before": 0, "bytes_after": 0}
+
+        # The low-level client is thread safe, so the workers share it
+        paginator = storage.s3_client.get_paginator("list_objects_v2")
+        with ThreadPoolExecutor(max_workers=opts.workers) as executor:
+            for page in paginator.paginate(Bucket=storage.s3_bucket, Prefix=storage.s3_folder):
+                # Archives are written in the current format only
+                keys = [obj["Key"] for obj in page.get("Contents", []) if not obj["Key"].endswith(ARCHIVE_SUFFIX)]
+
+                for result in executor.map(lambda key: self._migrate_object(storage.s3_client, storage.s3_bucket, key), keys):
+                    self._count(*result)
+
+        logger.info(f"#run: s3: {self.stats}")
+
+        if storage.local_enabled:
+            self._migrate_local_tier(storage.get_local_tier_path())
+
+    def _migrate_object(self, s3_client, bucket, key):
+        s3_obj = s3_client.get_object(Bucket=bucket, Key=key)
+        data_obj = s3_obj["Body"].read()
+        if not is_legacy_record(data_obj):
+            return len(data_obj), None
+
+        # The object's upload time is the best guess of when a legacy record was stored
+        new_data_obj = self._convert(data_obj, s3_obj["LastModified"].timestamp())
+        if not self.dry_run:
+            s3_client.put_object(Bucket=bucket, Key=key, Body=new_data_obj)
+
+        logger.debug(f"#_migrate_object: migrated: key={key}, size={len(data_obj)}->{len(new_data_obj)}")
+
+        return len(data_obj), len(new_data_obj)
+
+    def _migrate_local_tier(self, path):
+        logger.info(f"#_migrate_local_tier: start: path={path}")
+
+        self.stats = {"count": 0, "migrated": 0, "bytes_before": 0, "bytes_after": 0}
+
+        db = sqlite3.connect(path, timeout=30)
+        try:
+            for key, data_obj in db.execute("select key, data from cache").fetchall():
+                data_obj = bytes(data_obj)
+                if not is_legacy_record(data_obj):
+                    self._count(len(data_obj), None)
+                    continue
+
+                # Legacy local records have no known age, so they are stamped as the oldest possible.
+                # The cache then reloads them from S3, whose records carry their upload time, on the next lookup.
+                new_data_obj = self._convert(data_obj, 0)
+                if not self.dry_run:
+                    db.execute("update cache set data=?, size=? where key=?", (sqlite3.Binary(new_data_obj), len(new_data_obj), key))
+
+                self._count(len(data_obj), len(new_data_obj))
+
+            db.commit()
+
+            if not self.dry_run:
+                db.execute("vacuum")
+        finally:
+            db.close()
+
+        logger.info(f"#_migrate_local_tier: {self.stats}")
+
+    def _convert(self, data_obj, stored_at):
+        data = decode_record(data_obj, allow_legacy=True)
+
+        return encode_record(data["status"], data["url"], data["headers"], data["body"], stored_at)
+
+    def _count(self, size_before, size_after):
+        self.stats["count"] += 1
+        self.stats["bytes_before"] += size_before
+
+        if size_after is None:
+            self.stats["bytes_after"] += size_before
+        else:
+            self.stats["migrated"] += 1
+            self.stats["bytes_after"] += size_after
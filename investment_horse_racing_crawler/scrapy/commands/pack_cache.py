@@ -0,0 +1,158 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import os
+import tempfile
+
+from botocore.exceptions import ClientError
+from dateutil.relativedelta import relativedelta
+import psycopg2
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.http import Request
+
+from investment_horse_racing_crawler.app_logging import get_logger
+from investment_horse_racing_crawler.scrapy.cache_archive import CacheArchiveWriter
+from investment_horse_racing_crawler.scrapy.cache_record import encode_record, decode_record, is_legacy_record
+from investment_horse_racing_crawler.scrapy.middlewares import ARCHIVE_SUFFIX, S3CacheStorage
+
+
+logger = get_logger(__name__)
+
+
+BASE_URL = "https://keiba.yahoo.co.jp"
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return "[options] YYYY-MM [YYYY-MM ...]"
+
+    def short_desc(self):
+        return "Pack the cache records of finished months into indexed archives"
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option("--workers", dest="workers", type="int", default=8, help="number of concurrent S3 requests")
+        parser.add_option("--delete-loose", dest="delete_loose", action="store_true", default=False, help="delete the packed loose objects")
+
+    def run(self, args, opts):
+        if not args:
+            raise UsageError()
+
+        try:
+            months = [datetime.strptime(arg, "%Y-%m") for arg in args]
+        except ValueError:
+            raise UsageError(f"Invalid month: {args}")
+
+        logger.info(f"#run: start: months={args}, workers={opts.workers}, delete_loose={opts.delete_loose}")
+
+        storage = S3CacheStorage(self.settings)
+        storage.open_bucket()
+
+        db_conn = psycopg2.connect(
+            host=self.settings.get("DB_HOST"),
+            port=self.settings.get("DB_PORT"),
+            dbname=self.settings.get("DB_DATABASE"),
+            user=self.settings.get("DB_USERNAME"),
+            password=self.settings.get("DB_PASSWORD")
+        )
+        try:
+            with ThreadPoolExecutor(max_workers=opts.workers) as executor:
+                for month in months:
+                    # Pages of a month keep changing until its last results are final
+                    if month + relativedelta(months=1, days=1) > datetime.now():
+                        logger.warning(f"#run: skip unfinished month: month={month:%Y-%m}")
+                        continue
+
+                    self._pack_month(storage, db_conn, executor, month, opts.delete_loose)
+        finally:
+            db_conn.close()
+
+    def _pack_month(self, storage, db_conn, executor, month, delete_loose):
+        archive_key = storage.get_archive_prefix() + f"{month:%Y-%m}{ARCHIVE_SUFFIX}"
+
+        # The loose objects of a packed month may be deleted already, so repacking could lose records
+        if self._exists(storage, archive_key):
+            logger.warning(f"#_pack_month: skip packed month: key={archive_key}")
+            return
+
+        urls = self._get_month_urls(db_conn, month)
+        logger.info(f"#_pack_month: start: month={month:%Y-%m}, len(urls)={len(urls)}")
+
+        rpaths = sorted({storage._get_request_path(None, Request(url)) for url in urls})
+        packed_rpaths = []
+        stats = {"count": 0, "missing": 0, "bytes": 0}
+
+        with tempfile.TemporaryFile() as f:
+            writer = CacheArchiveWriter(f)
+
+            for rpath, data_obj in zip(rpaths, executor.map(lambda rpath: self._load_object(storage, rpath), rpaths)):
+                if data_obj is None:
+                    stats["missing"] += 1
+                    continue
+
+                writer.add(os.path.basename(rpath), data_obj)
+                packed_rpaths.append(rpath)
+                stats["count"] += 1
+                stats["bytes"] += len(data_obj)
+
+            if stats["count"] == 0:
+                logger.info(f"#_pack_month: nothing to pack: month={month:%Y-%m}")
+                return
+
+            writer.close()
+            f.seek(0)
+
+            storage.s3_client.upload_fileobj(f, storage.s3_bucket, archive_key)
+
+        logger.info(f"#_pack_month: archive uploaded: key={archive_key}, {stats}")
+
+        if delete_loose:
+            # DeleteObjects accepts up to 1000 keys per request
+            for i in range(0, len(packed_rpaths), 1000):
+                storage.s3_client.delete_objects(Bucket=storage.s3_bucket, Delete={"Objects": [{"Key": rpath} for rpath in packed_rpaths[i:i + 1000]], "Quiet": True})
+
+            logger.info(f"#_pack_month: loose objects deleted: count={len(packed_rpaths)}")
+
+    def _get_month_urls(self, db_conn, month):
+        # Directory pages are shared by many months and re-crawled with recache_horse, so they are left loose
+        urls = [f"{BASE_URL}/schedule/list/{month.year}/?month={month.month}"]
+
+        with db_conn.cursor() as db_cursor:
+            db_cursor.execute("select race_id from race_info where start_datetime >= %s and start_datetime < %s", (month, month + relativedelta(months=1)))
+
+            for (race_id,) in db_cursor.fetchall():
+                urls.append(f"{BASE_URL}/race/list/{race_id[:8]}/")
+                urls.append(f"{BASE_URL}/race/denma/{race_id}/")
+                urls.append(f"{BASE_URL}/race/result/{race_id}/")
+                urls.append(f"{BASE_URL}/odds/tfw/{race_id}/")
+
+        return urls
+
+    def _exists(self, storage, key):
+        try:
+            storage.s3_client.head_object(Bucket=storage.s3_bucket, Key=key)
+        except ClientError as err:
+            if err.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return False
+            raise err
+
+        return True
+
+    def _load_object(self, storage, rpath):
+        try:
+            s3_obj = storage.s3_client.get_object(Bucket=storage.s3_bucket, Key=rpath)
+        except ClientError as err:
+            if err.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise err
+
+        data_obj = s3_obj["Body"].read()
+
+        # Archives only hold records in the current format, so readers never unpickle
+        if is_legacy_record(data_obj):
+            data = decode_record(data_obj, allow_legacy=True)
+            data_obj = encode_record(data["status"], data["url"], data["headers"], data["body"], s3_obj["LastModified"].timestamp())
+
+        return data_obj
@@ -0,0 +1,90 @@
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from twisted.internet import defer, reactor
+
+from investment_horse_racing_crawler.app_logging import get_logger
+
+
+logger = get_logger(__name__)
+
+
+SCHEDULE_LIST_URL = "https://keiba.yahoo.co.jp/schedule/list/{year}/?month={month}"
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return "[options] START_MONTH [END_MONTH]"
+
+    def short_desc(self):
+        return "Re-ingest cached pages into the database without network access"
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option("--race-id-from", dest="race_id_from", default=None, help="replay races whose id is this or later")
+        parser.add_option("--race-id-to", dest="race_id_to", default=None, help="replay races whose id is this or earlier")
+        parser.add_option("--concurrency", dest="concurrency", type="int", default=64, help="number of pages parsed concurrently")
+        parser.add_option("--bulk-ingest", dest="bulk_ingest", action="store_true", default=False, help="ingest with the bulk load pipeline")
+
+    def process_options(self, args, opts):
+        ScrapyCommand.process_options(self, args, opts)
+
+        # Every page comes from the cache, so there is no site to be polite to, and a cache miss is skipped instead of fetched
+        self.settings.set("HTTPCACHE_IGNORE_MISSING", True, priority="cmdline")
+        self.settings.set("HTTPCACHE_FRESHNESS_POLICIES", [], priority="cmdline")
+        self.settings.set("ROBOTSTXT_OBEY", False, priority="cmdline")
+        self.settings.set("DOWNLOAD_DELAY", 0, priority="cmdline")
+        self.settings.set("AUTOTHROTTLE_ENABLED", False, priority="cmdline")
+        self.settings.set("CONCURRENT_REQUESTS", opts.concurrency, priority="cmdline")
+        self.settings.set("CONCURRENT_REQUESTS_PER_DOMAIN", opts.concurrency, priority="cmdline")
+        # Replay rebuilds the database, so directory pages are re-ingested even if they were parsed recently
+        self.settings.set("KNOWN_ENTITY_ENABLED", False, priority="cmdline")
+        self.settings.set("HTTPCACHE_S3_THREADS", max(opts.concurrency, self.settings.getint("HTTPCACHE_S3_THREADS")), priority="cmdline")
+
+    def run(self, args, opts):
+        if not 1 <= len(args) <= 2:
+            raise UsageError()
+
+        try:
+            start_month = datetime.strptime(args[0], "%Y-%m")
+            end_month = datetime.strptime(args[-1], "%Y-%m")
+        except ValueError:
+            raise UsageError(f"Invalid month: {args}")
+
+        logger.info(f"#run: start: start_month={start_month:%Y-%m}, end_month={end_month:%Y-%m}, race_id_from={opts.race_id_from}, race_id_to={opts.race_id_to}, concurrency={opts.concurrency}")
+
+        # Months are replayed one after another, so the reactor is stopped by the replay rather than by the first crawl
+        d = self._replay(start_month, end_month, opts)
+        d.addErrback(self._replay_failed)
+        d.addBoth(lambda _: reactor.callLater(0, reactor.stop))
+
+        self.crawler_process.start(stop_after_crawl=False)
+
+    def _replay_failed(self, failure):
+        logger.error("#_replay_failed: fail", exc_info=(failure.type, failure.value, failure.tb))
+        self.exitcode = 1
+
+    @defer.inlineCallbacks
+    def _replay(self, start_month, end_month, opts):
+        spider_kwargs = {}
+        if opts.race_id_from is not None:
+            spider_kwargs["race_id_from"] = opts.race_id_from
+        if opts.race_id_to is not None:
+            spider_kwargs["race_id_to"] = opts.race_id_to
+
+        # A month is replayed by one crawl, which starts at its schedule list page as a sharded crawl does
+        month = start_month
+        while month <= end_month:
+            logger.info(f"#_replay: replay month: month={month:%Y-%m}")
+
+            crawler = self.crawler_process.create_crawler("horse_racing")
+            yield self.crawler_process.crawl(crawler, SCHEDULE_LIST_URL.format(year=month.year, month=month.month), month, month + relativedelta(months=1), False, False, opts.bulk_ingest, **spider_kwargs)
+
+            stats = crawler.stats.get_stats()
+            logger.info(f"#_replay: month replayed: month={month:%Y-%m}, item_scraped_count={stats.get('item_scraped_count', 0)}, httpcache/hit={stats.get('httpcache/hit', 0)}, httpcache/ignore={stats.get('httpcache/ignore', 0)}")
+
+            month += relativedelta(months=1)
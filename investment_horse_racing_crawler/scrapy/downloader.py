@@ -0,0 +1,29 @@
+from scrapy.core.downloader import Downloader
+
+from investment_horse_racing_crawler.app_logging import get_logger
+
+
+logger = get_logger(__name__)
+
+
+class CacheAwareDownloader(Downloader):
+    """ Downloader whose concurrency limit is not used up by requests waiting for the politeness delay. """
+
+    def __init__(self, crawler):
+        super(CacheAwareDownloader, self).__init__(crawler)
+
+        self.max_queued_fetches = self.settings.getint("DOWNLOAD_MAX_QUEUED_FETCHES", 0)
+        self.stats = crawler.stats
+
+        logger.debug(f"#init: total_concurrency={self.total_concurrency}, max_queued_fetches={self.max_queued_fetches}")
+
+    def needs_backout(self):
+        if self.max_queued_fetches <= 0:
+            return super(CacheAwareDownloader, self).needs_backout()
+
+        # Cache misses wait in the slot queues for the download delay. They are bounded on their own,
+        # so a few of them do not stall the cache hits that are served before reaching a slot.
+        queued_count = sum(len(slot.queue) for slot in self.slots.values())
+        self.stats.max_value("downloader/queued_fetches_max", queued_count)
+
+        return len(self.active) - queued_count >= self.total_concurrency or queued_count >= self.max_queued_fetches
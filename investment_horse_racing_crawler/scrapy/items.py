@@ -1,95 +1,86 @@
 # -*- coding: utf-8 -*-
 
 
-from scrapy import Item, Field
-
-
-class RaceInfoItem(Item):
-    race_id = Field()
-    race_round = Field()
-    start_date = Field()
-    start_time = Field()
-    place_name = Field()
-    race_name = Field()
-    course_type_length = Field()
-    weather = Field()
-    course_condition = Field()
-    added_money = Field()
-
-
-class RacePayoffItem(Item):
-    race_id = Field()
-    payoff_type = Field()
-    horse_number = Field()
-    odds = Field()
-    favorite_order = Field()
-
-
-class RaceResultItem(Item):
-    race_id = Field()
-    result = Field()
-    bracket_number = Field()
-    horse_number = Field()
-    horse_id = Field()
-    horse_name = Field()
-    horse_gender_age = Field()
-    horse_weight_and_diff = Field()
-    arrival_time = Field()
-    jockey_id = Field()
-    jockey_name = Field()
-    jockey_weight = Field()
-    favorite_order = Field()
-    odds = Field()
-    trainer_id = Field()
-    trainer_name = Field()
-
-
-class RaceDenmaItem(Item):
-    race_id = Field()
-    bracket_number = Field()
-    horse_number = Field()
-    horse_id = Field()
-    trainer_id = Field()
-    horse_weight_and_diff = Field()
-    jockey_id = Field()
-    jockey_weight = Field()
-    prize_total_money = Field()
-
-
-class HorseItem(Item):
-    horse_id = Field()
-    gender = Field()
-    name = Field()
-    birthday = Field()
-    coat_color = Field()
-    trainer_id = Field()
-    owner = Field()
-    breeder = Field()
-    breeding_farm = Field()
-
-
-class TrainerItem(Item):
-    trainer_id = Field()
-    name_kana = Field()
-    name = Field()
-    birthday = Field()
-    belong_to = Field()
-    first_licensing_year = Field()
-
-
-class JockeyItem(Item):
-    jockey_id = Field()
-    name_kana = Field()
-    name = Field()
-    birthday = Field()
-    belong_to = Field()
-    first_licensing_year = Field()
-
-
-class OddsWinPlaceItem(Item):
-    race_id = Field()
-    horse_number = Field()
-    horse_id = Field()
-    odds_win = Field()
-    odds_place_min = Field()
-    odds_place_max = Field()
+from collections.abc import MutableMapping
+
+from scrapy.item import BaseItem
+
+
+class Record(BaseItem, MutableMapping):
+    """ Item that keeps one value per field in slots, instead of the dict of lists of scrapy.Item.
+
+    Rows are the bulk of the scraped items, so a record allocates neither a dict nor a list per field.
+    A field that was not scraped is an unset slot, and is missing from the mapping as in scrapy.Item.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        for name, value in dict(*args, **kwargs).items():
+            self[name] = value
+
+    def __getitem__(self, name):
+        if name not in self.__slots__:
+            raise KeyError(name)
+
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        if name not in self.__slots__:
+            raise KeyError(f"{type(self).__name__} does not support field: {name}")
+
+        setattr(self, name, value)
+
+    def __delitem__(self, name):
+        try:
+            delattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __iter__(self):
+        return (name for name in self.__slots__ if hasattr(self, name))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __hash__(self):
+        # Hashed by identity as scrapy.Item, since trackref keeps items in a WeakKeyDictionary
+        return id(self)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)!r})"
+
+
+class RaceInfoItem(Record):
+    __slots__ = ("race_id", "race_round", "start_date", "start_time", "place_name", "race_name", "course_type_length", "weather", "course_condition", "added_money")
+
+
+class RacePayoffItem(Record):
+    __slots__ = ("race_id", "payoff_type", "horse_number", "odds", "favorite_order")
+
+
+class RaceResultItem(Record):
+    __slots__ = ("race_id", "result", "bracket_number", "horse_number", "horse_id", "horse_name", "horse_gender_age", "horse_weight_and_diff", "arrival_time", "jockey_id", "jockey_name", "jockey_weight", "favorite_order", "odds", "trainer_id", "trainer_name")
+
+
+class RaceDenmaItem(Record):
+    __slots__ = ("race_id", "bracket_number", "horse_number", "horse_id", "trainer_id", "horse_weight_and_diff", "jockey_id", "jockey_weight", "prize_total_money")
+
+
+class HorseItem(Record):
+    __slots__ = ("horse_id", "gender", "name", "birthday", "coat_color", "trainer_id", "owner", "breeder", "breeding_farm")
+
+
+class TrainerItem(Record):
+    __slots__ = ("trainer_id", "name_kana", "name", "birthday", "belong_to", "first_licensing_year")
+
+
+class JockeyItem(Record):
+    __slots__ = ("jockey_id", "name_kana", "name", "birthday", "belong_to", "first_licensing_year")
+
+
+class OddsWinPlaceItem(Record):
+    __slots__ = ("race_id", "horse_number", "horse_id", "odds_win", "odds_place_min", "odds_place_max")
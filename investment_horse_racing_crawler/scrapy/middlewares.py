@@ -5,21 +5,57 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import os
+import re
 import boto3
-import pickle
+import sqlite3
+import threading
+import time
+from botocore.config import Config
+from dateutil import tz
 from scrapy import signals
-from scrapy.http import Headers
+from scrapy.core.downloader import Slot
+from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import Headers, Request
 from scrapy.responsetypes import responsetypes
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.project import data_path
 from scrapy.utils.request import request_fingerprint
 from botocore.exceptions import ClientError
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
 
 from investment_horse_racing_crawler.app_logging import get_logger
+from investment_horse_racing_crawler.scrapy.cache_archive import CacheArchiveSet, MmapArchiveReader, S3ArchiveReader
+from investment_horse_racing_crawler.scrapy.cache_record import encode_record, decode_record, get_stored_at, is_legacy_record
 
 
 logger = get_logger(__name__)
 
 
+# Sent with (request, spider) to warm the cache lookup of a request that is about to be scheduled
+cache_prefetch = object()
+
+
+# Packed archives of finished months are stored under S3_FOLDER/archives/ with this suffix
+ARCHIVE_SUFFIX = ".hrca"
+
+# pack_cache archives the pages of a race with the month the race starts, and the schedule page with its month
+ARCHIVE_SCHEDULE_URL_RE = re.compile("/schedule/list/([0-9]{4})/\\?month=([0-9]+)$")
+ARCHIVE_RACE_URL_RE = re.compile("/(?:race/list|race/denma|race/result|odds/tfw)/([0-9]{2})[0-9]+/$")
+
+
+# Spider flag that forces a refetch, and the URLs it applies to
+RECACHE_POLICIES = (
+    ("recache_race", re.compile("/schedule/list|/race/list|/race/result|/race/denma|/odds")),
+    ("recache_horse", re.compile("/directory/horse|/directory/trainer|/directory/jocky")),
+)
+
+
 class InvestmentHorseRacingCrawlerSpiderMiddleware(object):
     # Not all methods need to be defined. If a method is not defined,
     # scrapy acts as if the spider middleware does not modify the
@@ -115,6 +151,475 @@ class InvestmentHorseRacingCrawlerDownloaderMiddleware(object):
         spider.logger.info('Spider opened: %s' % spider.name)
 
 
+class ShardDedupSpiderMiddleware(object):
+    DIRECTORY_PATHS = ("/directory/horse/", "/directory/trainer/", "/directory/jocky/")
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("SHARD_DEDUP_ENABLED", True):
+            raise NotConfigured
+
+        return cls(crawler.stats)
+
+    def process_spider_output(self, response, result, spider):
+        # Shard processes share a claim table, so a directory page is fetched by the first shard that finds it
+        shard_claims = getattr(spider, "shard_claims", None)
+
+        for i in result:
+            if shard_claims is not None and isinstance(i, Request) and self._is_directory(i.url):
+                if shard_claims.setdefault(i.url, spider.shard_id) != spider.shard_id:
+                    logger.debug(f"#process_spider_output: claimed by other shard: url={i.url}")
+                    self.stats.inc_value("shard_dedup/skipped")
+                    continue
+
+                self.stats.inc_value("shard_dedup/claimed")
+
+            yield i
+
+    def _is_directory(self, url):
+        return any(path in url for path in self.DIRECTORY_PATHS)
+
+
+class KnownEntitySpiderMiddleware(object):
+    def __init__(self, path, max_age, stats):
+        logger.debug(f"#init: start: path={path}, max_age={max_age}")
+
+        self.path = path
+        self.max_age = max_age
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("KNOWN_ENTITY_ENABLED"):
+            raise NotConfigured
+
+        o = cls(
+            path=os.path.join(data_path(crawler.settings.get("KNOWN_ENTITY_DIR", "known_entities"), createdir=True), "known_entities.sqlite"),
+            max_age=crawler.settings.getfloat("KNOWN_ENTITY_MAX_AGE", 30 * 24 * 60 * 60),
+            stats=crawler.stats,
+        )
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(o.item_scraped, signal=signals.item_scraped)
+        return o
+
+    def spider_opened(self, spider):
+        # Autocommit with WAL, so shard processes can share the same file
+        self.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        self.db.execute("pragma journal_mode=wal")
+        self.db.execute("pragma synchronous=normal")
+        self.db.execute("create table if not exists entity (url text primary key, refreshed_at real not null)")
+
+    def spider_closed(self, spider):
+        self.db.close()
+
+    def process_spider_output(self, response, result, spider):
+        for i in result:
+            if isinstance(i, Request) and self._is_directory(i.url) and not getattr(spider, "recache_horse", False) and self._is_known(i.url):
+                logger.debug(f"#process_spider_output: known entity: url={i.url}")
+                self.stats.inc_value("known_entity/skipped")
+                continue
+
+            yield i
+
+    def item_scraped(self, item, response, spider):
+        # The entity is known once its item has passed the database pipeline, so a page whose item failed is fetched again
+        if self._is_directory(response.url) and response.status == 200:
+            self.db.execute("insert or replace into entity (url, refreshed_at) values (?, ?)", (response.url, time.time()))
+            self.stats.inc_value("known_entity/refreshed")
+
+    def _is_directory(self, url):
+        return any(path in url for path in ShardDedupSpiderMiddleware.DIRECTORY_PATHS)
+
+    def _is_known(self, url):
+        row = self.db.execute("select refreshed_at from entity where url=?", (url,)).fetchone()
+
+        return row is not None and time.time() - row[0] < self.max_age
+
+
+class AdaptiveConcurrencyMiddleware(object):
+    BACKOFF_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, crawler, path_classes, max_concurrency, target_latency, interval, max_delay, max_rate=0):
+        logger.debug(f"#init: start: path_classes={path_classes}, max_concurrency={max_concurrency}, target_latency={target_latency}, interval={interval}, max_delay={max_delay}, max_rate={max_rate}")
+
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.interval = interval
+        self.max_delay = max_delay
+
+        # The path classes share the politeness budget of the site. Together they start at 1 request / DOWNLOAD_DELAY,
+        # and are sped up only while their total rate stays within max_rate, which defaults to that start rate.
+        download_delay = crawler.settings.getfloat("DOWNLOAD_DELAY")
+        start_delay = download_delay * len(path_classes)
+        if max_rate > 0:
+            self.max_rate = max_rate
+        else:
+            self.max_rate = 1 / download_delay if download_delay > 0 else float("inf")
+
+        # Each path class is fetched through a download slot of its own, so each has its own concurrency and delay
+        self.path_classes = OrderedDict()
+        for c in path_classes:
+            self.path_classes[c["name"]] = {
+                "pattern": re.compile(c["pattern"]),
+                "max_concurrency": c.get("max_concurrency", 1),
+                "min_delay": c.get("min_delay", 0),
+                "concurrency": 1,
+                "delay": max(start_delay, c.get("min_delay", 0)),
+                "slot_keys": set(),
+                "latencies": [],
+                "response_count": 0,
+                "window_start": time.monotonic(),
+                "last_decrease": 0,
+            }
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("ADAPTIVE_CONCURRENCY_ENABLED"):
+            raise NotConfigured
+
+        o = cls(
+            crawler=crawler,
+            path_classes=crawler.settings.getlist("ADAPTIVE_CONCURRENCY_PATH_CLASSES"),
+            max_concurrency=crawler.settings.getint("ADAPTIVE_CONCURRENCY_MAX", 4),
+            target_latency=crawler.settings.getfloat("ADAPTIVE_CONCURRENCY_TARGET_LATENCY", 2.0),
+            interval=crawler.settings.getfloat("ADAPTIVE_CONCURRENCY_INTERVAL", 10.0),
+            max_delay=crawler.settings.getfloat("ADAPTIVE_CONCURRENCY_MAX_DELAY", 60.0),
+            max_rate=crawler.settings.getfloat("ADAPTIVE_CONCURRENCY_MAX_RATE", 0),
+        )
+
+        for name, path_class in o.path_classes.items():
+            o._export_stats(name, path_class)
+
+        return o
+
+    def process_request(self, request, spider):
+        name = self._get_path_class(request)
+        if name is None:
+            return None
+
+        path_class = self.path_classes[name]
+
+        slot_key = f"{urlparse_cached(request).hostname}/{name}"
+        request.meta["download_slot"] = slot_key
+        request.meta["adaptive_path_class"] = name
+
+        # Idle slots are garbage collected by the downloader, so a missing slot is created again with the current budget.
+        # The slot is created before the downloader looks it up for the request, so the budget applies from the first request.
+        path_class["slot_keys"].add(slot_key)
+
+        downloader = self.crawler.engine.downloader
+        if slot_key not in downloader.slots:
+            downloader.slots[slot_key] = Slot(path_class["concurrency"], path_class["delay"], downloader.randomize_delay)
+
+        return None
+
+    def process_response(self, request, response, spider):
+        name = request.meta.get("adaptive_path_class")
+        if name is None or "cached" in response.flags:
+            return response
+
+        path_class = self.path_classes[name]
+
+        if response.status in self.BACKOFF_STATUSES:
+            self.stats.inc_value(f"adaptive/{name}/errors")
+            self._decrease(name, path_class, f"status={response.status}")
+        else:
+            self._observe(name, path_class, request.meta.get("download_latency"))
+
+        return response
+
+    def process_exception(self, request, exception, spider):
+        name = request.meta.get("adaptive_path_class")
+        if name is None:
+            return None
+
+        self.stats.inc_value(f"adaptive/{name}/errors")
+        self._decrease(name, self.path_classes[name], f"exception={type(exception).__name__}")
+
+        return None
+
+    def _get_path_class(self, request):
+        for name, path_class in self.path_classes.items():
+            if path_class["pattern"].search(request.url):
+                return name
+
+        return None
+
+    def _observe(self, name, path_class, latency):
+        path_class["response_count"] += 1
+        if latency is not None:
+            path_class["latencies"].append(latency)
+
+        now = time.monotonic()
+        elapsed = now - path_class["window_start"]
+        if elapsed < self.interval:
+            return
+
+        # Decisions are made once per window, from the responses received in the window
+        latency_avg = sum(path_class["latencies"]) / len(path_class["latencies"]) if path_class["latencies"] else 0
+        self.stats.set_value(f"adaptive/{name}/rate", path_class["response_count"] / elapsed)
+        self.stats.set_value(f"adaptive/{name}/latency_avg", latency_avg)
+
+        path_class["latencies"] = []
+        path_class["response_count"] = 0
+        path_class["window_start"] = now
+
+        if latency_avg > self.target_latency:
+            self._decrease(name, path_class, f"latency_avg={latency_avg:.3f}")
+        else:
+            self._increase(name, path_class)
+
+    def _increase(self, name, path_class):
+        # The delay is shortened first, then requests are run in parallel
+        concurrency, delay = path_class["concurrency"], path_class["delay"]
+        if delay > path_class["min_delay"]:
+            delay = max(path_class["min_delay"], delay / 2)
+        elif concurrency < path_class["max_concurrency"] and self._total_concurrency() < self.max_concurrency:
+            concurrency += 1
+        else:
+            return
+
+        other_rate = sum(self._rate(c["concurrency"], c["delay"]) for c in self.path_classes.values() if c is not path_class)
+        if other_rate + self._rate(concurrency, delay) > self.max_rate:
+            self.stats.inc_value(f"adaptive/{name}/rate_limited")
+            return
+
+        path_class["concurrency"], path_class["delay"] = concurrency, delay
+
+        logger.info(f"#_increase: path_class={name}, concurrency={path_class['concurrency']}, delay={path_class['delay']}")
+        self.stats.inc_value(f"adaptive/{name}/increase")
+
+        self._apply(path_class)
+        self._export_stats(name, path_class)
+
+    def _decrease(self, name, path_class, reason):
+        # Responses of requests sent before a decrease arrive late, so a window passes before the next decrease
+        now = time.monotonic()
+        if now - path_class["last_decrease"] < self.interval:
+            return
+
+        path_class["last_decrease"] = now
+
+        if path_class["concurrency"] > 1:
+            path_class["concurrency"] = path_class["concurrency"] // 2
+        else:
+            path_class["delay"] = min(self.max_delay, max(path_class["delay"] * 2, path_class["min_delay"], 1.0))
+
+        logger.info(f"#_decrease: path_class={name}, reason={reason}, concurrency={path_class['concurrency']}, delay={path_class['delay']}")
+        self.stats.inc_value(f"adaptive/{name}/decrease")
+
+        self._apply(path_class)
+        self._export_stats(name, path_class)
+
+    def _apply(self, path_class):
+        slots = self.crawler.engine.downloader.slots
+
+        for slot_key in path_class["slot_keys"]:
+            slot = slots.get(slot_key)
+            if slot is not None:
+                slot.concurrency = path_class["concurrency"]
+                slot.delay = path_class["delay"]
+
+    def _rate(self, concurrency, delay):
+        return concurrency / delay if delay > 0 else float("inf")
+
+    def _total_concurrency(self):
+        return sum(c["concurrency"] for c in self.path_classes.values())
+
+    def _export_stats(self, name, path_class):
+        self.stats.set_value(f"adaptive/{name}/concurrency", path_class["concurrency"])
+        self.stats.set_value(f"adaptive/{name}/delay", path_class["delay"])
+
+
+class CacheFreshnessPolicy(object):
+    def __init__(self, policies, timezone):
+        logger.debug(f"#init: start: policies={policies}, timezone={timezone}")
+
+        self.policies = [(re.compile(p["pattern"]), p.get("max_age"), p.get("final_delay", 0)) for p in policies]
+        self.timezone = tz.gettz(timezone)
+
+    def is_fresh(self, request, stored_at, now=None):
+        # URLs without a policy, and policies without max_age, are cached forever
+        for url_re, max_age, final_delay in self.policies:
+            if url_re.search(request.url):
+                break
+        else:
+            return True
+
+        if max_age is None:
+            return True
+
+        if stored_at is None:
+            return False
+
+        # A page stored after it became final never changes again
+        final_datetime = request.meta.get("final_datetime")
+        if final_datetime is not None and stored_at >= final_datetime.replace(tzinfo=self.timezone).timestamp() + final_delay:
+            return True
+
+        return (now if now is not None else time.time()) - stored_at < max_age
+
+
+class SQLiteCacheTier(object):
+    def __init__(self, path, max_size):
+        logger.debug(f"#init: start: path={path}, max_size={max_size}")
+
+        self.path = path
+        self.max_size = max_size
+
+    def open(self):
+        # Autocommit with WAL, so shard processes can share the same file.
+        # The connection is shared by the cache I/O threads, so every access holds the lock.
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("pragma journal_mode=wal")
+        self.db.execute("pragma synchronous=normal")
+        self.db.execute("create table if not exists cache (key text primary key, data blob not null, size integer not null, accessed_at real not null)")
+        self.db.execute("create index if not exists cache_accessed_at on cache (accessed_at)")
+
+        self.total_size = self.db.execute("select coalesce(sum(size), 0) from cache").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("select data from cache where key=?", (key,)).fetchone()
+            if row is None:
+                return None
+
+            self.db.execute("update cache set accessed_at=? where key=?", (time.time(), key))
+
+            return bytes(row[0])
+
+    def put(self, key, data):
+        with self.lock:
+            self.db.execute("insert or replace into cache (key, data, size, accessed_at) values (?, ?, ?, ?)", (key, sqlite3.Binary(data), len(data), time.time()))
+
+            self.total_size += len(data)
+            if self.total_size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # Evict down to 90% of the limit, so eviction does not run on every put
+        self.total_size = self.db.execute("select coalesce(sum(size), 0) from cache").fetchone()[0]
+        target_size = self.max_size * 0.9
+
+        evict_keys = []
+        for key, size in self.db.execute("select key, size from cache order by accessed_at"):
+            if self.total_size <= target_size:
+                break
+
+            evict_keys.append((key,))
+            self.total_size -= size
+
+        self.db.executemany("delete from cache where key=?", evict_keys)
+
+        logger.debug(f"#_evict: evicted: count={len(evict_keys)}, total_size={self.total_size}")
+
+
+class CachePrefetchSpiderMiddleware(object):
+    def __init__(self, signals, patterns):
+        self.signals = signals
+        self.patterns = [re.compile(p) for p in patterns]
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("HTTPCACHE_PREFETCH_ENABLED"):
+            raise NotConfigured
+
+        return cls(crawler.signals, crawler.settings.getlist("HTTPCACHE_PREFETCH_PATTERNS"))
+
+    def process_spider_output(self, response, result, spider):
+        # Links of these pages are always crawled, so their lookups start as soon as the page is parsed
+        prefetch = any(p.search(response.url) for p in self.patterns)
+
+        for i in result:
+            if prefetch and isinstance(i, Request):
+                self.signals.send_catch_log(signal=cache_prefetch, request=i, spider=spider)
+
+            yield i
+
+
+class ThreadedHttpCacheMiddleware(HttpCacheMiddleware):
+    @classmethod
+    def from_crawler(cls, crawler):
+        o = super(ThreadedHttpCacheMiddleware, cls).from_crawler(crawler)
+        crawler.signals.connect(o.cache_prefetch, signal=cache_prefetch)
+        return o
+
+    def cache_prefetch(self, request, spider):
+        if not hasattr(self.storage, "prefetch"):
+            return
+
+        if request.meta.get("dont_cache", False) or not self.policy.should_cache_request(request):
+            return
+
+        self.storage.prefetch(spider, request)
+
+    def process_request(self, request, spider):
+        # Storages with a Deferred lookup do not block the reactor, so cache hits are served concurrently
+        if not hasattr(self.storage, "retrieve_response_deferred"):
+            return super(ThreadedHttpCacheMiddleware, self).process_request(request, spider)
+
+        if request.meta.get("dont_cache", False):
+            return None
+
+        if not self.policy.should_cache_request(request):
+            request.meta["_dont_cache"] = True
+            return None
+
+        d = self.storage.retrieve_response_deferred(spider, request)
+        d.addCallback(self._process_cached_response, request, spider)
+
+        return d
+
+    def process_response(self, request, response, spider):
+        response = super(ThreadedHttpCacheMiddleware, self).process_response(request, response, spider)
+
+        # The response is handed on once its store is accepted, so a slow storage holds the downloads back
+        d = request.meta.pop("_cache_store", None)
+        if d is None:
+            return response
+
+        d.addCallback(lambda _: response)
+
+        return d
+
+    def _cache_response(self, spider, response, request, cachedresponse):
+        if not hasattr(self.storage, "store_response_deferred"):
+            return super(ThreadedHttpCacheMiddleware, self)._cache_response(spider, response, request, cachedresponse)
+
+        if self.policy.should_cache_response(response, request):
+            self.stats.inc_value("httpcache/store", spider=spider)
+            request.meta["_cache_store"] = self.storage.store_response_deferred(spider, request, response)
+        else:
+            self.stats.inc_value("httpcache/uncacheable", spider=spider)
+
+    def _process_cached_response(self, cachedresponse, request, spider):
+        if cachedresponse is None:
+            self.stats.inc_value("httpcache/miss", spider=spider)
+            if self.ignore_missing:
+                self.stats.inc_value("httpcache/ignore", spider=spider)
+                raise IgnoreRequest("Ignored request not in cache: %s" % request)
+            return None
+
+        cachedresponse.flags.append("cached")
+        if self.policy.is_cached_response_fresh(cachedresponse, request):
+            self.stats.inc_value("httpcache/hit", spider=spider)
+            return cachedresponse
+
+        request.meta["cached_response"] = cachedresponse
+        return None
+
+
 class S3CacheStorage(object):
 
     def __init__(self, settings):
@@ -129,52 +634,309 @@ class S3CacheStorage(object):
 
         logger.debug("#init: endpoint=%s, region=%s, bucket=%s, folder=%s" % (self.s3_endpoint, self.s3_region, self.s3_bucket, self.s3_folder))
 
+        self.local_enabled = settings.getbool("HTTPCACHE_LOCAL_ENABLED")
+        self.local_dir = settings.get("HTTPCACHE_LOCAL_DIR", "httpcache_local")
+        self.local_max_size = settings.getint("HTTPCACHE_LOCAL_MAX_SIZE", 1024 * 1024 * 1024)
+        self.allow_legacy = settings.getbool("HTTPCACHE_ALLOW_LEGACY_RECORDS")
+
+        self.s3_max_pool_connections = settings.getint("HTTPCACHE_S3_MAX_POOL_CONNECTIONS", 10)
+        self.io_threads = settings.getint("HTTPCACHE_S3_THREADS", 0)
+        self.max_pending_stores = settings.getint("HTTPCACHE_S3_MAX_PENDING_STORES", 100)
+        self.prefetch_max = settings.getint("HTTPCACHE_PREFETCH_MAX", 500)
+
+        self.archive_enabled = settings.getbool("HTTPCACHE_ARCHIVE_ENABLED")
+        self.archive_local_dir = settings.get("HTTPCACHE_ARCHIVE_LOCAL_DIR")
+
+        self.stats = None
+        self.stats_lock = threading.Lock()
+        self.executor = None
+        self.archives = None
+
+        self.freshness_policy = CacheFreshnessPolicy(settings.getlist("HTTPCACHE_FRESHNESS_POLICIES"), settings.get("HTTPCACHE_FRESHNESS_TIMEZONE", "Asia/Tokyo"))
+
     def open_spider(self, spider):
         logger.debug("#open_spider: start: spider=%s" % spider)
 
-        self.s3_client = boto3.resource(
+        self.open_bucket()
+
+        self.stats = spider.crawler.stats if hasattr(spider, "crawler") else None
+
+        self.local_tier = None
+        if self.local_enabled:
+            self.local_tier = SQLiteCacheTier(self.get_local_tier_path(), self.local_max_size)
+            self.local_tier.open()
+
+            logger.debug("#open_spider: local tier opened")
+
+        if self.archive_enabled:
+            self.open_archives()
+
+        if self.io_threads > 0:
+            self.executor = ThreadPoolExecutor(max_workers=self.io_threads, thread_name_prefix="S3CacheStorage")
+            self.pending_stores = defer.DeferredSemaphore(self.max_pending_stores)
+
+            # Prefetched lookups, in the order they were submitted
+            self.prefetched = OrderedDict()
+            self.prefetched_rpaths = OrderedDict()
+
+            logger.debug(f"#open_spider: cache I/O threads started: io_threads={self.io_threads}")
+
+    def open_bucket(self):
+        # The low-level client is thread safe, so one client and its connection pool is shared by the I/O threads
+        self.s3_client = boto3.client(
             "s3",
             endpoint_url=self.s3_endpoint,
             aws_access_key_id=self.s3_access_key,
             aws_secret_access_key=self.s3_secret_key,
-            region_name=self.s3_region)
+            region_name=self.s3_region,
+            config=Config(max_pool_connections=self.s3_max_pool_connections))
 
-        self.s3_bucket_obj = self.s3_client.Bucket(self.s3_bucket)
-        if self.s3_bucket_obj.creation_date:
-            logger.debug("#open_spider: bucket exist")
-        else:
-            self.s3_bucket_obj.create()
-            logger.debug("#open_spider: bucket created")
+        try:
+            self.s3_client.head_bucket(Bucket=self.s3_bucket)
+            logger.debug("#open_bucket: bucket exist")
+        except ClientError as err:
+            if err.response["Error"]["Code"] not in ("NoSuchBucket", "404"):
+                raise err
+
+            self.s3_client.create_bucket(Bucket=self.s3_bucket)
+            logger.debug("#open_bucket: bucket created")
+
+    def open_archives(self):
+        # Only the archives are listed here, each one is downloaded and its index read by the first lookup in its month
+        self.archives = CacheArchiveSet()
+
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.s3_bucket, Prefix=self.get_archive_prefix()):
+            for s3_obj in page.get("Contents", []):
+                if not s3_obj["Key"].endswith(ARCHIVE_SUFFIX):
+                    continue
+
+                month = os.path.basename(s3_obj["Key"])[:-len(ARCHIVE_SUFFIX)]
+                self.archives.add(month, partial(self._open_archive_reader, s3_obj["Key"], s3_obj["Size"]), s3_obj["Size"])
+
+        self._inc_stats("httpcache/archive/archives", len(self.archives.archives))
+
+    def _open_archive_reader(self, key, size):
+        logger.debug(f"#_open_archive_reader: key={key}")
+        self._inc_stats("httpcache/archive/opened")
+
+        if not self.archive_local_dir:
+            return S3ArchiveReader(self.s3_client, self.s3_bucket, key)
+
+        # Archives are immutable, so a local copy of the same size is reused as is
+        archive_path = os.path.join(data_path(self.archive_local_dir, createdir=True), os.path.basename(key))
+        if not os.path.exists(archive_path) or os.path.getsize(archive_path) != size:
+            self.s3_client.download_file(self.s3_bucket, key, archive_path)
+
+        return MmapArchiveReader(archive_path)
+
+    def _get_archive_months(self, request):
+        schedule_re = ARCHIVE_SCHEDULE_URL_RE.search(request.url)
+        if schedule_re:
+            return [f"{schedule_re.group(1)}-{int(schedule_re.group(2)):02d}"]
+
+        race_re = ARCHIVE_RACE_URL_RE.search(request.url)
+        if race_re:
+            return self.archives.get_race_year_months(race_re.group(1))
+
+        # Directory pages are left loose
+        return []
+
+    def get_archive_prefix(self):
+        return os.path.join(self.s3_folder, "archives") + "/"
+
+    def get_local_tier_path(self):
+        return os.path.join(data_path(self.local_dir, createdir=True), "cache.sqlite")
 
     def close_spider(self, spider):
         logger.debug("#close_spider")
 
+        if self.executor is not None:
+            # Waits for the in-flight stores
+            self.executor.shutdown(wait=True)
+
+            logger.debug("#close_spider: cache I/O threads stopped")
+
+        if self.local_tier is not None:
+            self.local_tier.close()
+
+        if self.archives is not None:
+            self.archives.close()
+
     def retrieve_response(self, spider, request):
         logger.debug("#retrieve_response: start: url=%s" % request.url)
 
+        start_time = time.monotonic()
+        try:
+            return self._retrieve_response(spider, request)
+        finally:
+            self._record_lookup_stats(time.monotonic() - start_time)
+
+    def retrieve_response_deferred(self, spider, request):
+        if self.executor is None:
+            return defer.succeed(self.retrieve_response(spider, request))
+
+        logger.debug("#retrieve_response_deferred: start: url=%s" % request.url)
+
+        if self._is_recache(spider, request):
+            return defer.succeed(None)
+
+        start_time = time.monotonic()
+
+        rpath = self._get_request_path(spider, request)
+        future = self.prefetched.pop(rpath, None)
+        if future is not None:
+            self._inc_stats("httpcache/prefetch/hit")
+        else:
+            future = self.executor.submit(self._load_record, rpath, request)
+
+        d = self._defer_future(future)
+        d.addCallback(lambda record: self._build_response(request, record))
+        d.addBoth(self._lookup_done, start_time)
+
+        return d
+
+    def prefetch(self, spider, request):
+        if self.executor is None or self._match_recache(spider, request) is not None:
+            return
+
+        rpath = self._get_request_path(spider, request)
+
+        # Directory pages are linked from many races, so recently seen paths are not prefetched again
+        if rpath in self.prefetched_rpaths:
+            return
+
+        self.prefetched_rpaths[rpath] = True
+        while len(self.prefetched_rpaths) > self.prefetch_max * 10:
+            self.prefetched_rpaths.popitem(last=False)
+
+        logger.debug(f"#prefetch: url={request.url}, cache path={rpath}")
+
+        self.prefetched[rpath] = self.executor.submit(self._load_record, rpath, request)
+        self._inc_stats("httpcache/prefetch/submitted")
+
+        while len(self.prefetched) > self.prefetch_max:
+            self.prefetched.popitem(last=False)
+            self._inc_stats("httpcache/prefetch/dropped")
+
+    def _match_recache(self, spider, request):
+        for flag, url_re in RECACHE_POLICIES:
+            if getattr(spider, flag, False) and url_re.search(request.url):
+                return flag
+
+        return None
+
+    def _is_recache(self, spider, request):
+        flag = self._match_recache(spider, request)
+        if flag is None:
+            return False
+
+        logger.debug(f"#retrieve_response: re-cache: flag={flag}")
+        self._inc_stats("httpcache/recache")
+
+        return True
+
+    def _retrieve_response(self, spider, request):
+        # The recache policy needs no I/O, so it is evaluated before any cache lookup
+        if self._is_recache(spider, request):
+            return
+
         rpath = self._get_request_path(spider, request)
         logger.debug("#retrieve_response: cache path=%s" % rpath)
 
-        s3_obj = self.s3_bucket_obj.Object(rpath)
+        return self._build_response(request, self._load_record(rpath, request))
+
+    def _load_record(self, rpath, request):
+        data_obj = None
+        if self.local_tier is not None:
+            data_obj = self._load_local(rpath, request)
+
+        if data_obj is None and self.archives is not None:
+            data_obj = self._load_archived(rpath, request)
+
+        if data_obj is not None:
+            return get_stored_at(data_obj), decode_record(data_obj, allow_legacy=self.allow_legacy)
 
         try:
-            s3_obj.last_modified
+            s3_obj = self.s3_client.get_object(Bucket=self.s3_bucket, Key=rpath)
+            data_obj = s3_obj["Body"].read()
         except ClientError as err:
-            if err.response["Error"]["Code"] == "404":
-                logger.debug("#retrieve_response: cache_nothing")
-                return
+            if err.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                logger.debug("#_load_record: cache_nothing")
+                self._inc_stats("httpcache/s3/miss")
+                return None
             else:
                 raise err
 
-        if spider.recache_race and (("/schedule/list" in request.url) or ("/race/list" in request.url) or ("/race/result" in request.url) or ("/race/denma" in request.url) or ("/odds" in request.url)):
-            logger.debug("#retrieve_response: re-cache race")
-            return
+        if is_legacy_record(data_obj) and not self.allow_legacy:
+            logger.warning(f"#_load_record: legacy record rejected: key={rpath}")
+            self._inc_stats("httpcache/s3/legacy_rejected")
+            return None
 
-        if spider.recache_horse and (("/directory/horse" in request.url) or ("/directory/trainer" in request.url) or ("/directory/jocky" in request.url)):
-            logger.debug("#retrieve_response: re-cache horse/jockey/trainer")
-            return
+        self._inc_stats("httpcache/s3/hit")
+
+        stored_at = get_stored_at(data_obj)
+        data = decode_record(data_obj, allow_legacy=self.allow_legacy)
+
+        # A legacy record has no stored_at, so the object's upload time is used and kept in the local copy
+        if stored_at is None and "LastModified" in s3_obj:
+            stored_at = s3_obj["LastModified"].timestamp()
+            data_obj = encode_record(data["status"], data["url"], data["headers"], data["body"], stored_at)
+
+        if self.local_tier is not None:
+            self.local_tier.put(rpath, data_obj)
+
+        return stored_at, data
+
+    def _load_local(self, rpath, request):
+        data_obj = self.local_tier.get(rpath)
+        if data_obj is None:
+            self._inc_stats("httpcache/local/miss")
+            return None
 
-        data = pickle.loads(s3_obj.get()["Body"].read())
+        if is_legacy_record(data_obj) and not self.allow_legacy:
+            self._inc_stats("httpcache/local/legacy_rejected")
+            return None
+
+        # Legacy and migrated local records have no real stored_at, and S3 may hold a newer page stored by another host,
+        # so a stale local record falls through to S3
+        if not self.freshness_policy.is_fresh(request, get_stored_at(data_obj)):
+            self._inc_stats("httpcache/local/stale")
+            return None
+
+        self._inc_stats("httpcache/local/hit")
+
+        return data_obj
+
+    def _load_archived(self, rpath, request):
+        data_obj = self.archives.get(os.path.basename(rpath), self._get_archive_months(request))
+        if data_obj is None:
+            self._inc_stats("httpcache/archive/miss")
+            return None
+
+        # A page refetched after it was archived is stored as a loose object, so a stale archived record falls through to it
+        if not self.freshness_policy.is_fresh(request, get_stored_at(data_obj)):
+            self._inc_stats("httpcache/archive/stale")
+            return None
+
+        self._inc_stats("httpcache/archive/hit")
+
+        if self.local_tier is not None:
+            self.local_tier.put(rpath, data_obj)
+
+        return data_obj
+
+    def _build_response(self, request, record):
+        if record is None:
+            return None
+
+        stored_at, data = record
+
+        # Stale local and archived records fall through to S3, so this is the freshness of the newest stored page
+        if not self.freshness_policy.is_fresh(request, stored_at):
+            logger.debug(f"#retrieve_response: stale: stored_at={stored_at}")
+            self._inc_stats("httpcache/stale")
+            return None
 
         url = data["url"]
         status = data["status"]
@@ -187,24 +949,101 @@ class S3CacheStorage(object):
 
         return response
 
+    def _lookup_done(self, result, start_time):
+        self._record_lookup_stats(time.monotonic() - start_time)
+
+        return result
+
     def store_response(self, spider, request, response):
+        self.store_response_deferred(spider, request, response)
+
+    def store_response_deferred(self, spider, request, response):
         logger.debug("#store_response: start: url=%s" % response.url)
 
         rpath = self._get_request_path(spider, request)
         logger.debug("#store_response: cache path=%s" % rpath)
 
-        data = {
-            "status": response.status,
-            "url": response.url,
-            "headers": dict(response.headers),
-            "body": response.body,
-        }
+        if self.executor is None:
+            self._store(rpath, response.status, response.url, response.headers, response.body)
+            return defer.succeed(None)
+
+        # Stores are fire-and-forget, but bounded. Past the bound the returned Deferred waits for a pending store to finish,
+        # so a slow S3 holds the crawl back without blocking the reactor.
+        if self.pending_stores.tokens == 0:
+            self._inc_stats("httpcache/store_backpressure")
+
+        d = self.pending_stores.acquire()
+        d.addCallback(lambda _: self._submit_store(rpath, response))
+        d.addErrback(self._store_failed)
+
+        return d
 
-        data_obj = pickle.dumps(data)
+    def _submit_store(self, rpath, response):
+        try:
+            future = self.executor.submit(self._store, rpath, response.status, response.url, response.headers, response.body)
+        except Exception:
+            self.pending_stores.release()
+            raise
+
+        future.add_done_callback(self._store_done)
+
+    def _store(self, rpath, status, url, headers, body):
+        data_obj = encode_record(status, url, headers, body)
+
+        self.s3_client.put_object(Bucket=self.s3_bucket, Key=rpath, Body=data_obj)
+
+        if self.local_tier is not None:
+            self.local_tier.put(rpath, data_obj)
+
+        logger.debug(f"#_store: data put: cache path={rpath}")
+
+    def _store_done(self, future):
+        reactor.callFromThread(self.pending_stores.release)
+
+        exception = future.exception()
+        if exception is not None:
+            logger.error("#_store_done: fail", exc_info=(type(exception), exception, exception.__traceback__))
+            self._inc_stats("httpcache/store_errors")
+
+    def _store_failed(self, failure):
+        logger.error("#_store_failed: fail", exc_info=(failure.type, failure.value, failure.getTracebackObject()))
+        self._inc_stats("httpcache/store_errors")
+
+    def _defer_future(self, future):
+        d = defer.Deferred()
+
+        future.add_done_callback(lambda future: reactor.callFromThread(self._resolve, d, future))
+
+        return d
+
+    def _resolve(self, d, future):
+        exception = future.exception()
+        if exception is not None:
+            d.errback(Failure(exception))
+        else:
+            d.callback(future.result())
+
+    def _inc_stats(self, key, count=1):
+        # Cache I/O threads update the stats too, so the read-modify-write is serialized
+        if self.stats is not None:
+            with self.stats_lock:
+                self.stats.inc_value(key, count)
+
+    def _record_lookup_stats(self, latency):
+        if self.stats is None:
+            return
 
-        self.s3_bucket_obj.Object(rpath).put(Body=data_obj)
+        with self.stats_lock:
+            self.stats.inc_value("httpcache/lookup_count")
+            self.stats.inc_value("httpcache/lookup_latency_total", latency)
+            self.stats.max_value("httpcache/lookup_latency_max", latency)
+            self.stats.set_value("httpcache/lookup_latency_avg", self.stats.get_value("httpcache/lookup_latency_total") / self.stats.get_value("httpcache/lookup_count"))
 
-        logger.debug("#store_response: data put")
+            for tier in ("local", "archive", "s3"):
+                hit_count = self.stats.get_value(f"httpcache/{tier}/hit", 0)
+                lookup_count = hit_count + self.stats.get_value(f"httpcache/{tier}/miss", 0)
+                if lookup_count > 0:
+                    self.stats.set_value(f"httpcache/{tier}/hit_ratio", hit_count / lookup_count)
 
     def _get_request_path(self, spider, request):
         key = request_fingerprint(request)
@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+
+
+from collections import namedtuple
+from datetime import datetime
+import re
+from scrapy.exceptions import DropItem
+
+from investment_horse_racing_crawler.scrapy.items import RaceInfoItem, RacePayoffItem, RaceResultItem, RaceDenmaItem, HorseItem, TrainerItem, JockeyItem, OddsWinPlaceItem
+
+
+# Normalizers do not touch the database, so they can run anywhere (e.g. in a worker process).
+# Each normalizer returns the normalized item and the rows to write as (table, row) pairs.
+
+
+RACE_ROUND_RE = re.compile("^([0-9]+)R$")
+START_DATE_RE = re.compile("^([0-9]{4})年([0-9]{1,2})月([0-9]{1,2})日")
+START_TIME_RE = re.compile("^([0-9]+):([0-9]+)発走$")
+COURSE_TYPE_LENGTH_RE = re.compile("^(.+?) ([0-9]+)m$")
+HORSE_GENDER_AGE_RE = re.compile("^([^0-9]+)([0-9]+)$")
+HORSE_WEIGHT_AND_DIFF_RE = re.compile("^([\\- 0-9]+)\\(([\\+\\- 0-9]+)\\)$")
+RACE_RESULT_JOCKEY_WEIGHT_RE = re.compile("^[^0-9]?([\\.0-9]+)$")
+RACE_RESULT_ODDS_RE = re.compile("^\\(([\\.\\- 0-9]+)\\)$")
+RACE_DENMA_JOCKEY_WEIGHT_RE = re.compile("^([\\.0-9]+)[^0-9]*$")
+BIRTHDAY_RE = re.compile("^([0-9]+)年([0-9]+)月([0-9]+)日$")
+TRAINER_FIRST_LICENSING_YEAR_RE = re.compile("^([0-9]+)年$")
+JOCKEY_FIRST_LICENSING_YEAR_RE = re.compile("^([0-9]+)年.*$")
+
+NormalizedItem = namedtuple("NormalizedItem", ["item", "rows"])
+
+
+class NormalizedValues(dict):
+    """ Values of a normalized item, which keep the name of the item class they were normalized from. """
+
+    __slots__ = ("item_type",)
+
+    def __init__(self, item_type, *args, **kwargs):
+        super(NormalizedValues, self).__init__(*args, **kwargs)
+
+        self.item_type = item_type
+
+
+PAYOFF_TYPES = {
+    "単勝": "win",
+    "複勝": "place",
+    "枠連": "bracket_quinella",
+    "馬連": "quinella",
+    "ワイド": "quinella_place",
+    "馬単": "exacta",
+    "3連複": "trio",
+    "3連単": "trifecta",
+}
+
+
+def normalize_item(item):
+    normalizer = NORMALIZERS.get(type(item))
+    if normalizer is None:
+        raise DropItem("Unknown item type")
+
+    values, rows = normalizer(item)
+
+    return NormalizedValues(type(item).__name__, values), rows
+
+
+def normalize_values(item_cls, values):
+    # Entry point for worker processes, which receive the item values as a plain dict
+    normalizer = NORMALIZERS.get(item_cls)
+    if normalizer is None:
+        raise DropItem("Unknown item type")
+
+    values, rows = normalizer(values)
+
+    return NormalizedItem(NormalizedValues(item_cls.__name__, values), rows)
+
+
+def parse_start_datetime(start_date_str, start_time_str):
+    start_date_reg = START_DATE_RE.match(start_date_str.strip())
+    start_time_reg = START_TIME_RE.match(start_time_str.strip())
+    if not (start_date_reg and start_time_reg):
+        return None
+
+    return datetime(int(start_date_reg.group(1)), int(start_date_reg.group(2)), int(start_date_reg.group(3)), int(start_time_reg.group(1)), int(start_time_reg.group(2)), 0)
+
+
+def normalize_race_info_item(item):
+    i = {}
+
+    i["race_id"] = item["race_id"]
+
+    race_round_reg = RACE_ROUND_RE.match(item["race_round"].strip())
+    if race_round_reg:
+        i["race_round"] = int(race_round_reg.group(1))
+    else:
+        raise DropItem("Unknown pattern race_round")
+
+    i["start_datetime"] = parse_start_datetime(item["start_date"], item["start_time"])
+    if i["start_datetime"] is None:
+        raise DropItem("Unknown pattern start_date, start_time")
+
+    i["place_name"] = item["place_name"].strip()
+
+    i["race_name"] = item["race_name"].strip()
+
+    course_type_length_reg = COURSE_TYPE_LENGTH_RE.match(item["course_type_length"].strip())
+    if course_type_length_reg:
+        i["course_type"] = course_type_length_reg.group(1)
+        i["course_length"] = int(course_type_length_reg.group(2))
+    else:
+        raise DropItem("Unknown pattern course_type_length")
+
+    i["weather"] = item["weather"].strip()
+
+    i["course_condition"] = item["course_condition"].strip()
+
+    i["added_money"] = item["added_money"].strip()
+
+    rows = [("race_info", (i["race_id"], i["race_round"], i["start_datetime"], i["place_name"], i["race_name"], i["course_type"], i["course_length"], i["weather"], i["course_condition"], i["added_money"]))]
+
+    return i, rows
+
+
+def normalize_race_payoff_item(item):
+    i = {}
+
+    i["race_id"] = item["race_id"]
+
+    payoff_type = PAYOFF_TYPES.get(item["payoff_type"])
+    if payoff_type is not None:
+        i["payoff_type"] = payoff_type
+    else:
+        raise DropItem("Unknown payoff_type")
+
+    if "horse_number" in item:
+        horse_number_parts = item["horse_number"].split("－")
+
+        if 1 <= len(horse_number_parts) <= 3:
+            horse_numbers = [int(horse_number_part) for horse_number_part in horse_number_parts] + [None] * (3 - len(horse_number_parts))
+            i["horse_number_1"], i["horse_number_2"], i["horse_number_3"] = horse_numbers
+        else:
+            raise DropItem("Unknown horse_number")
+    else:
+        raise DropItem("Empty race payoff record")
+
+    i["odds"] = int(item["odds"].replace("円", "").replace(",", ""))/100.0
+
+    favorite_order_str = item["favorite_order"].replace("番人気", "").strip()
+    if favorite_order_str != "-":
+        i["favorite_order"] = int(favorite_order_str)
+    else:
+        i["favorite_order"] = None
+
+    race_payoff_id = "_".join(str(v) for v in (i["race_id"], i["payoff_type"], i["horse_number_1"], i["horse_number_2"], i["horse_number_3"]) if v is not None)
+
+    rows = [("race_payoff", (race_payoff_id, i["race_id"], i["payoff_type"], i["horse_number_1"], i["horse_number_2"], i["horse_number_3"], i["odds"], i["favorite_order"]))]
+
+    return i, rows
+
+
+def normalize_race_result_item(item):
+    i = {}
+
+    i["race_id"] = item["race_id"]
+
+    result_str = item["result"].strip()
+    if len(result_str) > 0:
+        i["result"] = int(result_str)
+    else:
+        i["result"] = None
+
+    i["bracket_number"] = int(item["bracket_number"].strip())
+
+    i["horse_number"] = int(item["horse_number"].strip())
+
+    i["horse_id"] = _parse_id(item["horse_id"])
+
+    i["horse_name"] = item["horse_name"].strip()
+
+    horse_gender_age_reg = HORSE_GENDER_AGE_RE.match(item["horse_gender_age"].strip().split("/")[0])
+    if horse_gender_age_reg:
+        i["horse_gender"] = horse_gender_age_reg.group(1)
+        i["horse_age"] = int(horse_gender_age_reg.group(2))
+    else:
+        raise DropItem("Unknown horse_gender_age")
+
+    i["horse_weight"], i["horse_weight_diff"] = _parse_horse_weight_and_diff(item["horse_weight_and_diff"].strip().split("/")[1])
+
+    arrival_time_str = item["arrival_time"].strip()
+    if len(arrival_time_str) > 0:
+        arrival_time_parts = arrival_time_str.split(".")
+        if len(arrival_time_parts) == 2:
+            i["arrival_time"] = int(arrival_time_parts[0]) + int(arrival_time_parts[1]) * 0.1
+        else:
+            i["arrival_time"] = int(arrival_time_parts[0]) * 60.0 + int(arrival_time_parts[1]) + int(arrival_time_parts[2]) * 0.1
+    else:
+        i["arrival_time"] = None
+
+    i["jockey_id"] = _parse_id(item["jockey_id"])
+
+    i["jockey_name"] = item["jockey_name"].strip()
+
+    jockey_weight_reg = RACE_RESULT_JOCKEY_WEIGHT_RE.match(item["jockey_weight"].strip())
+    if jockey_weight_reg:
+        i["jockey_weight"] = float(jockey_weight_reg.group(1))
+    else:
+        raise DropItem("Unknown jockey_weight pattern")
+
+    favorite_order_str = item["favorite_order"].strip()
+    if len(favorite_order_str) > 0:
+        i["favorite_order"] = int(favorite_order_str)
+    else:
+        i["favorite_order"] = None
+
+    if "odds" in item:
+        odds_reg = RACE_RESULT_ODDS_RE.match(item["odds"].strip())
+        if odds_reg:
+            i["odds"] = _parse_float(odds_reg.group(1).strip(), "-")
+        else:
+            raise DropItem("Unknown odds pattern")
+    else:
+        i["odds"] = None
+
+    i["trainer_id"] = _parse_id(item["trainer_id"])
+
+    i["trainer_name"] = item["trainer_name"].strip()
+
+    race_result_id = "{}_{}".format(i["race_id"], i["horse_number"])
+
+    rows = [("race_result", (race_result_id, i["race_id"], i["result"], i["bracket_number"], i["horse_number"], i["horse_id"], i["horse_weight"], i["horse_weight_diff"], i["arrival_time"], i["jockey_id"], i["jockey_weight"], i["favorite_order"], i["odds"], i["trainer_id"]))]
+
+    return i, rows
+
+
+def normalize_race_denma_item(item):
+    i = {}
+
+    i["race_id"] = item["race_id"]
+
+    bracket_number_str = item["bracket_number"].strip()
+    if bracket_number_str != "-":
+        i["bracket_number"] = int(bracket_number_str)
+    else:
+        i["bracket_number"] = None
+
+    horse_number_str = item["horse_number"].strip()
+    if horse_number_str != "-":
+        i["horse_number"] = int(horse_number_str)
+    else:
+        i["horse_number"] = None
+
+    i["horse_id"] = _parse_id(item["horse_id"])
+
+    if "trainer_id" in item:
+        i["trainer_id"] = _parse_id(item["trainer_id"])
+    else:
+        i["trainer_id"] = None
+
+    i["horse_weight"], i["horse_weight_diff"] = _parse_horse_weight_and_diff(item["horse_weight_and_diff"].strip())
+
+    i["jockey_id"] = _parse_id(item["jockey_id"])
+
+    jockey_weight_reg = RACE_DENMA_JOCKEY_WEIGHT_RE.match(item["jockey_weight"].strip())
+    if jockey_weight_reg:
+        i["jockey_weight"] = float(jockey_weight_reg.group(1))
+    else:
+        raise DropItem("Unknown jockey_weight pattern")
+
+    i["prize_total_money"] = float(item["prize_total_money"].strip().replace("億", "").replace("万", ""))
+
+    race_denma_id = "{}_{}".format(i["race_id"], i["horse_id"])
+
+    rows = [("race_denma", (race_denma_id, i["race_id"], i["bracket_number"], i["horse_number"], i["horse_id"], i["trainer_id"], i["horse_weight"], i["horse_weight_diff"], i["jockey_id"], i["jockey_weight"], i["prize_total_money"]))]
+
+    return i, rows
+
+
+def normalize_horse_item(item):
+    i = {}
+
+    i["horse_id"] = item["horse_id"]
+
+    i["gender"] = item["gender"].split("|")[-2].strip()
+
+    i["name"] = item["name"].strip()
+
+    i["birthday"] = _parse_birthday(item["birthday"])
+
+    i["coat_color"] = item["coat_color"].strip()
+
+    i["trainer_id"] = _parse_id(item["trainer_id"].strip())
+
+    i["owner"] = item["owner"].strip()
+
+    if "breeder" in item:
+        i["breeder"] = item["breeder"].strip()
+    else:
+        i["breeder"] = None
+
+    i["breeding_farm"] = item["breeding_farm"].strip()
+
+    rows = [("horse", (i["horse_id"], i["gender"], i["name"], i["birthday"], i["coat_color"], i["trainer_id"], i["owner"], i["breeder"], i["breeding_farm"]))]
+
+    return i, rows
+
+
+def normalize_trainer_item(item):
+    i = {}
+
+    i["trainer_id"] = item["trainer_id"]
+
+    i["name_kana"] = item["name_kana"].strip()
+
+    i["name"] = item["name"].strip()
+
+    i["birthday"] = _parse_birthday(item["birthday"])
+
+    i["belong_to"] = item["belong_to"].strip()
+
+    first_licensing_year_reg = TRAINER_FIRST_LICENSING_YEAR_RE.match(item["first_licensing_year"].strip())
+    if first_licensing_year_reg:
+        i["first_licensing_year"] = int(first_licensing_year_reg.group(1))
+    else:
+        raise DropItem("Unknown first_licensing_year pattern")
+
+    rows = [("trainer", (i["trainer_id"], i["name_kana"], i["name"], i["birthday"], i["belong_to"], i["first_licensing_year"]))]
+
+    return i, rows
+
+
+def normalize_jockey_item(item):
+    i = {}
+
+    i["jockey_id"] = item["jockey_id"]
+
+    name_kana_str = item["name_kana"].strip()
+    if len(name_kana_str) > 0:
+        i["name_kana"] = name_kana_str
+    else:
+        i["name_kana"] = None
+
+    i["name"] = item["name"].strip()
+
+    if "birthday" in item:
+        i["birthday"] = _parse_birthday(item["birthday"])
+    else:
+        i["birthday"] = None
+
+    i["belong_to"] = item["belong_to"].strip()
+
+    first_licensing_year_reg = JOCKEY_FIRST_LICENSING_YEAR_RE.match(item["first_licensing_year"].strip())
+    if first_licensing_year_reg:
+        first_licensing_year_int = int(first_licensing_year_reg.group(1))
+        if first_licensing_year_int > 0:
+            i["first_licensing_year"] = first_licensing_year_int
+        else:
+            i["first_licensing_year"] = None
+    else:
+        raise DropItem("Unknown first_licensing_year pattern")
+
+    rows = [("jockey", (i["jockey_id"], i["name_kana"], i["name"], i["birthday"], i["belong_to"], i["first_licensing_year"]))]
+
+    return i, rows
+
+
+def normalize_odds_item(item):
+    i = {"win": {}, "place": {}}
+
+    i["win"]["race_id"] = item["race_id"]
+    i["win"]["horse_number"] = int(item["horse_number"])
+    i["win"]["horse_id"] = _parse_id(item["horse_id"])
+
+    if "odds_win" in item:
+        i["win"]["odds"] = _parse_float(item["odds_win"].strip(), "****")
+    else:
+        i["win"]["odds"] = None
+
+    i["place"]["race_id"] = i["win"]["race_id"]
+    i["place"]["horse_number"] = i["win"]["horse_number"]
+    i["place"]["horse_id"] = i["win"]["horse_id"]
+
+    if "odds_place_min" in item:
+        i["place"]["odds_min"] = _parse_float(item["odds_place_min"].strip(), "****")
+    else:
+        i["place"]["odds_min"] = None
+
+    if "odds_place_max" in item:
+        i["place"]["odds_max"] = _parse_float(item["odds_place_max"].strip(), "****")
+    else:
+        i["place"]["odds_max"] = None
+
+    odds_id = "{}_{}".format(i["win"]["race_id"], i["win"]["horse_number"])
+
+    rows = [
+        ("odds_win", (odds_id, i["win"]["race_id"], i["win"]["horse_number"], i["win"]["horse_id"], i["win"]["odds"])),
+        ("odds_place", (odds_id, i["place"]["race_id"], i["place"]["horse_number"], i["place"]["horse_id"], i["place"]["odds_min"], i["place"]["odds_max"])),
+    ]
+
+    return i, rows
+
+
+NORMALIZERS = {
+    RaceInfoItem: normalize_race_info_item,
+    RacePayoffItem: normalize_race_payoff_item,
+    RaceResultItem: normalize_race_result_item,
+    RaceDenmaItem: normalize_race_denma_item,
+    HorseItem: normalize_horse_item,
+    TrainerItem: normalize_trainer_item,
+    JockeyItem: normalize_jockey_item,
+    OddsWinPlaceItem: normalize_odds_item,
+}
+
+
+def _parse_id(href):
+    return href.split("/")[-2]
+
+
+def _parse_float(value_str, empty_str):
+    if value_str != empty_str:
+        return float(value_str)
+    else:
+        return None
+
+
+def _parse_horse_weight_and_diff(horse_weight_and_diff_str):
+    horse_weight_and_diff_reg = HORSE_WEIGHT_AND_DIFF_RE.match(horse_weight_and_diff_str)
+    if not horse_weight_and_diff_reg:
+        raise DropItem("Unknown horse_weight_and_diff")
+
+    horse_weight = _parse_float(horse_weight_and_diff_reg.group(1).strip(), "-")
+    horse_weight_diff = _parse_float(horse_weight_and_diff_reg.group(2).strip(), "-")
+
+    return horse_weight, horse_weight_diff
+
+
+def _parse_birthday(birthday_str):
+    birthday_reg = BIRTHDAY_RE.match(birthday_str.strip())
+    if not birthday_reg:
+        raise DropItem("Unknown birthday pattern")
+
+    return datetime(int(birthday_reg.group(1)), int(birthday_reg.group(2)), int(birthday_reg.group(3)), 0, 0, 0)
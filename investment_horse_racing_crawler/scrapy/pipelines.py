@@ -1,40 +1,191 @@
 # -*- coding: utf-8 -*-
 
 
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import io
+import multiprocessing
+import queue
+import threading
+import time
 import psycopg2
-from psycopg2.extras import DictCursor
-import re
-from scrapy.exceptions import DropItem
+from psycopg2.extras import DictCursor, execute_values
+from scrapy.exceptions import NotConfigured
+from twisted.internet import defer, reactor, task
+from twisted.python.failure import Failure
 
 from investment_horse_racing_crawler.app_logging import get_logger
-from investment_horse_racing_crawler.scrapy.items import RaceInfoItem, RacePayoffItem, RaceResultItem, RaceDenmaItem, HorseItem, TrainerItem, JockeyItem, OddsWinPlaceItem
+from investment_horse_racing_crawler.scrapy.normalizers import NormalizedItem, normalize_item, normalize_values
+from investment_horse_racing_crawler.scrapy.scheduler import scheduler_checkpoint
 
 
 logger = get_logger(__name__)
 
 
+# Columns of each table. The first column is the primary key.
+TABLE_COLUMNS = {
+    "race_info": ("race_id", "race_round", "start_datetime", "place_name", "race_name", "course_type", "course_length", "weather", "course_condition", "added_money"),
+    "race_payoff": ("race_payoff_id", "race_id", "payoff_type", "horse_number_1", "horse_number_2", "horse_number_3", "odds", "favorite_order"),
+    "race_result": ("race_result_id", "race_id", "result", "bracket_number", "horse_number", "horse_id", "horse_weight", "horse_weight_diff", "arrival_time", "jockey_id", "jockey_weight", "favorite_order", "odds", "trainer_id"),
+    "race_denma": ("race_denma_id", "race_id", "bracket_number", "horse_number", "horse_id", "trainer_id", "horse_weight", "horse_weight_diff", "jockey_id", "jockey_weight", "prize_total_money"),
+    "horse": ("horse_id", "gender", "name", "birthday", "coat_color", "trainer_id", "owner", "breeder", "breeding_farm"),
+    "trainer": ("trainer_id", "name_kana", "name", "birthday", "belong_to", "first_licensing_year"),
+    "jockey": ("jockey_id", "name_kana", "name", "birthday", "belong_to", "first_licensing_year"),
+    "odds_win": ("odds_win_id", "race_id", "horse_number", "horse_id", "odds"),
+    "odds_place": ("odds_place_id", "race_id", "horse_number", "horse_id", "odds_min", "odds_max"),
+}
+
+
+def _build_upsert_sql(table, source):
+    columns = TABLE_COLUMNS[table]
+    values_columns = columns[1:]
+
+    # Rows whose values are unchanged are not rewritten, so re-crawls do not create dead tuples
+    return f"insert into {table} ({', '.join(columns)}) {source}" \
+        f" on conflict ({columns[0]}) do update set {', '.join(f'{c}=excluded.{c}' for c in values_columns)}" \
+        f" where ({', '.join(f'{table}.{c}' for c in values_columns)}) is distinct from ({', '.join(f'excluded.{c}' for c in values_columns)})"
+
+
+def _build_merge_sql(table):
+    columns = TABLE_COLUMNS[table]
+
+    # The latest staged row wins when a row is staged more than once
+    return _build_upsert_sql(table, f"select distinct on ({columns[0]}) {', '.join(columns)} from staging_{table} order by {columns[0]}, staging_seq desc")
+
+
+UPSERT_SQL = {table: _build_upsert_sql(table, "values %s") + f" returning {columns[0]}" for table, columns in TABLE_COLUMNS.items()}
+MERGE_SQL = {table: _build_merge_sql(table) for table in TABLE_COLUMNS}
+COPY_SQL = {table: f"copy staging_{table} ({', '.join(columns)}) from stdin with (format csv, null '\\N')" for table, columns in TABLE_COLUMNS.items()}
+
+WRITER_STOP = object()
+
+# Errors caused by the values of a row, as opposed to the connection or the server
+ROW_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError)
+
+
+class WriterFlush(object):
+    """ Marker that makes the writer thread commit the rows queued before it. """
+
+    def __init__(self):
+        self.deferred = defer.Deferred()
+
+
+class ProcessPoolNormalizePipeline(object):
+    def __init__(self, pool_size, stats=None):
+        logger.debug("#init: start: pool_size=%s" % pool_size)
+
+        self.pool_size = pool_size
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        logger.debug("#from_crawler")
+
+        pool_size = crawler.settings.getint("NORMALIZE_PROCESS_POOL_SIZE", 0)
+        if pool_size <= 0:
+            raise NotConfigured("NORMALIZE_PROCESS_POOL_SIZE is not set")
+
+        return cls(
+            pool_size=pool_size,
+            stats=crawler.stats
+        )
+
+    def open_spider(self, spider):
+        logger.debug("#open_spider: start: spider=%s" % spider)
+
+        # Worker processes are spawned, not forked, so they do not inherit the reactor's threads and sockets
+        self.executor = ProcessPoolExecutor(max_workers=self.pool_size, mp_context=multiprocessing.get_context("spawn"))
+        self.locks = {}
+
+    def close_spider(self, spider):
+        logger.debug("#close_spider: start")
+
+        self.executor.shutdown(wait=True)
+
+        logger.debug("#close_spider: executor shutdown")
+
+    def process_item(self, item, spider):
+        logger.debug("#process_item: start: item=%s", item)
+
+        normalized = self._submit(item)
+
+        # Items of the same race are handed to the next pipeline in the order they were scraped
+        key = item["race_id"] if "race_id" in item else type(item).__name__
+        lock = self.locks.setdefault(key, defer.DeferredLock())
+
+        d = lock.acquire()
+        d.addCallback(lambda _: normalized)
+        d.addBoth(self._release, key, lock)
+
+        return d
+
+    def _submit(self, item):
+        d = defer.Deferred()
+
+        future = self.executor.submit(normalize_values, type(item), dict(item))
+        future.add_done_callback(lambda f: reactor.callFromThread(self._resolve, d, f))
+
+        if self.stats is not None:
+            self.stats.inc_value("normalize_pool/submitted")
+
+        return d
+
+    def _resolve(self, d, future):
+        exception = future.exception()
+        if exception is not None:
+            d.errback(Failure(exception))
+        else:
+            d.callback(future.result())
+
+    def _release(self, result, key, lock):
+        # Releasing the lock runs the chains of the waiting items at once, which would hand them to the next pipeline
+        # before this item. So it is released on the next reactor turn, after this item has been handed over.
+        reactor.callLater(0, self._unlock, key, lock)
+
+        return result
+
+    def _unlock(self, key, lock):
+        lock.release()
+
+        if not lock.locked and not lock.waiting:
+            self.locks.pop(key, None)
+
+
 class PostgreSQLPipeline(object):
-    def __init__(self, db_host, db_port, db_database, db_username, db_password):
-        logger.debug("#init: start: db_host=%s, db_port=%s, db_database=%s, db_username=%s" % (db_host, db_port, db_database, db_username))
+    def __init__(self, db_host, db_port, db_database, db_username, db_password, batch_size=1, flush_interval=0, writer_queue_size=0, stats=None, crawler=None):
+        logger.debug("#init: start: db_host=%s, db_port=%s, db_database=%s, db_username=%s, batch_size=%s, flush_interval=%s, writer_queue_size=%s" % (db_host, db_port, db_database, db_username, batch_size, flush_interval, writer_queue_size))
 
         self.db_host = db_host
         self.db_port = db_port
         self.db_database = db_database
         self.db_username = db_username
         self.db_password = db_password
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.writer_queue_size = writer_queue_size
+        self.stats = stats
+        self.crawler = crawler
 
     @classmethod
     def from_crawler(cls, crawler):
         logger.debug("#from_crawler")
 
-        return cls(
+        o = cls(
             db_host=crawler.settings.get("DB_HOST"),
             db_port=crawler.settings.get("DB_PORT"),
             db_database=crawler.settings.get("DB_DATABASE"),
             db_username=crawler.settings.get("DB_USERNAME"),
-            db_password=crawler.settings.get("DB_PASSWORD")
+            db_password=crawler.settings.get("DB_PASSWORD"),
+            batch_size=crawler.settings.getint("DB_BATCH_SIZE", 1),
+            flush_interval=crawler.settings.getfloat("DB_FLUSH_INTERVAL", 0),
+            writer_queue_size=crawler.settings.getint("DB_WRITER_QUEUE_SIZE", 0),
+            stats=crawler.stats,
+            crawler=crawler
         )
+        crawler.signals.connect(o.scheduler_checkpoint, signal=scheduler_checkpoint)
+
+        return o
 
     def open_spider(self, spider):
         logger.debug("#open_spider: start: spider=%s" % spider)
@@ -53,506 +204,401 @@ class PostgreSQLPipeline(object):
 
         logger.debug("#open_spider: database connected")
 
+        self.bulk_ingest = getattr(spider, "bulk_ingest", False)
+        if self.bulk_ingest:
+            self._open_staging()
+
+        self.buffers = {table: {} for table in TABLE_COLUMNS}
+        self.buffered_count = 0
+        self.last_flush_time = time.monotonic()
+
+        self.spider = spider
+        self.flush_loop = None
+        self.writer_thread = None
+        self.write_error = None
+        self.writer_waiters = deque()
+        if self.writer_queue_size > 0:
+            # The connection is only used by the writer thread until close_spider joins it
+            self.writer_queue = queue.Queue(maxsize=self.writer_queue_size)
+            self.writer_thread = threading.Thread(target=self._run_writer, name="PostgreSQLWriter", daemon=True)
+            self.writer_thread.start()
+        elif self.flush_interval > 0:
+            self.flush_loop = task.LoopingCall(self._flush_on_interval)
+            self.flush_loop.start(self.flush_interval, now=False)
+
     def close_spider(self, spider):
         logger.debug("#close_spider: start")
 
-        self.db_cursor.close()
-        self.db_conn.close()
-
-        logger.debug("#close_spider: database disconnected")
+        if self.flush_loop is not None and self.flush_loop.running:
+            self.flush_loop.stop()
 
-    def process_item(self, item, spider):
-        logger.debug("#process_item: start: item=%s" % item)
-
-        if isinstance(item, RaceInfoItem):
-            new_item = self.process_race_info_item(item, spider)
-        elif isinstance(item, RacePayoffItem):
-            new_item = self.process_race_payoff_item(item, spider)
-        elif isinstance(item, RaceResultItem):
-            new_item = self.process_race_result_item(item, spider)
-        elif isinstance(item, RaceDenmaItem):
-            new_item = self.process_race_denma_item(item, spider)
-        elif isinstance(item, HorseItem):
-            new_item = self.process_horse_item(item, spider)
-        elif isinstance(item, TrainerItem):
-            new_item = self.process_trainer_item(item, spider)
-        elif isinstance(item, JockeyItem):
-            new_item = self.process_jockey_item(item, spider)
-        elif isinstance(item, OddsWinPlaceItem):
-            new_item = self.process_odds_item(item, spider)
-        else:
-            raise DropItem("Unknown item type")
+        if self.writer_thread is not None:
+            # A failed writer thread has stopped by itself, and no longer makes room in the queue
+            while self.writer_thread.is_alive():
+                try:
+                    self.writer_queue.put(WRITER_STOP, timeout=1.0)
+                    break
+                except queue.Full:
+                    pass
 
-        self.db_cursor.execute("select 1")
-        results = self.db_cursor.fetchall()
+            self.writer_thread.join()
 
-        logger.debug("#process_item: database results=%s" % results)
+            logger.debug("#close_spider: writer thread stopped")
 
-        return new_item
+            # Items left in the queue by a failed writer thread are written with the last flush, which retries its rows
+            flushes = []
+            while not self.writer_queue.empty():
+                normalized = self.writer_queue.get_nowait()
+                if isinstance(normalized, WriterFlush):
+                    flushes.append(normalized)
+                elif normalized is not WRITER_STOP:
+                    self._write_normalized(normalized)
 
-    def process_race_info_item(self, item, spider):
-        logger.debug("#process_race_info_item: start: item=%s" % item)
+        self.flush()
 
-        # Build item
-        i = {}
+        if self.bulk_ingest:
+            self.merge_staging()
 
-        i["race_id"] = item["race_id"][0]
+        if self.writer_thread is not None:
+            for marker in flushes:
+                marker.deferred.callback(None)
 
-        race_round_reg = re.match("^([0-9]+)R$", item["race_round"][0].strip())
-        if race_round_reg:
-            i["race_round"] = int(race_round_reg.group(1))
-        else:
-            raise DropItem("Unknown pattern race_round")
-
-        start_date_reg = re.match("^([0-9]{4})年([0-9]{1,2})月([0-9]{1,2})日", item["start_date"][0].strip())
-        start_time_reg = re.match("^([0-9]+):([0-9]+)発走$", item["start_time"][0].strip())
-        if start_date_reg and start_time_reg:
-            i["start_datetime"] = datetime(int(start_date_reg.group(1)), int(start_date_reg.group(2)), int(start_date_reg.group(3)), int(start_time_reg.group(1)), int(start_time_reg.group(2)), 0)
-        else:
-            raise DropItem("Unknown pattern start_date, start_time")
+        self.db_cursor.close()
+        self.db_conn.close()
 
-        i["place_name"] = item["place_name"][0].strip()
+        logger.debug("#close_spider: database disconnected")
 
-        i["race_name"] = item["race_name"][0].strip()
+    def process_item(self, item, spider):
+        logger.debug("#process_item: start: item=%s", item)
 
-        course_type_length_reg = re.match("^(.+?) ([0-9]+)m$", item["course_type_length"][0].strip())
-        if course_type_length_reg:
-            i["course_type"] = course_type_length_reg.group(1)
-            i["course_length"] = int(course_type_length_reg.group(2))
+        if isinstance(item, NormalizedItem):
+            normalized = item
         else:
-            raise DropItem("Unknown pattern course_type_length")
-
-        i["weather"] = item["weather"][0].strip()
-
-        i["course_condition"] = item["course_condition"][0].strip()
-
-        i["added_money"] = item["added_money"][0].strip()
+            normalized = NormalizedItem(*normalize_item(item))
 
-        # Insert db
-        self.db_cursor.execute("delete from race_info where race_id=%s", (i["race_id"],))
-        self.db_cursor.execute("insert into race_info (race_id, race_round, start_datetime, place_name, race_name, course_type, course_length, weather, course_condition, added_money) values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (i["race_id"], i["race_round"], i["start_datetime"], i["place_name"], i["race_name"], i["course_type"], i["course_length"], i["weather"], i["course_condition"], i["added_money"]))
-        self.db_conn.commit()
+        if self.writer_thread is not None:
+            return self._enqueue(normalized)
 
-        return i
-
-    def process_race_payoff_item(self, item, spider):
-        logger.debug("#process_race_payoff_item: start: item=%s" % item)
-
-        # Build item
-        i = {}
-
-        i["race_id"] = item["race_id"][0]
-
-        if item["payoff_type"][0] == "単勝":
-            i["payoff_type"] = "win"
-        elif item["payoff_type"][0] == "複勝":
-            i["payoff_type"] = "place"
-        elif item["payoff_type"][0] == "枠連":
-            i["payoff_type"] = "bracket_quinella"
-        elif item["payoff_type"][0] == "馬連":
-            i["payoff_type"] = "quinella"
-        elif item["payoff_type"][0] == "ワイド":
-            i["payoff_type"] = "quinella_place"
-        elif item["payoff_type"][0] == "馬単":
-            i["payoff_type"] = "exacta"
-        elif item["payoff_type"][0] == "3連複":
-            i["payoff_type"] = "trio"
-        elif item["payoff_type"][0] == "3連単":
-            i["payoff_type"] = "trifecta"
-        else:
-            raise DropItem("Unknown payoff_type")
-
-        if "horse_number" in item:
-            horse_number_parts = item["horse_number"][0].split("－")
-
-            if len(horse_number_parts) == 1:
-                i["horse_number_1"] = int(horse_number_parts[0])
-                i["horse_number_2"] = None
-                i["horse_number_3"] = None
-            elif len(horse_number_parts) == 2:
-                i["horse_number_1"] = int(horse_number_parts[0])
-                i["horse_number_2"] = int(horse_number_parts[1])
-                i["horse_number_3"] = None
-            elif len(horse_number_parts) == 3:
-                i["horse_number_1"] = int(horse_number_parts[0])
-                i["horse_number_2"] = int(horse_number_parts[1])
-                i["horse_number_3"] = int(horse_number_parts[2])
-            else:
-                raise DropItem("Unknown horse_number")
-        else:
-            raise DropItem("Empty race payoff record")
+        # Items are not buffered on top of the rows of a failed flush, while the crawl stops
+        if self.write_error is not None:
+            return defer.fail(self.write_error)
 
-        i["odds"] = int(item["odds"][0].replace("円", "").replace(",", ""))/100.0
+        try:
+            self._write_normalized(normalized)
+        except Exception:
+            self._write_failed(Failure(), "postgresql_flush_error")
+            raise
 
-        favorite_order_str = item["favorite_order"][0].replace("番人気", "").strip()
-        if favorite_order_str != "-":
-            i["favorite_order"] = int(favorite_order_str)
-        else:
-            i["favorite_order"] = None
+        return normalized.item
 
-        # Insert db
-        if i["horse_number_3"] is not None:
-            race_payoff_id = "{}_{}_{}_{}_{}".format(i["race_id"], i["payoff_type"], i["horse_number_1"], i["horse_number_2"], i["horse_number_3"])
-        elif i["horse_number_2"] is not None:
-            race_payoff_id = "{}_{}_{}_{}".format(i["race_id"], i["payoff_type"], i["horse_number_1"], i["horse_number_2"])
-        else:
-            race_payoff_id = "{}_{}_{}".format(i["race_id"], i["payoff_type"], i["horse_number_1"])
+    def scheduler_checkpoint(self, spider):
+        # The requests of buffered items are done, so they are not in the checkpoint, and their rows are committed before it is published
+        if self.write_error is not None:
+            return defer.fail(self.write_error)
 
-        self.db_cursor.execute("delete from race_payoff where race_payoff_id=%s", (race_payoff_id,))
-        self.db_cursor.execute("insert into race_payoff (race_payoff_id, race_id, payoff_type, horse_number_1, horse_number_2, horse_number_3, odds, favorite_order) values (%s, %s, %s, %s, %s, %s, %s, %s)", (race_payoff_id, i["race_id"], i["payoff_type"], i["horse_number_1"], i["horse_number_2"], i["horse_number_3"], i["odds"], i["favorite_order"]))
-        self.db_conn.commit()
+        if self.writer_thread is None:
+            self._commit_buffered()
+            return
 
-        return i
+        if not self.writer_thread.is_alive():
+            return
 
-    def process_race_result_item(self, item, spider):
-        logger.debug("#process_race_result_item: start: item=%s" % item)
+        marker = WriterFlush()
+        if not self.writer_waiters:
+            try:
+                self.writer_queue.put_nowait(marker)
+                return marker.deferred
+            except queue.Full:
+                pass
 
-        # Build item
-        i = {}
+        self.writer_waiters.append((marker.deferred, marker))
 
-        i["race_id"] = item["race_id"][0]
+        return marker.deferred
 
-        result_str = item["result"][0].strip()
-        if len(result_str) > 0:
-            i["result"] = int(result_str)
-        else:
-            i["result"] = None
+    def flush(self):
+        if self.buffered_count == 0:
+            return
 
-        i["bracket_number"] = int(item["bracket_number"][0].strip())
+        logger.debug("#flush: start: buffered_count=%s" % self.buffered_count)
 
-        i["horse_number"] = int(item["horse_number"][0].strip())
+        start_time = time.monotonic()
+        rows_count = self.buffered_count
+        table_rows = {table: list(rows.values()) for table, rows in self.buffers.items() if len(rows) > 0}
 
-        i["horse_id"] = item["horse_id"][0].split("/")[-2]
+        try:
+            try:
+                results = {table: (self._write_rows(table, rows), 0) for table, rows in table_rows.items()}
+            except ROW_ERRORS:
+                # A bad row fails the whole batch, so the batch is split down to the bad rows, which are logged and dropped
+                logger.warning("#flush: batch failed, split it", exc_info=True)
+                self._inc_stats("postgresql/flush_split")
+                self.db_conn.rollback()
 
-        i["horse_name"] = item["horse_name"][0].strip()
+                results = {table: self._write_split(table, rows) for table, rows in table_rows.items()}
 
-        horse_gender_age_reg = re.match("^([^0-9]+)([0-9]+)$", item["horse_gender_age"][0].strip().split("/")[0])
-        if horse_gender_age_reg:
-            i["horse_gender"] = horse_gender_age_reg.group(1)
-            i["horse_age"] = int(horse_gender_age_reg.group(2))
-        else:
-            raise DropItem("Unknown horse_gender_age")
-
-        horse_weight_and_diff_reg = re.match("^([\\- 0-9]+)\\(([\\+\\- 0-9]+)\\)$", item["horse_weight_and_diff"][0].strip().split("/")[1])
-        if horse_weight_and_diff_reg:
-            horse_weight_str = horse_weight_and_diff_reg.group(1).strip()
-            if horse_weight_str != "-":
-                i["horse_weight"] = float(horse_weight_str)
-            else:
-                i["horse_weight"] = None
-
-            horse_weight_diff_str = horse_weight_and_diff_reg.group(2).strip()
-            if horse_weight_diff_str != "-":
-                i["horse_weight_diff"] = float(horse_weight_diff_str)
-            else:
-                i["horse_weight_diff"] = None
-        else:
-            raise DropItem("Unknown horse_weight_and_diff")
-
-        arrival_time_str = item["arrival_time"][0].strip()
-        if len(arrival_time_str) > 0:
-            arrival_time_parts = arrival_time_str.split(".")
-            if len(arrival_time_parts) == 2:
-                i["arrival_time"] = int(arrival_time_parts[0]) + int(arrival_time_parts[1]) * 0.1
-            else:
-                i["arrival_time"] = int(arrival_time_parts[0]) * 60.0 + int(arrival_time_parts[1]) + int(arrival_time_parts[2]) * 0.1
-        else:
-            i["arrival_time"] = None
+            self.db_conn.commit()
+        except Exception:
+            logger.exception("#flush: fail")
+            self.db_conn.rollback()
+            raise
+        finally:
+            self.last_flush_time = time.monotonic()
 
-        i["jockey_id"] = item["jockey_id"][0].split("/")[-2]
+        # Rows are dropped only once they are committed, so the rows of a failed flush are written by the next one
+        self.buffers = {table: {} for table in TABLE_COLUMNS}
+        self.buffered_count = 0
 
-        i["jockey_name"] = item["jockey_name"][0].strip()
+        for table, (written_count, bad_count) in results.items():
+            self._inc_stats(f"postgresql/flush_rows/{table}", len(table_rows[table]))
 
-        jockey_weight_reg = re.match("^[^0-9]?([\\.0-9]+)$", item["jockey_weight"][0].strip())
-        if jockey_weight_reg:
-            i["jockey_weight"] = float(jockey_weight_reg.group(1))
-        else:
-            raise DropItem("Unknown jockey_weight pattern")
+            if not self.bulk_ingest:
+                self._inc_stats(f"postgresql/unchanged_rows/{table}", len(table_rows[table]) - bad_count - written_count)
 
-        favorite_order_str = item["favorite_order"][0].strip()
-        if len(favorite_order_str) > 0:
-            i["favorite_order"] = int(favorite_order_str)
-        else:
-            i["favorite_order"] = None
-
-        if "odds" in item:
-            odds_reg = re.match("^\\(([\\.\\- 0-9]+)\\)$", item["odds"][0].strip())
-            if odds_reg:
-                odds_str = odds_reg.group(1).strip()
-                if odds_str != "-":
-                    i["odds"] = float(odds_str)
-                else:
-                    i["odds"] = None
-            else:
-                raise DropItem("Unknown odds pattern")
-        else:
-            i["odds"] = None
+        latency = time.monotonic() - start_time
+        logger.debug("#flush: end: rows=%s, latency=%s" % (rows_count, latency))
 
-        i["trainer_id"] = item["trainer_id"][0].split("/")[-2]
+        self._record_flush_stats(rows_count, latency)
 
-        i["trainer_name"] = item["trainer_name"][0].strip()
+    def merge_staging(self):
+        logger.debug("#merge_staging: start")
 
-        # Insert db
-        race_result_id = "{}_{}".format(i["race_id"], i["horse_number"])
+        try:
+            for table in self.staged_tables:
+                start_time = time.monotonic()
 
-        self.db_cursor.execute("delete from race_result where race_result_id=%s", (race_result_id,))
-        self.db_cursor.execute("insert into race_result (race_result_id, race_id, result, bracket_number, horse_number, horse_id, horse_weight, horse_weight_diff, arrival_time, jockey_id, jockey_weight, favorite_order, odds, trainer_id) values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (race_result_id, i["race_id"], i["result"], i["bracket_number"], i["horse_number"], i["horse_id"], i["horse_weight"], i["horse_weight_diff"], i["arrival_time"], i["jockey_id"], i["jockey_weight"], i["favorite_order"], i["odds"], i["trainer_id"]))
-        self.db_conn.commit()
+                self.db_cursor.execute(MERGE_SQL[table])
+                written_count = self.db_cursor.rowcount
+                self.db_cursor.execute(f"truncate staging_{table}")
 
-        return i
+                self.bulk_seconds[table] += time.monotonic() - start_time
+                self._inc_stats(f"postgresql/bulk/{table}/merged_rows", written_count)
 
-    def process_race_denma_item(self, item, spider):
-        logger.debug("#process_race_denma_item: start: item=%s" % item)
+            self.db_conn.commit()
+        except Exception:
+            logger.exception("#merge_staging: fail")
+            self.db_conn.rollback()
+            raise
 
-        # Build item
-        i = {}
+        for table in self.staged_tables:
+            if self.stats is not None and self.bulk_seconds[table] > 0:
+                self.stats.set_value(f"postgresql/bulk/{table}/rows_per_second", self.bulk_rows[table] / self.bulk_seconds[table])
 
-        i["race_id"] = item["race_id"][0]
+        self.staged_tables = set()
 
-        bracket_number_str = item["bracket_number"][0].strip()
-        if bracket_number_str != "-":
-            i["bracket_number"] = int(bracket_number_str)
-        else:
-            i["bracket_number"] = None
+        logger.debug("#merge_staging: end")
 
-        horse_number_str = item["horse_number"][0].strip()
-        if horse_number_str != "-":
-            i["horse_number"] = int(horse_number_str)
-        else:
-            i["horse_number"] = None
+    def _commit_buffered(self):
+        self.flush()
 
-        i["horse_id"] = item["horse_id"][0].split("/")[-2]
+        # Staging tables are temporary, so staged rows are only kept once they are merged
+        if self.bulk_ingest and self.staged_tables:
+            self.merge_staging()
 
-        if "trainer_id" in item:
-            i["trainer_id"] = item["trainer_id"][0].split("/")[-2]
-        else:
-            i["trainer_id"] = None
-
-        horse_weight_and_diff_reg = re.match("^([\\- 0-9]+)\\(([\\+\\- 0-9]+)\\)$", item["horse_weight_and_diff"][0].strip())
-        if horse_weight_and_diff_reg:
-            horse_weight_str = horse_weight_and_diff_reg.group(1).strip()
-            if horse_weight_str != "-":
-                i["horse_weight"] = float(horse_weight_str)
-            else:
-                i["horse_weight"] = None
-
-            horse_weight_diff_str = horse_weight_and_diff_reg.group(2).strip()
-            if horse_weight_diff_str != "-":
-                i["horse_weight_diff"] = float(horse_weight_diff_str)
-            else:
-                i["horse_weight_diff"] = None
-        else:
-            raise DropItem("Unknown horse_weight_and_diff")
+    def _open_staging(self):
+        logger.debug("#_open_staging: start")
 
-        i["jockey_id"] = item["jockey_id"][0].split("/")[-2]
+        for table in TABLE_COLUMNS:
+            self.db_cursor.execute(f"create temporary table staging_{table} (like {table} excluding constraints, staging_seq bigserial)")
 
-        jockey_weight_reg = re.match("^([\\.0-9]+)[^0-9]*$", item["jockey_weight"][0].strip())
-        if jockey_weight_reg:
-            i["jockey_weight"] = float(jockey_weight_reg.group(1))
-        else:
-            raise DropItem("Unknown jockey_weight pattern")
-
-        i["prize_total_money"] = float(item["prize_total_money"][0].strip().replace("億", "").replace("万", ""))
-
-        # Insert db
-        race_denma_id = "{}_{}".format(i["race_id"], i["horse_id"])
-
-        self.db_cursor.execute("delete from race_denma where race_denma_id=%s", (race_denma_id,))
-        self.db_cursor.execute("""insert into race_denma (
-            race_denma_id,
-            race_id,
-            bracket_number,
-            horse_number,
-            horse_id,
-            trainer_id,
-            horse_weight,
-            horse_weight_diff,
-            jockey_id,
-            jockey_weight,
-            prize_total_money
-        ) values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""", (
-            race_denma_id,
-            i["race_id"],
-            i["bracket_number"],
-            i["horse_number"],
-            i["horse_id"],
-            i["trainer_id"],
-            i["horse_weight"],
-            i["horse_weight_diff"],
-            i["jockey_id"],
-            i["jockey_weight"],
-            i["prize_total_money"]
-        ))
         self.db_conn.commit()
 
-        return i
-
-    def process_horse_item(self, item, spider):
-        logger.debug("#process_horse_item: start: item=%s" % item)
-
-        # Build item
-        i = {}
-
-        i["horse_id"] = item["horse_id"][0]
-
-        i["gender"] = item["gender"][0].split("|")[-2].strip()
-
-        i["name"] = item["name"][0].strip()
-
-        birthday_reg = re.match("^([0-9]+)年([0-9]+)月([0-9]+)日$", item["birthday"][0].strip())
-        if birthday_reg:
-            i["birthday"] = datetime(int(birthday_reg.group(1)), int(birthday_reg.group(2)), int(birthday_reg.group(3)), 0, 0, 0)
-        else:
-            raise DropItem("Unknown birthday pattern")
-
-        i["coat_color"] = item["coat_color"][0].strip()
+        self.bulk_rows = {table: 0 for table in TABLE_COLUMNS}
+        self.bulk_seconds = {table: 0.0 for table in TABLE_COLUMNS}
+        self.staged_tables = set()
+        self.staging_month = None
 
-        i["trainer_id"] = item["trainer_id"][0].strip().split("/")[-2]
+    def _write_rows(self, table, rows):
+        if self.bulk_ingest:
+            self._copy_to_staging(table, rows)
+            return len(rows)
 
-        i["owner"] = item["owner"][0].strip()
+        written_rows = execute_values(self.db_cursor, UPSERT_SQL[table], rows, page_size=len(rows), fetch=True)
 
-        if "breeder" in item:
-            i["breeder"] = item["breeder"][0].strip()
-        else:
-            i["breeder"] = None
+        return len(written_rows)
 
-        i["breeding_farm"] = item["breeding_farm"][0].strip()
+    def _write_split(self, table, rows):
+        # Each part is written under a savepoint, so a failed part is undone without the parts written before it
+        self.db_cursor.execute("savepoint flush_split")
+        try:
+            written_count = self._write_rows(table, rows)
+        except ROW_ERRORS as err:
+            self.db_cursor.execute("rollback to savepoint flush_split")
+            self.db_cursor.execute("release savepoint flush_split")
 
-        # Insert db
-        self.db_cursor.execute("delete from horse where horse_id=%s", (i["horse_id"],))
-        self.db_cursor.execute("insert into horse (horse_id, gender, name, birthday, coat_color, trainer_id, owner, breeder, breeding_farm) values(%s, %s, %s, %s, %s, %s, %s, %s, %s)", (i["horse_id"], i["gender"], i["name"], i["birthday"], i["coat_color"], i["trainer_id"], i["owner"], i["breeder"], i["breeding_farm"]))
-        self.db_conn.commit()
+            if len(rows) == 1:
+                logger.error(f"#_write_split: bad row dropped: table={table}, row={rows[0]}, error={err}")
+                self._inc_stats(f"postgresql/bad_rows/{table}")
+                return 0, 1
 
-        return i
+            half = len(rows) // 2
+            results = [self._write_split(table, rows[:half]), self._write_split(table, rows[half:])]
 
-    def process_trainer_item(self, item, spider):
-        logger.debug("#process_trainer_item: start: item=%s" % item)
+            return sum(r[0] for r in results), sum(r[1] for r in results)
 
-        # Build item
-        i = {}
+        self.db_cursor.execute("release savepoint flush_split")
 
-        i["trainer_id"] = item["trainer_id"][0]
+        return written_count, 0
 
-        i["name_kana"] = item["name_kana"][0].strip()
+    def _copy_to_staging(self, table, rows):
+        start_time = time.monotonic()
 
-        i["name"] = item["name"][0].strip()
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        row_count = 0
+        for row in rows:
+            writer.writerow(["\\N" if v is None else v for v in row])
+            row_count += 1
+        buf.seek(0)
 
-        birthday_reg = re.match("^([0-9]+)年([0-9]+)月([0-9]+)日$", item["birthday"][0].strip())
-        if birthday_reg:
-            i["birthday"] = datetime(int(birthday_reg.group(1)), int(birthday_reg.group(2)), int(birthday_reg.group(3)), 0, 0, 0)
-        else:
-            raise DropItem("Unknown birthday pattern")
+        self.db_cursor.copy_expert(COPY_SQL[table], buf)
 
-        i["belong_to"] = item["belong_to"][0].strip()
+        self.staged_tables.add(table)
+        self.bulk_rows[table] += row_count
+        self.bulk_seconds[table] += time.monotonic() - start_time
 
-        first_licensing_year_reg = re.match("^([0-9]+)年$", item["first_licensing_year"][0].strip())
-        if first_licensing_year_reg:
-            i["first_licensing_year"] = int(first_licensing_year_reg.group(1))
-        else:
-            raise DropItem("Unknown first_licensing_year pattern")
+    def _on_race_month(self, start_datetime):
+        if not self.bulk_ingest:
+            return
 
-        # Insert db
-        self.db_cursor.execute("delete from trainer where trainer_id=%s", (i["trainer_id"],))
-        self.db_cursor.execute("insert into trainer (trainer_id, name_kana, name, birthday, belong_to, first_licensing_year) values (%s, %s, %s, %s, %s, %s)", (i["trainer_id"], i["name_kana"], i["name"], i["birthday"], i["belong_to"], i["first_licensing_year"]))
-        self.db_conn.commit()
-
-        return i
+        # Staged rows are merged once the crawl moves on to another schedule month
+        race_month = (start_datetime.year, start_datetime.month)
+        if self.staging_month is not None and self.staging_month != race_month:
+            self.flush()
+            self.merge_staging()
 
-    def process_jockey_item(self, item, spider):
-        logger.debug("#process_jockey_item: start: item=%s" % item)
+        self.staging_month = race_month
 
-        # Build item
-        i = {}
+    def _write_normalized(self, normalized):
+        for table, row in normalized.rows:
+            if table == "race_info":
+                self._on_race_month(normalized.item["start_datetime"])
 
-        i["jockey_id"] = item["jockey_id"][0]
+            self._write(table, row)
 
-        name_kana_str = item["name_kana"][0].strip()
-        if len(name_kana_str) > 0:
-            i["name_kana"] = name_kana_str
+        if self.buffered_count >= self.batch_size:
+            self.flush()
         else:
-            i["name_kana"] = None
+            self._flush_if_expired()
 
-        i["name"] = item["name"][0].strip()
+    def _enqueue(self, normalized):
+        if self.write_error is not None:
+            return defer.fail(self.write_error)
 
-        if "birthday" in item:
-            birthday_reg = re.match("^([0-9]+)年([0-9]+)月([0-9]+)日$", item["birthday"][0].strip())
-            if birthday_reg:
-                i["birthday"] = datetime(int(birthday_reg.group(1)), int(birthday_reg.group(2)), int(birthday_reg.group(3)), 0, 0, 0)
-            else:
-                raise DropItem("Unknown birthday pattern")
-        else:
-            i["birthday"] = None
+        if self.stats is not None:
+            self.stats.max_value("postgresql/writer/queue_size_max", self.writer_queue.qsize())
 
-        i["belong_to"] = item["belong_to"][0].strip()
+        if not self.writer_waiters:
+            try:
+                self.writer_queue.put_nowait(normalized)
+                return normalized.item
+            except queue.Full:
+                pass
 
-        first_licensing_year_reg = re.match("^([0-9]+)年.*$", item["first_licensing_year"][0].strip())
-        if first_licensing_year_reg:
-            first_licensing_year_int = int(first_licensing_year_reg.group(1))
-            if first_licensing_year_int > 0:
-                i["first_licensing_year"] = first_licensing_year_int
-            else:
-                i["first_licensing_year"] = None
-        else:
-            raise DropItem("Unknown first_licensing_year pattern")
+        # The queue is full, so the item is held back until the writer thread makes room.
+        # Pending items keep the scraper busy, which stops the engine from scheduling more requests.
+        self._inc_stats("postgresql/writer/backpressure")
 
-        # Insert db
-        self.db_cursor.execute("delete from jockey where jockey_id=%s", (i["jockey_id"],))
-        self.db_cursor.execute("insert into jockey (jockey_id, name_kana, name, birthday, belong_to, first_licensing_year) values (%s, %s, %s, %s, %s, %s)", (i["jockey_id"], i["name_kana"], i["name"], i["birthday"], i["belong_to"], i["first_licensing_year"]))
-        self.db_conn.commit()
+        d = defer.Deferred()
+        self.writer_waiters.append((d, normalized))
 
-        return i
+        return d
 
-    def process_odds_item(self, item, spider):
-        logger.debug("#process_odds_item: start: item=%s" % item)
+    def _drain_waiters(self):
+        while self.writer_waiters:
+            d, normalized = self.writer_waiters[0]
 
-        # Build item
-        i = {"win": {}, "place": {}}
+            try:
+                self.writer_queue.put_nowait(normalized)
+            except queue.Full:
+                return
 
-        i["win"]["race_id"] = item["race_id"][0]
-        i["win"]["horse_number"] = int(item["horse_number"][0])
-        i["win"]["horse_id"] = item["horse_id"][0].split("/")[-2]
+            self.writer_waiters.popleft()
+            if not isinstance(normalized, WriterFlush):
+                d.callback(normalized.item)
 
-        if "odds_win" in item:
-            odds_win_str = item["odds_win"][0].strip()
-            if odds_win_str != "****":
-                i["win"]["odds"] = float(odds_win_str)
-            else:
-                i["win"]["odds"] = None
-        else:
-            i["win"]["odds"] = None
-
-        i["place"]["race_id"] = i["win"]["race_id"]
-        i["place"]["horse_number"] = i["win"]["horse_number"]
-        i["place"]["horse_id"] = i["win"]["horse_id"]
-
-        if "odds_place_min" in item:
-            odds_place_min_str = item["odds_place_min"][0].strip()
-            if odds_place_min_str != "****":
-                i["place"]["odds_min"] = float(odds_place_min_str)
-            else:
-                i["place"]["odds_min"] = None
-        else:
-            i["place"]["odds_min"] = None
-
-        if "odds_place_max" in item:
-            odds_place_max_str = item["odds_place_max"][0].strip()
-            if odds_place_max_str != "****":
-                i["place"]["odds_max"] = float(odds_place_max_str)
-            else:
-                i["place"]["odds_max"] = None
-        else:
-            i["place"]["odds_max"] = None
+    def _run_writer(self):
+        logger.debug("#_run_writer: start")
 
-        # Insert db
-        odds_win_id = "{}_{}".format(i["win"]["race_id"], i["win"]["horse_number"])
-        odds_place_id = "{}_{}".format(i["place"]["race_id"], i["place"]["horse_number"])
+        # The timeout also wakes the thread up to hand over waiters enqueued while it was idle
+        timeout = self.flush_interval if self.flush_interval > 0 else 1.0
 
-        self.db_cursor.execute("delete from odds_win where odds_win_id=%s", (odds_win_id,))
-        self.db_cursor.execute("insert into odds_win (odds_win_id, race_id, horse_number, horse_id, odds) values (%s, %s, %s, %s, %s)", (odds_win_id, i["win"]["race_id"], i["win"]["horse_number"], i["win"]["horse_id"], i["win"]["odds"]))
+        while True:
+            try:
+                normalized = self.writer_queue.get(timeout=timeout)
+            except queue.Empty:
+                normalized = None
 
-        self.db_cursor.execute("delete from odds_place where odds_place_id=%s", (odds_place_id,))
-        self.db_cursor.execute("insert into odds_place (odds_place_id, race_id, horse_number, horse_id, odds_min, odds_max) values (%s, %s, %s, %s, %s, %s)", (odds_place_id, i["place"]["race_id"], i["place"]["horse_number"], i["place"]["horse_id"], i["place"]["odds_min"], i["place"]["odds_max"]))
+            if normalized is WRITER_STOP:
+                break
 
-        self.db_conn.commit()
+            if self.writer_waiters:
+                reactor.callFromThread(self._drain_waiters)
 
-        return i
+            try:
+                if isinstance(normalized, WriterFlush):
+                    self._commit_buffered()
+                    reactor.callFromThread(normalized.deferred.callback, None)
+                elif normalized is not None:
+                    self._write_normalized(normalized)
+                else:
+                    self._flush_if_expired()
+            except Exception:
+                logger.exception("#_run_writer: fail")
+                self._inc_stats("postgresql/writer/errors")
+
+                failure = Failure()
+                if isinstance(normalized, WriterFlush):
+                    reactor.callFromThread(normalized.deferred.errback, failure)
+
+                # The rows stay buffered for close_spider, and the crawl stops instead of scraping items it cannot write
+                reactor.callFromThread(self._write_failed, failure, "postgresql_writer_error")
+                break
+
+        logger.debug("#_run_writer: end")
+
+    def _write_failed(self, failure, reason):
+        # The connection is given up instead of flushing again for every item, which would only grow the buffer and repeat the error
+        self.write_error = failure
+
+        while self.writer_waiters:
+            d, _ = self.writer_waiters.popleft()
+            d.errback(failure)
+
+        if self.crawler is not None and self.crawler.engine is not None and self.spider is not None:
+            self.crawler.engine.close_spider(self.spider, reason)
+
+    def _write(self, table, row):
+        # Rows are keyed by primary key, so the last write of a row wins within a batch
+        self.buffers[table][row[0]] = row
+        self.buffered_count = sum(len(rows) for rows in self.buffers.values())
+
+    def _flush_on_interval(self):
+        if self.write_error is not None:
+            return
+
+        try:
+            self._flush_if_expired()
+        except Exception:
+            self._write_failed(Failure(), "postgresql_flush_error")
+
+    def _flush_if_expired(self):
+        if self.flush_interval > 0 and time.monotonic() - self.last_flush_time >= self.flush_interval:
+            self.flush()
+
+    def _inc_stats(self, key, count=1):
+        if self.stats is not None:
+            self.stats.inc_value(key, count)
+
+    def _record_flush_stats(self, rows_count, latency):
+        if self.stats is None:
+            return
+
+        self.stats.inc_value("postgresql/flush_count")
+        self.stats.inc_value("postgresql/flush_rows", rows_count)
+        self.stats.inc_value("postgresql/flush_latency_total", latency)
+        self.stats.max_value("postgresql/flush_latency_max", latency)
+        self.stats.max_value("postgresql/rows_per_flush_max", rows_count)
+
+        flush_count = self.stats.get_value("postgresql/flush_count")
+        self.stats.set_value("postgresql/flush_latency_avg", self.stats.get_value("postgresql/flush_latency_total") / flush_count)
+        self.stats.set_value("postgresql/rows_per_flush_avg", self.stats.get_value("postgresql/flush_rows") / flush_count)
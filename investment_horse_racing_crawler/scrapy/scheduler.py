@@ -0,0 +1,353 @@
+import json
+import math
+import os
+import pickle
+import shutil
+import struct
+import weakref
+
+from scrapy.core.scheduler import Scheduler
+from scrapy.dupefilters import BaseDupeFilter
+from scrapy.utils.job import job_dir
+from scrapy.utils.misc import create_instance, load_object
+from scrapy.utils.reqser import request_from_dict, request_to_dict
+from scrapy.utils.request import request_fingerprint
+from twisted.internet import task
+from twisted.python.failure import Failure
+
+from investment_horse_racing_crawler.app_logging import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# File layout: header (bit count, hash count, item count) | bits
+BLOOM_HEADER = struct.Struct(">QIQ")
+
+# JOBDIR/checkpoint.json names the last complete checkpoint directory
+CHECKPOINT_FILE = "checkpoint.json"
+CHECKPOINT_DIR_PREFIX = "checkpoint-"
+
+# Sent before a checkpoint is published. Handlers write out what they buffered for the requests done so far, and may return a Deferred.
+scheduler_checkpoint = object()
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate):
+        self.bit_count = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, int(round(self.bit_count / capacity * math.log(2))))
+        self.item_count = 0
+        self.bits = bytearray((self.bit_count + 7) // 8)
+
+    def add(self, fingerprint):
+        """ Add a hex request fingerprint, returning True if it was (probably) added before. """
+
+        # The fingerprint is already a uniform hash, so the bit positions are derived from it by double hashing
+        h1 = int(fingerprint[0:16], 16)
+        h2 = int(fingerprint[16:32], 16) | 1
+
+        seen = True
+        for i in range(self.hash_count):
+            position = (h1 + i * h2) % self.bit_count
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                seen = False
+                self.bits[position >> 3] |= mask
+
+        if not seen:
+            self.item_count += 1
+
+        return seen
+
+    def save(self, path):
+        # Written to a temporary file and renamed, so a crash never leaves a torn filter
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(BLOOM_HEADER.pack(self.bit_count, self.hash_count, self.item_count))
+            f.write(self.bits)
+
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        with open(path, "rb") as f:
+            bit_count, hash_count, item_count = BLOOM_HEADER.unpack(f.read(BLOOM_HEADER.size))
+            if (bit_count, hash_count) != (self.bit_count, self.hash_count):
+                raise ValueError(f"Bloom filter size changed: {path}")
+
+            bits = f.read()
+            if len(bits) != len(self.bits):
+                raise ValueError(f"Bloom filter truncated: {path}, size={len(bits)}, expected={len(self.bits)}")
+
+            self.item_count = item_count
+            self.bits = bytearray(bits)
+
+
+class BloomDupeFilter(BaseDupeFilter):
+    """ Request fingerprint filter with bounded memory, persisted in JOBDIR. """
+
+    def __init__(self, path=None, capacity=10000000, error_rate=0.0001, debug=False):
+        logger.debug(f"#init: path={path}, capacity={capacity}, error_rate={error_rate}")
+
+        self.path = path
+        self.debug = debug
+        self.bloom = BloomFilter(capacity, error_rate)
+
+    @classmethod
+    def from_settings(cls, settings):
+        jobdir = job_dir(settings)
+
+        return cls(
+            path=os.path.join(jobdir, "requests.bloom") if jobdir else None,
+            capacity=settings.getint("DUPEFILTER_BLOOM_CAPACITY", 10000000),
+            error_rate=settings.getfloat("DUPEFILTER_BLOOM_ERROR_RATE", 0.0001),
+            debug=settings.getbool("DUPEFILTER_DEBUG"),
+        )
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls.from_settings(crawler.settings)
+
+    def open(self):
+        if self.path is not None and os.path.exists(self.path):
+            self.bloom.load(self.path)
+
+            logger.info(f"#open: resumed: item_count={self.bloom.item_count}")
+
+    def close(self, reason):
+        self.checkpoint()
+
+    def checkpoint(self):
+        if self.path is not None:
+            self.bloom.save(self.path)
+
+    def request_seen(self, request):
+        return self.bloom.add(self.request_fingerprint(request))
+
+    def request_fingerprint(self, request):
+        return request_fingerprint(request)
+
+    def log(self, request, spider):
+        if self.debug:
+            logger.debug(f"#log: filtered duplicate request: {request}")
+
+        spider.crawler.stats.inc_value("dupefilter/filtered", spider=spider)
+
+
+class CheckpointScheduler(Scheduler):
+    """ Scheduler that saves its disk queues and dupefilter together every SCHEDULER_CHECKPOINT_INTERVAL seconds.
+
+    A checkpoint is a snapshot directory in JOBDIR, published by replacing checkpoint.json.
+    A resumed crawl rebuilds its queue from the last snapshot, not from the files the killed crawl left behind.
+    The snapshot also holds the requests in flight, which are already marked in the dupefilter, and they are queued again on resume.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+
+        jobdir = job_dir(settings)
+        if jobdir is None:
+            return super(CheckpointScheduler, cls).from_crawler(crawler)
+
+        # A job can run for days over millions of requests, so its dupefilter is bounded in memory and saved with the checkpoints
+        dupefilter_cls = load_object(settings.get("JOB_DUPEFILTER_CLASS") or settings["DUPEFILTER_CLASS"])
+        dupefilter = create_instance(dupefilter_cls, settings, crawler)
+
+        return cls(
+            dupefilter,
+            jobdir=jobdir,
+            logunser=settings.getbool("SCHEDULER_DEBUG"),
+            stats=crawler.stats,
+            pqclass=load_object(settings["SCHEDULER_PRIORITY_QUEUE"]),
+            dqclass=load_object(settings["SCHEDULER_DISK_QUEUE"]),
+            mqclass=load_object(settings["SCHEDULER_MEMORY_QUEUE"]),
+            crawler=crawler,
+        )
+
+    def open(self, spider):
+        self.checkpoint_loop = None
+        self.popped = weakref.WeakSet()
+
+        inflight = []
+        if self.dqdir is not None:
+            self.jobdir = os.path.dirname(self.dqdir)
+            inflight = self._restore_checkpoint()
+
+        result = super(CheckpointScheduler, self).open(spider)
+
+        # Their fingerprints are in the restored dupefilter, so they are queued without it
+        for d in inflight:
+            self._dqpush(request_from_dict(d, spider))
+
+        interval = self.crawler.settings.getfloat("SCHEDULER_CHECKPOINT_INTERVAL", 0)
+        if self.dqs is not None and interval > 0:
+            self.checkpoint_loop = task.LoopingCall(self.checkpoint)
+            self.checkpoint_loop.start(interval, now=False)
+
+        return result
+
+    def close(self, reason):
+        if self.checkpoint_loop is not None and self.checkpoint_loop.running:
+            self.checkpoint_loop.stop()
+
+        # A closed crawl is checkpointed too, so running the job again resumes from where it stopped
+        if self.dqs is not None:
+            self.checkpoint()
+
+        return super(CheckpointScheduler, self).close(reason)
+
+    def next_request(self):
+        request = super(CheckpointScheduler, self).next_request()
+        if request is not None:
+            self.popped.add(request)
+
+        return request
+
+    def checkpoint(self):
+        # Disk queues only write their state on close, so they are closed, snapshotted and reopened.
+        # The dupefilter and the requests in flight are saved into the same snapshot, so a resumed crawl never filters a request it did not finish.
+        state = self.dqs.close()
+        self._write_dqs_state(self.dqdir, state)
+
+        if hasattr(self.df, "checkpoint"):
+            self.df.checkpoint()
+
+        checkpoint_name = self._write_checkpoint()
+
+        self.dqs = self._dq()
+
+        # The items of the requests done before the snapshot may still be buffered by the pipelines, so it is published once they are written
+        d = self.crawler.signals.send_catch_log_deferred(signal=scheduler_checkpoint, spider=self.spider)
+        d.addCallback(self._publish_checkpoint, checkpoint_name)
+
+        return d
+
+    def _inflight_requests(self):
+        # A popped request stays in the engine slot until its spider output is handled, i.e. its items are passed and its links are queued
+        slot = getattr(getattr(self.crawler, "engine", None), "slot", None)
+        if slot is None:
+            return []
+
+        return [r for r in self.popped if r in slot.inprogress]
+
+    def _write_checkpoint(self):
+        self.checkpoint_seq += 1
+        checkpoint_name = f"{CHECKPOINT_DIR_PREFIX}{self.checkpoint_seq:06d}"
+        checkpoint_path = os.path.join(self.jobdir, checkpoint_name)
+
+        if os.path.exists(checkpoint_path):
+            shutil.rmtree(checkpoint_path)
+
+        _copy_queue_dir(self.dqdir, os.path.join(checkpoint_path, "requests.queue"))
+
+        # The filter is saved by renaming a new file over the old one, so a link keeps the saved bits
+        bloom_path = getattr(self.df, "path", None)
+        if bloom_path is not None and os.path.exists(bloom_path):
+            os.link(bloom_path, os.path.join(checkpoint_path, "requests.bloom"))
+
+        inflight = []
+        for request in self._inflight_requests():
+            try:
+                inflight.append(request_to_dict(request, self.spider))
+            except ValueError:
+                self.stats.inc_value("scheduler/unserializable", spider=self.spider)
+
+        with open(os.path.join(checkpoint_path, "inflight.pickle"), "wb") as f:
+            pickle.dump(inflight, f, protocol=2)
+
+        return checkpoint_name
+
+    def _publish_checkpoint(self, results, checkpoint_name):
+        checkpoint_seq = int(checkpoint_name[len(CHECKPOINT_DIR_PREFIX):])
+
+        # The snapshot is not published when a handler failed to write, nor over a newer snapshot
+        failed = any(isinstance(result, Failure) for _, result in results)
+        if failed or checkpoint_seq < self.published_seq:
+            logger.warning(f"#_publish_checkpoint: discarded: checkpoint={checkpoint_name}, failed={failed}")
+            self.stats.inc_value("scheduler/checkpoint/discarded", spider=self.spider)
+
+            shutil.rmtree(os.path.join(self.jobdir, checkpoint_name), ignore_errors=True)
+            return
+
+        tmp_path = os.path.join(self.jobdir, CHECKPOINT_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"name": checkpoint_name}, f)
+        os.replace(tmp_path, os.path.join(self.jobdir, CHECKPOINT_FILE))
+
+        self.checkpoint_name = checkpoint_name
+        self.published_seq = checkpoint_seq
+        self._remove_old_checkpoints(checkpoint_seq)
+
+        self.stats.inc_value("scheduler/checkpoint", spider=self.spider)
+
+        logger.debug(f"#_publish_checkpoint: checkpoint={checkpoint_name}")
+
+    def _restore_checkpoint(self):
+        self.checkpoint_name = None
+        self.checkpoint_seq = 0
+
+        checkpoint_file = os.path.join(self.jobdir, CHECKPOINT_FILE)
+        if os.path.exists(checkpoint_file):
+            with open(checkpoint_file) as f:
+                self.checkpoint_name = json.load(f)["name"]
+                self.checkpoint_seq = int(self.checkpoint_name[len(CHECKPOINT_DIR_PREFIX):])
+
+        self.published_seq = self.checkpoint_seq
+
+        # Queue files written after the checkpoint do not match the saved queue state, so the queue is rebuilt from the snapshot
+        shutil.rmtree(self.dqdir)
+
+        bloom_path = getattr(self.df, "path", None)
+        if bloom_path is not None and os.path.exists(bloom_path):
+            os.remove(bloom_path)
+
+        inflight = []
+        if self.checkpoint_name is None:
+            os.makedirs(self.dqdir)
+        else:
+            checkpoint_path = os.path.join(self.jobdir, self.checkpoint_name)
+            _copy_queue_dir(os.path.join(checkpoint_path, "requests.queue"), self.dqdir)
+
+            if bloom_path is not None and os.path.exists(os.path.join(checkpoint_path, "requests.bloom")):
+                shutil.copyfile(os.path.join(checkpoint_path, "requests.bloom"), bloom_path)
+
+            inflight_path = os.path.join(checkpoint_path, "inflight.pickle")
+            if os.path.exists(inflight_path):
+                with open(inflight_path, "rb") as f:
+                    inflight = pickle.load(f)
+
+            logger.info(f"#_restore_checkpoint: restored: checkpoint={self.checkpoint_name}, inflight={len(inflight)}")
+
+        # Also removes the snapshots left unpublished by the killed crawl
+        self._remove_old_checkpoints()
+
+        return inflight
+
+    def _remove_old_checkpoints(self, before_seq=None):
+        # Snapshots newer than the published one may still wait for their handlers, so only older ones are removed while crawling
+        for name in os.listdir(self.jobdir):
+            if not name.startswith(CHECKPOINT_DIR_PREFIX) or name == self.checkpoint_name:
+                continue
+
+            if before_seq is None or int(name[len(CHECKPOINT_DIR_PREFIX):]) < before_seq:
+                shutil.rmtree(os.path.join(self.jobdir, name))
+
+
+def _copy_queue_dir(src, dst):
+    """ Copy the disk queue directory, linking the chunk files that are only read and removed from now on. """
+
+    for dirpath, _, filenames in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(dirpath, src))
+        os.makedirs(target, exist_ok=True)
+
+        # Pushes append to the head chunk and the state files are rewritten in place, so those are copied
+        head_chunk = None
+        if "info.json" in filenames:
+            with open(os.path.join(dirpath, "info.json")) as f:
+                head_chunk = "q%05d" % json.load(f)["head"][0]
+
+        for filename in filenames:
+            if head_chunk is not None and filename.startswith("q") and filename != head_chunk:
+                os.link(os.path.join(dirpath, filename), os.path.join(target, filename))
+            else:
+                shutil.copyfile(os.path.join(dirpath, filename), os.path.join(target, filename))
@@ -9,23 +9,109 @@ USER_AGENT = "horse_racing_crawler/1.0 (+https://github.com/u6k/investment-horse
 
 SPIDER_MODULES = ['investment_horse_racing_crawler.scrapy.spiders']
 NEWSPIDER_MODULE = 'investment_horse_racing_crawler.scrapy.spiders'
+COMMANDS_MODULE = 'investment_horse_racing_crawler.scrapy.commands'
 
 
 ROBOTSTXT_OBEY = True
 
-CONCURRENT_REQUESTS = 1
+# Cache lookups run before the per-domain slot, so only CONCURRENT_REQUESTS_PER_DOMAIN limits requests to the site
+CONCURRENT_REQUESTS = 16
 CONCURRENT_REQUESTS_PER_DOMAIN = 1
 CONCURRENT_REQUESTS_PER_IP = 0
 
 DOWNLOAD_DELAY = 3
 DOWNLOAD_TIMEOUT = 10
 
+# Crawls started with a job name keep their scheduler queue and dupefilter in CRAWL_JOB_DIR/<job name> and resume from there.
+# Both are saved together with the requests in flight every SCHEDULER_CHECKPOINT_INTERVAL seconds, once the pipelines have written their buffered items,
+# so a killed crawl loses at most that much work.
+# Only these jobs use JOB_DUPEFILTER_CLASS, other crawls keep the exact DUPEFILTER_CLASS of Scrapy.
+SCHEDULER = "investment_horse_racing_crawler.scrapy.scheduler.CheckpointScheduler"
+SCHEDULER_CHECKPOINT_INTERVAL = 60
+JOB_DUPEFILTER_CLASS = "investment_horse_racing_crawler.scrapy.scheduler.BloomDupeFilter"
+DUPEFILTER_BLOOM_CAPACITY = 10000000
+DUPEFILTER_BLOOM_ERROR_RATE = 0.0001
+CRAWL_JOB_DIR = "crawl_jobs"
+
+# Table rows of result, denma and odds pages are parsed with precompiled lxml XPaths instead of an ItemLoader per row
+FAST_PARSER_ENABLED = True
+
+# HorseRacingSpider sets the request priorities, and requests of the same priority are fetched in the order they were found
+SCHEDULER_MEMORY_QUEUE = "scrapy.squeues.FifoMemoryQueue"
+SCHEDULER_DISK_QUEUE = "scrapy.squeues.PickleFifoDiskQueue"
+
+# Requests waiting for DOWNLOAD_DELAY do not count toward CONCURRENT_REQUESTS, but at most DOWNLOAD_MAX_QUEUED_FETCHES of them wait at a time
+DOWNLOADER = "investment_horse_racing_crawler.scrapy.downloader.CacheAwareDownloader"
+DOWNLOAD_MAX_QUEUED_FETCHES = 8
+
 ITEM_PIPELINES = {
+    "investment_horse_racing_crawler.scrapy.pipelines.ProcessPoolNormalizePipeline": 200,
     "investment_horse_racing_crawler.scrapy.pipelines.PostgreSQLPipeline": 300,
 }
 
+DOWNLOADER_MIDDLEWARES = {
+    "scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware": None,
+    "investment_horse_racing_crawler.scrapy.middlewares.ThreadedHttpCacheMiddleware": 900,
+    "investment_horse_racing_crawler.scrapy.middlewares.AdaptiveConcurrencyMiddleware": 950,
+}
+
+# Network fetches of all path classes together start at 1 request / DOWNLOAD_DELAY. Every ADAPTIVE_CONCURRENCY_INTERVAL seconds
+# of healthy responses the delay of a class is halved down to min_delay, then its concurrency is raised up to max_concurrency,
+# as long as the classes together stay within ADAPTIVE_CONCURRENCY_MAX_RATE requests per second to the site.
+# 429/5xx, download errors or an average latency above ADAPTIVE_CONCURRENCY_TARGET_LATENCY halve it back.
+# 0 caps the site at 1 request / DOWNLOAD_DELAY as without adaptive concurrency, so the classes only share that rate.
+# A faster rate must be set explicitly.
+ADAPTIVE_CONCURRENCY_ENABLED = True
+ADAPTIVE_CONCURRENCY_MAX_RATE = 0
+ADAPTIVE_CONCURRENCY_MAX = 6
+ADAPTIVE_CONCURRENCY_TARGET_LATENCY = 2.0
+ADAPTIVE_CONCURRENCY_INTERVAL = 10.0
+ADAPTIVE_CONCURRENCY_MAX_DELAY = 60.0
+ADAPTIVE_CONCURRENCY_PATH_CLASSES = [
+    {"name": "odds", "pattern": "/odds/", "max_concurrency": 3, "min_delay": 0.5},
+    {"name": "race", "pattern": "/race/", "max_concurrency": 2, "min_delay": 1.0},
+    {"name": "schedule", "pattern": "/schedule/", "max_concurrency": 1, "min_delay": 1.0},
+    {"name": "directory", "pattern": "/directory/", "max_concurrency": 1, "min_delay": 3.0},
+]
+
+SPIDER_MIDDLEWARES = {
+    "investment_horse_racing_crawler.scrapy.middlewares.CachePrefetchSpiderMiddleware": 50,
+    "investment_horse_racing_crawler.scrapy.middlewares.ShardDedupSpiderMiddleware": 100,
+    "investment_horse_racing_crawler.scrapy.middlewares.KnownEntitySpiderMiddleware": 150,
+}
+
+# Directory pages whose item was written within KNOWN_ENTITY_MAX_AGE seconds, in this or a previous run, are not requested again unless recache_horse is set
+KNOWN_ENTITY_ENABLED = True
+KNOWN_ENTITY_DIR = "known_entities"
+KNOWN_ENTITY_MAX_AGE = 30 * 24 * 60 * 60
+
 HTTPCACHE_ENABLED = True
 HTTPCACHE_STORAGE = "investment_horse_racing_crawler.scrapy.middlewares.S3CacheStorage"
+HTTPCACHE_S3_MAX_POOL_CONNECTIONS = 32
+HTTPCACHE_S3_THREADS = 16
+HTTPCACHE_S3_MAX_PENDING_STORES = 100
+HTTPCACHE_PREFETCH_ENABLED = True
+HTTPCACHE_PREFETCH_PATTERNS = ["/race/denma/"]
+HTTPCACHE_PREFETCH_MAX = 500
+HTTPCACHE_LOCAL_ENABLED = True
+HTTPCACHE_LOCAL_DIR = "httpcache_local"
+HTTPCACHE_LOCAL_MAX_SIZE = 2 * 1024 * 1024 * 1024
+# Pickled records written before the versioned record format are treated as cache misses and refetched.
+# Set this only until "scrapy migrate_cache" has rewritten them, since unpickling can run any code.
+HTTPCACHE_ALLOW_LEGACY_RECORDS = False
+# Archives packed with "scrapy pack_cache" are downloaded by the first lookup in their month and read with mmap
+HTTPCACHE_ARCHIVE_ENABLED = True
+HTTPCACHE_ARCHIVE_LOCAL_DIR = "httpcache_archives"
+
+# max_age (seconds) applies until the page is final, i.e. stored final_delay seconds after request.meta["final_datetime"]
+HTTPCACHE_FRESHNESS_TIMEZONE = "Asia/Tokyo"
+HTTPCACHE_FRESHNESS_POLICIES = [
+    {"pattern": "/schedule/list/", "max_age": 6 * 60 * 60},
+    {"pattern": "/race/list/", "max_age": 6 * 60 * 60},
+    {"pattern": "/race/denma/", "max_age": 60 * 60},
+    {"pattern": "/odds/", "max_age": 10 * 60},
+    {"pattern": "/race/result/", "max_age": 60 * 60, "final_delay": 60 * 60},
+]
 
 SPIDER_CONTRACTS = {
     "investment_horse_racing_crawler.scrapy.contracts.ScheduleListContract": 10,
@@ -53,3 +139,13 @@ DB_PORT = os.environ["DB_PORT"]
 DB_DATABASE = os.environ["DB_DATABASE"]
 DB_USERNAME = os.environ["DB_USERNAME"]
 DB_PASSWORD = os.environ["DB_PASSWORD"]
+
+DB_BATCH_SIZE = 500
+DB_FLUSH_INTERVAL = 10
+DB_WRITER_QUEUE_SIZE = 1000
+
+NORMALIZE_PROCESS_POOL_SIZE = 0
+
+CRAWL_MAX_JOBS = 2
+CRAWL_PROGRESS_INTERVAL = 5
+CRAWL_SHARD_PROCESSES = 4
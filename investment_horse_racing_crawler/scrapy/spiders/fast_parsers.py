@@ -0,0 +1,105 @@
+from lxml import etree
+
+from investment_horse_racing_crawler.scrapy.items import RacePayoffItem, RaceResultItem, RaceDenmaItem, OddsWinPlaceItem
+
+
+# Row parsers that evaluate precompiled XPaths on the lxml tree of the response.
+# They emit the same values as the ItemLoader path: the first matched string per field, and no field when nothing matched.
+# Strings are plain str, since the smart strings of lxml keep a reference to their element and so to the whole tree.
+# A field entry lists every field filled from its XPath, so a selection shared by several fields is evaluated once per row.
+
+PAYOFF_ROWS = etree.XPath("//table[contains(@class, 'resultYen')]/tr")
+PAYOFF_TYPE = etree.XPath("th/text()", smart_strings=False)
+PAYOFF_FIELDS = (
+    (("horse_number",), etree.XPath("td[1]/text()", smart_strings=False)),
+    (("odds",), etree.XPath("td[2]/text()", smart_strings=False)),
+    (("favorite_order",), etree.XPath("td[3]/span/text()", smart_strings=False)),
+)
+
+RESULT_ROWS = etree.XPath("//table[@id='raceScore']/tbody/tr")
+RESULT_FIELDS = (
+    (("result",), etree.XPath("td[1]/text()", smart_strings=False)),
+    (("bracket_number",), etree.XPath("td[2]/span/text()", smart_strings=False)),
+    (("horse_number",), etree.XPath("td[3]/text()", smart_strings=False)),
+    (("horse_id",), etree.XPath("td[4]/a/@href", smart_strings=False)),
+    (("horse_name",), etree.XPath("td[4]/a/text()", smart_strings=False)),
+    (("horse_gender_age", "horse_weight_and_diff"), etree.XPath("td[4]/span/text()", smart_strings=False)),
+    (("arrival_time",), etree.XPath("td[5]/text()[1]", smart_strings=False)),
+    (("jockey_id",), etree.XPath("td[7]/a/@href", smart_strings=False)),
+    (("jockey_name",), etree.XPath("td[7]/a/text()", smart_strings=False)),
+    (("jockey_weight",), etree.XPath("td[7]/span/text()", smart_strings=False)),
+    (("favorite_order",), etree.XPath("td[8]/text()[1]", smart_strings=False)),
+    (("odds",), etree.XPath("td[8]/span/text()", smart_strings=False)),
+    (("trainer_id",), etree.XPath("td[9]/a/@href", smart_strings=False)),
+    (("trainer_name",), etree.XPath("td[9]/a/text()", smart_strings=False)),
+)
+
+DENMA_ROWS = etree.XPath("//table[contains(@class, 'denmaLs')]/tr[position()>1]")
+DENMA_FIELDS = (
+    (("bracket_number",), etree.XPath("td[1]/span/text()", smart_strings=False)),
+    (("horse_number",), etree.XPath("td[2]/strong/text()", smart_strings=False)),
+    (("horse_id",), etree.XPath("td[3]/a/@href", smart_strings=False)),
+    (("trainer_id",), etree.XPath("td[3]/span/a/@href", smart_strings=False)),
+    (("horse_weight_and_diff",), etree.XPath("string(td[4])", smart_strings=False)),
+    (("jockey_id",), etree.XPath("td[5]/a/@href", smart_strings=False)),
+    (("jockey_weight",), etree.XPath("td[5]/text()", smart_strings=False)),
+    (("prize_total_money",), etree.XPath("td[7]/text()[3]", smart_strings=False)),
+)
+
+ODDS_ROWS = etree.XPath("//table[@class='dataLs oddTkwLs']/tbody/tr[not(th)]")
+ODDS_FIELDS = (
+    (("horse_number",), etree.XPath("td[2]/text()", smart_strings=False)),
+    (("horse_id",), etree.XPath("td[3]/a/@href", smart_strings=False)),
+    (("odds_win",), etree.XPath("td[4]/text()", smart_strings=False)),
+    (("odds_place_min",), etree.XPath("td[5]/text()", smart_strings=False)),
+    (("odds_place_max",), etree.XPath("td[7]/text()", smart_strings=False)),
+)
+
+
+def parse_payoff_rows(root, race_id):
+    payoff_type = None
+    for tr in PAYOFF_ROWS(root):
+        payoff_type_strs = PAYOFF_TYPE(tr)
+        if payoff_type_strs:
+            payoff_type = payoff_type_strs[0]
+
+        yield _build_item(RacePayoffItem, tr, PAYOFF_FIELDS, race_id=race_id, payoff_type=payoff_type)
+
+
+def parse_result_rows(root, race_id):
+    for tr in RESULT_ROWS(root):
+        yield _build_item(RaceResultItem, tr, RESULT_FIELDS, race_id=race_id)
+
+
+def parse_denma_rows(root, race_id):
+    for tr in DENMA_ROWS(root):
+        yield _build_item(RaceDenmaItem, tr, DENMA_FIELDS, race_id=race_id)
+
+
+def parse_odds_rows(root, race_id):
+    for tr in ODDS_ROWS(root):
+        yield _build_item(OddsWinPlaceItem, tr, ODDS_FIELDS, race_id=race_id)
+
+
+def _build_item(item_cls, tr, fields, **values):
+    item = item_cls()
+
+    for name, value in values.items():
+        if value is not None:
+            item[name] = value
+
+    for names, xpath in fields:
+        result = xpath(tr)
+
+        # string() returns one string, node selections return a list of strings
+        if isinstance(result, str):
+            value = result
+        elif result:
+            value = result[0]
+        else:
+            continue
+
+        for name in names:
+            item[name] = value
+
+    return item
@@ -1,21 +1,52 @@
 import re
 from datetime import datetime
+from operator import itemgetter
+from dateutil import tz
 from dateutil.relativedelta import relativedelta
 import scrapy
 from scrapy.loader import ItemLoader
+from scrapy.loader.processors import Compose
 
 from investment_horse_racing_crawler.app_logging import get_logger
 from investment_horse_racing_crawler.scrapy.items import RaceInfoItem, RacePayoffItem, RaceResultItem, RaceDenmaItem, HorseItem, TrainerItem, JockeyItem, OddsWinPlaceItem
+from investment_horse_racing_crawler.scrapy.normalizers import parse_start_datetime
+from investment_horse_racing_crawler.scrapy.spiders import fast_parsers
 
 
 logger = get_logger(__name__)
 
 
+# Link extraction selects only the hrefs each page follows, instead of testing every anchor of the page
+SCHEDULE_LIST_LINK_XPATH = "//a[starts-with(@href, '/schedule/list/') or starts-with(@href, '/race/list/')]/@href"
+RACE_LIST_LINK_XPATH = "//a[starts-with(@href, '/race/result/')]/@href"
+DIRECTORY_LINK_XPATH = "//a[starts-with(@href, '/directory/horse/') or starts-with(@href, '/directory/trainer/') or starts-with(@href, '/directory/jocky/')]/@href"
+
+SCHEDULE_LIST_HREF_RE = re.compile("^/schedule/list/([0-9]+)/\\?month=([0-9]+)$")
+RACE_LIST_DATE_RE = re.compile("^([0-9]+)年([0-9]+)月([0-9]+)日.*$")
+RACE_RESULT_HREF_RE = re.compile("^/race/result/([0-9]+)/$")
+
+
+# Request priorities. Pages that lead to races come first, then races by how soon they start, and directory pages last.
+PRIORITY_LIST = 300
+PRIORITY_UPCOMING_RACE = 200
+PRIORITY_FINISHED_RESULT = 150
+PRIORITY_PAST_RACE = 100
+PRIORITY_PENDING_RESULT = 0
+PRIORITY_DIRECTORY = -100
+
+
+class RecordLoader(ItemLoader):
+    # Records hold the first extracted value of a field, which is the value the normalizers use.
+    # TakeFirst is not used, since it skips an empty first value.
+    default_output_processor = Compose(itemgetter(0))
+
+
 class HorseRacingSpider(scrapy.Spider):
     name = "horse_racing"
+    timezone = tz.gettz("Asia/Tokyo")
 
-    def __init__(self, start_url='https://keiba.yahoo.co.jp/schedule/list/', start_date=datetime(1900, 1, 1), end_date=datetime(2100, 1, 1), recache_race=False, recache_horse=False, *args, **kwargs):
-        logger.info(f"#__init__: start: start_url={start_url}, start_date={start_date}, end_date={end_date}, recache_race={recache_race}, recache_horse={recache_horse}")
+    def __init__(self, start_url='https://keiba.yahoo.co.jp/schedule/list/', start_date=datetime(1900, 1, 1), end_date=datetime(2100, 1, 1), recache_race=False, recache_horse=False, bulk_ingest=False, *args, **kwargs):
+        logger.info(f"#__init__: start: start_url={start_url}, start_date={start_date}, end_date={end_date}, recache_race={recache_race}, recache_horse={recache_horse}, bulk_ingest={bulk_ingest}")
         try:
             super(HorseRacingSpider, self).__init__(*args, **kwargs)
 
@@ -30,6 +61,7 @@ class HorseRacingSpider(scrapy.Spider):
             self.end_date = end_date
             self.recache_race = recache_race
             self.recache_horse = recache_horse
+            self.bulk_ingest = bulk_ingest
         except Exception:
             logger.exception("#__init__: fail")
 
@@ -45,9 +77,10 @@ class HorseRacingSpider(scrapy.Spider):
         logger.debug(f"#parse: end_date={self.end_date}")
         logger.debug(f"#parse: recache_race={self.recache_race}")
         logger.debug(f"#parse: recache_horse={self.recache_horse}")
+        logger.debug(f"#parse: bulk_ingest={self.bulk_ingest}")
 
         path = response.url[25:]
-        yield self._follow_delegate(response, path)
+        yield self._follow_delegate(response, path, final_datetime=self._get_schedule_final_datetime(path))
 
     def parse_schedule_list(self, response):
         """ Parse schedule list page.
@@ -59,10 +92,11 @@ class HorseRacingSpider(scrapy.Spider):
         """
         logger.info("#parse_schedule_list: start: url=%s" % response.url)
 
-        for a in response.xpath("//a"):
-            href = a.xpath("@href").get()
+        # Race lists linked from a schedule page are the race days of its month, so they are final once the month is over
+        race_list_final_datetime = self._get_schedule_final_datetime(response.url[25:])
 
-            target_re = re.match("^/schedule/list/([0-9]+)/\\?month=([0-9]+)$", href)
+        for href in response.xpath(SCHEDULE_LIST_LINK_XPATH).getall():
+            target_re = SCHEDULE_LIST_HREF_RE.match(href)
             if target_re:
                 logger.debug("#parse_schedule_list: other schedule list page: href=%s" % href)
 
@@ -75,10 +109,11 @@ class HorseRacingSpider(scrapy.Spider):
                     logger.debug(f"#parse_schedule_list: cancel other schedule list page: target={target_start} to {target_end}, settings={self.start_date} to {self.end_date}")
                     continue
 
-                yield self._follow_delegate(response, href)
+                # The schedule of a month is final once the month is over
+                yield self._follow_delegate(response, href, final_datetime=target_end + relativedelta(days=1))
 
             if href.startswith("/race/list/"):
-                yield self._follow_delegate(response, href)
+                yield self._follow_delegate(response, href, final_datetime=race_list_final_datetime)
 
     def parse_race_list(self, response):
         """ Parse race list page.
@@ -91,7 +126,7 @@ class HorseRacingSpider(scrapy.Spider):
         logger.info("#parse_race_list: start: url=%s" % response.url)
 
         # Check re-crawl
-        target_date_re = re.match("^([0-9]+)年([0-9]+)月([0-9]+)日.*$", response.xpath("//div[@id='cornerTit']/h4/text()").get())
+        target_date_re = RACE_LIST_DATE_RE.match(response.xpath("//div[@id='cornerTit']/h4/text()").get())
         if not target_date_re:
             raise RuntimeError("#parse_race_list: target date not found")
 
@@ -101,11 +136,16 @@ class HorseRacingSpider(scrapy.Spider):
             logger.debug(f"#parse_race_list: cancel race list: target={target_date}, settings={self.start_date} to {self.end_date}")
             return
 
-        for a in response.xpath("//a"):
-            race_id_re = re.match("^/race/result/([0-9]+)/$", a.xpath("@href").get())
+        for href in response.xpath(RACE_LIST_LINK_XPATH).getall():
+            race_id_re = RACE_RESULT_HREF_RE.match(href)
             if race_id_re:
                 race_id = race_id_re.group(1)
-                yield self._follow_delegate(response, f"/race/denma/{race_id}/")
+
+                if not self._in_race_id_range(race_id):
+                    logger.debug(f"#parse_race_list: cancel race: race_id={race_id}")
+                    continue
+
+                yield self._follow_delegate(response, f"/race/denma/{race_id}/", final_datetime=target_date + relativedelta(days=1))
 
     def parse_race_result(self, response):
         """ Parse race result page.
@@ -122,13 +162,24 @@ class HorseRacingSpider(scrapy.Spider):
 
         race_id = response.url.split("/")[-2]
 
+        if self._use_fast_parser():
+            for i in fast_parsers.parse_payoff_rows(response.selector.root, race_id):
+                logger.debug("#parse_race_result: race payoff=%s" % i)
+                yield i
+
+            for i in fast_parsers.parse_result_rows(response.selector.root, race_id):
+                logger.debug("#parse_race_result: race result=%s" % i)
+                yield i
+
+            return
+
         payoff_type = None
         for tr in response.xpath("//table[contains(@class, 'resultYen')]/tr"):
             payoff_type_str = tr.xpath("th/text()").get()
             if payoff_type_str is not None:
                 payoff_type = payoff_type_str
 
-            loader = ItemLoader(item=RacePayoffItem(), selector=tr)
+            loader = RecordLoader(item=RacePayoffItem(), selector=tr)
             loader.add_value("race_id", race_id)
             loader.add_value("payoff_type", payoff_type)
             loader.add_xpath("horse_number", "td[1]/text()")
@@ -143,7 +194,7 @@ class HorseRacingSpider(scrapy.Spider):
         logger.debug("#parse_race_result: parse race result")
 
         for tr in response.xpath("//table[@id='raceScore']/tbody/tr"):
-            loader = ItemLoader(item=RaceResultItem(), selector=tr)
+            loader = RecordLoader(item=RaceResultItem(), selector=tr)
             loader.add_value("race_id", race_id)
             loader.add_xpath("result", "td[1]/text()")
             loader.add_xpath("bracket_number", "td[2]/span/text()")
@@ -178,7 +229,7 @@ class HorseRacingSpider(scrapy.Spider):
         # Parse race info
         logger.debug("#parse_race_denma: parse race info")
 
-        loader = ItemLoader(item=RaceInfoItem(), response=response)
+        loader = RecordLoader(item=RaceInfoItem(), response=response)
         race_id = response.url.split("/")[-2]
         loader.add_value("race_id", race_id)
         loader.add_xpath("race_round", "//td[@id='raceNo']/text()")
@@ -195,11 +246,34 @@ class HorseRacingSpider(scrapy.Spider):
         logger.debug("#parse_race_denma: race info=%s" % i)
         yield i
 
+        start_datetime = None
+        if "start_date" in i and "start_time" in i:
+            start_datetime = parse_start_datetime(i["start_date"], i["start_time"])
+
         # Parse race denma
         logger.debug("#parse_race_denma: parse race denma")
 
+        if self._use_fast_parser():
+            rows = fast_parsers.parse_denma_rows(response.selector.root, race_id)
+        else:
+            rows = self._parse_denma_rows(response, race_id)
+
+        for i in rows:
+            logger.debug("#parse_race_denma: race denma=%s" % i)
+            yield i
+
+        # Parse link
+        logger.debug("#parse_race_denma: parse link")
+
+        for href in response.xpath(DIRECTORY_LINK_XPATH).getall():
+            yield self._follow_delegate(response, href)
+
+        yield self._follow_delegate(response, f"/odds/tfw/{race_id}/", final_datetime=start_datetime)
+        yield self._follow_delegate(response, f"/race/result/{race_id}/", final_datetime=start_datetime)
+
+    def _parse_denma_rows(self, response, race_id):
         for tr in response.xpath("//table[contains(@class, 'denmaLs')]/tr[position()>1]"):
-            loader = ItemLoader(item=RaceDenmaItem(), selector=tr)
+            loader = RecordLoader(item=RaceDenmaItem(), selector=tr)
             loader.add_value("race_id", race_id)
             loader.add_xpath("bracket_number", "td[1]/span/text()")
             loader.add_xpath("horse_number", "td[2]/strong/text()")
@@ -209,24 +283,8 @@ class HorseRacingSpider(scrapy.Spider):
             loader.add_xpath("jockey_id", "td[5]/a/@href")
             loader.add_xpath("jockey_weight", "td[5]/text()")
             loader.add_xpath("prize_total_money", "td[7]/text()[3]")
-            i = loader.load_item()
-
-            logger.debug("#parse_race_denma: race denma=%s" % i)
-            yield i
-
-        # Parse link
-        logger.debug("#parse_race_denma: parse link")
-
-        for a in response.xpath("//a"):
-            href = a.xpath("@href").get()
-
-            if href.startswith("/directory/horse/") \
-                    or href.startswith("/directory/trainer/") \
-                    or href.startswith("/directory/jocky/"):
-                yield self._follow_delegate(response, href)
 
-        yield self._follow_delegate(response, f"/odds/tfw/{race_id}/")
-        yield self._follow_delegate(response, f"/race/result/{race_id}/")
+            yield loader.load_item()
 
     def parse_horse(self, response):
         """ Parse horse page.
@@ -240,7 +298,7 @@ class HorseRacingSpider(scrapy.Spider):
 
         horse_id = response.url.split("/")[-2]
 
-        loader = ItemLoader(item=HorseItem(), response=response)
+        loader = RecordLoader(item=HorseItem(), response=response)
         loader.add_value("horse_id", horse_id)
         loader.add_xpath("gender", "string(//div[@id='dirTitName']/p)")
         loader.add_xpath("name", "//div[@id='dirTitName']/h1/text()")
@@ -267,7 +325,7 @@ class HorseRacingSpider(scrapy.Spider):
 
         trainer_id = response.url.split("/")[-2]
 
-        loader = ItemLoader(item=TrainerItem(), response=response)
+        loader = RecordLoader(item=TrainerItem(), response=response)
         loader.add_value("trainer_id", trainer_id)
         loader.add_xpath("name_kana", "//div[@id='dirTitName']/p/text()[1]")
         loader.add_xpath("name", "//div[@id='dirTitName']/h1/text()")
@@ -291,7 +349,7 @@ class HorseRacingSpider(scrapy.Spider):
 
         jockey_id = response.url.split("/")[-2]
 
-        loader = ItemLoader(item=JockeyItem(), response=response)
+        loader = RecordLoader(item=JockeyItem(), response=response)
         loader.add_value("jockey_id", jockey_id)
         loader.add_xpath("name_kana", "//div[@id='dirTitName']/p/text()[1]")
         loader.add_xpath("name", "//div[@id='dirTitName']/h1/text()")
@@ -315,11 +373,18 @@ class HorseRacingSpider(scrapy.Spider):
 
         race_id = response.url.split("/")[-2]
 
+        if self._use_fast_parser():
+            for i in fast_parsers.parse_odds_rows(response.selector.root, race_id):
+                logger.debug("#parse_odds: odds=%s" % i)
+                yield i
+
+            return
+
         for tr in response.xpath("//table[@class='dataLs oddTkwLs']/tbody/tr"):
             if len(tr.xpath("th")) > 0:
                 continue
 
-            loader = ItemLoader(item=OddsWinPlaceItem(), selector=tr)
+            loader = RecordLoader(item=OddsWinPlaceItem(), selector=tr)
             loader.add_value("race_id", race_id)
             loader.add_xpath("horse_number", "td[2]/text()")
             loader.add_xpath("horse_id", "td[3]/a/@href")
@@ -332,40 +397,94 @@ class HorseRacingSpider(scrapy.Spider):
             logger.debug("#parse_odds: odds=%s" % i)
             yield i
 
-    def _follow_delegate(self, response, path):
-        logger.info(f"#_follow_delegate: start: path={path}")
+    def _use_fast_parser(self):
+        # Spiders created without a crawler, as in the contracts and tests, use the ItemLoader path
+        settings = getattr(self, "settings", None)
+
+        return settings is not None and settings.getbool("FAST_PARSER_ENABLED")
+
+    def _in_race_id_range(self, race_id):
+        # Race ids sort in the order of year, place, kai, day and round
+        race_id_from = getattr(self, "race_id_from", None)
+        race_id_to = getattr(self, "race_id_to", None)
+
+        return (race_id_from is None or race_id >= race_id_from) and (race_id_to is None or race_id <= race_id_to)
+
+    def _get_schedule_final_datetime(self, path, now=None):
+        # The schedule page without month is the schedule of the current month
+        target_re = SCHEDULE_LIST_HREF_RE.match(path)
+        if target_re:
+            target_start = datetime(int(target_re.group(1)), int(target_re.group(2)), 1, 0, 0, 0)
+        else:
+            if now is None:
+                now = datetime.now(self.timezone).replace(tzinfo=None)
+
+            target_start = datetime(now.year, now.month, 1, 0, 0, 0)
+
+        return target_start + relativedelta(months=1)
+
+    def _get_priority(self, path, final_datetime, now=None):
+        if path.startswith("/schedule/list/") or path.startswith("/race/list/"):
+            return PRIORITY_LIST
+
+        if path.startswith("/directory/"):
+            return PRIORITY_DIRECTORY
+
+        if final_datetime is None:
+            return PRIORITY_PAST_RACE
+
+        if now is None:
+            now = datetime.now(self.timezone).replace(tzinfo=None)
+
+        hours_until = (final_datetime - now).total_seconds() / 3600
+
+        if path.startswith("/race/result/"):
+            return PRIORITY_FINISHED_RESULT if hours_until <= 0 else PRIORITY_PENDING_RESULT
+
+        if hours_until < 0:
+            return PRIORITY_PAST_RACE
+
+        # Denma and odds of the races starting sooner go first
+        return PRIORITY_UPCOMING_RACE + max(0, 48 - int(hours_until))
+
+    def _follow_delegate(self, response, path, final_datetime=None):
+        logger.info(f"#_follow_delegate: start: path={path}, final_datetime={final_datetime}")
+
+        # final_datetime tells the cache freshness policy when the page stops changing
+        meta = {"final_datetime": final_datetime} if final_datetime is not None else None
+        priority = self._get_priority(path, final_datetime)
 
         if path.startswith("/schedule/list/"):
             logger.debug(f"#_follow_delegate: follow schedule list page")
-            return response.follow(path, callback=self.parse_schedule_list)
+            return response.follow(path, callback=self.parse_schedule_list, meta=meta, priority=priority)
 
         elif path.startswith("/race/list/"):
             logger.debug(f"#_follow_delegate: follow race list page")
-            return response.follow(path, callback=self.parse_race_list)
+            return response.follow(path, callback=self.parse_race_list, meta=meta, priority=priority)
 
         elif path.startswith("/race/denma/"):
             logger.debug(f"#_follow_delegate: follow race denma page")
-            return response.follow(path, callback=self.parse_race_denma)
+            return response.follow(path, callback=self.parse_race_denma, meta=meta, priority=priority)
 
         elif path.startswith("/race/result/"):
             logger.debug(f"#_follow_delegate: follow race result page")
-            return response.follow(path, callback=self.parse_race_result)
+            return response.follow(path, callback=self.parse_race_result, meta=meta, priority=priority)
 
         elif path.startswith("/odds/tfw/"):
             logger.debug(f"#_follow_delegate: follow odds page")
-            return response.follow(path, callback=self.parse_odds)
+            return response.follow(path, callback=self.parse_odds, meta=meta, priority=priority)
 
         elif path.startswith("/directory/horse/"):
             logger.debug(f"#_follow_delegate: follow horse page")
-            return response.follow(path, callback=self.parse_horse)
+            return response.follow(path, callback=self.parse_horse, meta=meta, priority=priority)
 
         elif path.startswith("/directory/trainer/"):
             logger.debug(f"#_follow_delegate: follow trainer page")
-            return response.follow(path, callback=self.parse_trainer)
+            return response.follow(path, callback=self.parse_trainer, meta=meta, priority=priority)
 
         elif path.startswith("/directory/jocky/"):
             logger.debug(f"#_follow_delegate: follow jockey page")
-            return response.follow(path, callback=self.parse_jockey)
+            return response.follow(path, callback=self.parse_jockey, meta=meta, priority=priority)
 
         else:
             logger.warning(f"#_follow_delegate: unknown path pattern")
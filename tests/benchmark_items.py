@@ -0,0 +1,76 @@
+"""Memory benchmark of the items scraped from the row-heavy pages, with the ItemLoader and the fast parser path.
+
+Items are parsed from the pages of tests.benchmark_parsers and kept alive, as they are while they wait in the pipelines,
+then the memory and the number of memory blocks they retain are divided by the number of items.
+
+Usage: python -m tests.benchmark_items [page_count] [FIXTURE_DIR]
+"""
+
+import gc
+import logging
+import sys
+import tracemalloc
+
+from scrapy.http import HtmlResponse, Request
+
+from tests.benchmark_parsers import FIXTURE_URLS, create_spider, generate_fixtures, get_callback, load_fixtures
+
+
+ITEM_PAGES = ["race_result", "race_denma", "odds"]
+
+
+def parse_items(spider, name, body, page_count):
+    url = FIXTURE_URLS[name]
+    callback = get_callback(spider, name)
+
+    items = []
+    for _ in range(page_count):
+        response = HtmlResponse(url, body=body, encoding="utf-8", request=Request(url))
+        items.extend(o for o in callback(response) if not isinstance(o, Request))
+
+    return items
+
+
+def benchmark(fixtures, page_count, fast_parser):
+    spider = create_spider(fast_parser)
+
+    results = {}
+    for name in ITEM_PAGES:
+        # Warm up, so lazily built caches are not counted
+        parse_items(spider, name, fixtures[name], 1)
+
+        gc.collect()
+        start_blocks = sys.getallocatedblocks()
+        tracemalloc.start()
+
+        items = parse_items(spider, name, fixtures[name], page_count)
+
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+        blocks = sys.getallocatedblocks() - start_blocks
+        tracemalloc.stop()
+
+        results[name] = (size / len(items), blocks / len(items), len(items))
+
+        del items
+
+    return results
+
+
+def main():
+    logging.disable(logging.DEBUG)
+
+    page_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    fixtures = load_fixtures(sys.argv[2]) if len(sys.argv) > 2 else generate_fixtures()
+
+    for fast_parser in (False, True):
+        print("fast parser" if fast_parser else "item loader")
+
+        results = benchmark(fixtures, page_count, fast_parser)
+
+        for name, (size, blocks, item_count) in results.items():
+            print(f"{name:20s} {size:10.0f} bytes/item {blocks:8.1f} blocks/item ({item_count} items)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Micro-benchmark of the item normalizers over the item fixtures of test_pipelines.py.
+
+Usage: python -m tests.benchmark_normalizers [repeat]
+"""
+
+import logging
+import sys
+import time
+
+from scrapy.exceptions import DropItem
+
+from investment_horse_racing_crawler.scrapy.items import RaceInfoItem, RacePayoffItem, RaceResultItem, RaceDenmaItem, HorseItem, TrainerItem, JockeyItem, OddsWinPlaceItem
+from investment_horse_racing_crawler.scrapy.normalizers import normalize_item
+
+
+FIXTURES = [
+    (RaceInfoItem, {"added_money": ' 本賞金：1060、420、270、160、106万円 ', "course_condition": '重', "course_type_length": '芝・右 2600m ', "place_name": ' 1回小倉2日 ', "race_id": '2010010212', "race_name": '\n呼子特別', "race_round": '12R', "start_date": '2020年1月19日（日） ', "start_time": ' 16:01発走', "weather": '曇'}),
+    (RacePayoffItem, {"favorite_order": '7番人気', "horse_number": '4', "odds": '1,360円', "payoff_type": '単勝', "race_id": '2010010212'}),
+    (RacePayoffItem, {"favorite_order": '6番人気', "horse_number": '7', "odds": '310円', "payoff_type": '複勝', "race_id": '2010010212'}),
+    (RacePayoffItem, {"favorite_order": '-番人気', "odds": '円', "payoff_type": '複勝', "race_id": '9002020101'}),
+    (RacePayoffItem, {"favorite_order": '-番人気', "horse_number": '2', "odds": '1,630円', "payoff_type": '単勝', "race_id": '1702020412'}),
+    (RacePayoffItem, {"favorite_order": '3番人気', "horse_number": '4－6', "odds": '540円', "payoff_type": '枠連', "race_id": '1906050201'}),
+    (RacePayoffItem, {"favorite_order": '5番人気', "horse_number": '7－12', "odds": '1,290円', "payoff_type": '馬連', "race_id": '1906050201'}),
+    (RacePayoffItem, {"favorite_order": '3番人気', "horse_number": '7－8', "odds": '370円', "payoff_type": 'ワイド', "race_id": '1906050201'}),
+    (RacePayoffItem, {"favorite_order": '9番人気', "horse_number": '12－7', "odds": '2,380円', "payoff_type": '馬単', "race_id": '1906050201'}),
+    (RacePayoffItem, {"favorite_order": '4番人気', "horse_number": '7－8－12', "odds": '1,770円', "payoff_type": '3連複', "race_id": '1906050201'}),
+    (RacePayoffItem, {"favorite_order": '24番人気', "horse_number": '12－7－8', "odds": '10,420円', "payoff_type": '3連単', "race_id": '1906050201'}),
+    (RaceResultItem, {"arrival_time": '\n2.43.6', "bracket_number": '3', "favorite_order": '\n7    ', "horse_gender_age": '\n牡5/442(-6)/    ', "horse_id": '/directory/horse/2015104408/', "horse_name": 'ワセダインブルー', "horse_number": '\n4  ', "horse_weight_and_diff": '\n牡5/442(-6)/    ', "jockey_id": '/directory/jocky/01143/', "jockey_name": '原田 和真', "jockey_weight": '57.0', "odds": '(13.6)', "race_id": '2010010212', "result": '\n1  ', "trainer_id": '/directory/trainer/01132/', "trainer_name": '金成 貴史'}),
+    (RaceResultItem, {"arrival_time": '\n2.44.9', "bracket_number": '8', "favorite_order": '\n3    ', "horse_gender_age": '\nせん5/478(+10)/B    ', "horse_id": '/directory/horse/2015106286/', "horse_name": 'サダムラピュタ', "horse_number": '\n13  ', "horse_weight_and_diff": '\nせん5/478(+10)/B    ', "jockey_id": '/directory/jocky/01154/', "jockey_name": '松若 風馬', "jockey_weight": '57.0', "odds": '(6.9)', "race_id": '2010010212', "result": '\n4  ', "trainer_id": '/directory/trainer/01082/', "trainer_name": '平田 修'}),
+    (RaceResultItem, {"arrival_time": '\n1.12.2', "bracket_number": '2', "favorite_order": '\n5    ', "horse_gender_age": '\n牡3/466(+2)/    ', "horse_id": '/directory/horse/2017104069/', "horse_name": 'メモワールミノル', "horse_number": '\n3  ', "horse_weight_and_diff": '\n牡3/466(+2)/    ', "jockey_id": '/directory/jocky/01179/', "jockey_name": '菅原 明良', "jockey_weight": '△54.0', "odds": '(8.3)', "race_id": '2006010201', "result": '\n1  ', "trainer_id": '/directory/trainer/01153/', "trainer_name": '中舘 英二'}),
+    (RaceResultItem, {"arrival_time": '\n1.12.4', "bracket_number": '3', "favorite_order": '\n9    ', "horse_gender_age": '\n牡3/460(+6)/    ', "horse_id": '/directory/horse/2017101489/', "horse_name": 'ドラゴンズバック', "horse_number": '\n6  ', "horse_weight_and_diff": '\n牡3/460(+6)/    ', "jockey_id": '/directory/jocky/01164/', "jockey_name": '藤田 菜七子', "jockey_weight": '▲53.0', "odds": '(21.8)', "race_id": '2006010201', "result": '\n2  ', "trainer_id": '/directory/trainer/01031/', "trainer_name": '伊藤 伸一'}),
+    (RaceResultItem, {"arrival_time": '\n', "bracket_number": '2', "favorite_order": '\n     ', "horse_gender_age": '\n牝5/ - ( - )/    ', "horse_id": '/directory/horse/2015102358/', "horse_name": 'イチザティアラ', "horse_number": '\n2  ', "horse_weight_and_diff": '\n牝5/ - ( - )/    ', "jockey_id": '/directory/jocky/00894/', "jockey_name": '小牧 太', "jockey_weight": '55.0', "odds": '( - )', "race_id": '2008010104', "result": '\n', "trainer_id": '/directory/trainer/01040/', "trainer_name": '服部 利之'}),
+    (RaceResultItem, {"arrival_time": '\n55.4', "bracket_number": '7', "favorite_order": '\n4    ', "horse_gender_age": '\n牝5/470(+6)/    ', "horse_id": '/directory/horse/2014102003/', "horse_name": 'ブリッジオーヴァー', "horse_number": '\n15  ', "horse_weight_and_diff": '\n牝5/470(+6)/    ', "jockey_id": '/directory/jocky/01178/', "jockey_name": '斎藤 新', "jockey_weight": '52.0', "odds": '(8.6)', "race_id": '1904030412', "result": '\n1  ', "trainer_id": '/directory/trainer/01164/', "trainer_name": '安田 翔伍'}),
+    (RaceResultItem, {"arrival_time": '\n1.44.2', "bracket_number": '5', "favorite_order": '\n4    ', "horse_gender_age": '\n牝4/446(+4)/    ', "horse_id": '/directory/horse/1988100963/', "horse_name": 'ジャストフォーユウ', "horse_number": '\n5  ', "horse_weight_and_diff": '\n牝4/446(+4)/    ', "jockey_id": '/directory/jocky/00673/', "jockey_name": '岸 滋彦', "jockey_weight": '53.0', "race_id": '9110040707', "result": '\n1  ', "trainer_id": '/directory/trainer/00375/', "trainer_name": '野村 彰彦'}),
+    (RaceDenmaItem, {"bracket_number": '1', "horse_id": '/directory/horse/2017100081/', "horse_number": '2', "horse_weight_and_diff": '\n488(+12)\n', "jockey_id": '/directory/jocky/01077/', "jockey_weight": '55.0 ', "prize_total_money": '\n280万', "race_id": '1906050201', "trainer_id": '/directory/trainer/01106/'}),
+    (RaceDenmaItem, {"bracket_number": '2', "horse_id": '/directory/horse/2017109094/', "horse_number": '3', "horse_weight_and_diff": '\n436(+12)\n', "jockey_id": '/directory/jocky/01179/', "jockey_weight": '51.0 ▲', "prize_total_money": '\n355万', "race_id": '1906050201', "trainer_id": '/directory/trainer/01147/'}),
+    (RaceDenmaItem, {"bracket_number": '3', "horse_id": '/directory/horse/2014106160/', "horse_number": '3', "horse_weight_and_diff": '\n482(+6)\n', "jockey_id": '/directory/jocky/00660/', "jockey_weight": '56.0 ', "prize_total_money": '\n2億4247万', "race_id": '2006010911', "trainer_id": '/directory/trainer/01115/'}),
+    (RaceDenmaItem, {"bracket_number": '2', "horse_id": '/directory/horse/2015102358/', "horse_number": '2', "horse_weight_and_diff": '\n-( - )', "jockey_id": '/directory/jocky/00894/', "jockey_weight": '55.0 ', "prize_total_money": '\n670万', "race_id": '2008010104'}),
+    (RaceDenmaItem, {"bracket_number": '3', "horse_id": '/directory/horse/2014105282/', "horse_number": '6', "horse_weight_and_diff": '\n438(-2)\n', "jockey_id": '/directory/jocky/01075/', "jockey_weight": '55.0 ', "prize_total_money": '\n2751.5万', "race_id": '2006010112', "trainer_id": '/directory/trainer/01097/'}),
+    (RaceDenmaItem, {"bracket_number": '-', "horse_id": '/directory/horse/2005102371/', "horse_number": '-', "horse_weight_and_diff": '\n-( - )', "jockey_id": '/directory/jocky/00660/', "jockey_weight": '55.0 ', "prize_total_money": '\n1995万', "race_id": '0901010907', "trainer_id": '/directory/trainer/00208/'}),
+    (HorseItem, {"birthday": '2017年3月31日', "breeder": '大栄牧場', "breeding_farm": '新冠町', "coat_color": '栗毛', "gender": ' 牡 | 登録抹消 ', "horse_id": '2017101602', "name": 'エリンクロノス', "owner": '田頭 勇貴', "trainer_id": '/directory/trainer/01012/'}),
+    (HorseItem, {"birthday": '2015年2月24日', "breeder": '三嶋牧場', "breeding_farm": '浦河町', "coat_color": '鹿毛', "gender": '（地） | 牡 | 登録抹消 ', "horse_id": '2015103355', "name": 'ネクストステップ', "owner": '吉澤 克己', "trainer_id": '/directory/trainer/01002/'}),
+    (HorseItem, {"birthday": '2015年2月28日', "breeder": 'Lansdowne Thoroughbreds, LLC', "breeding_farm": '米', "coat_color": '芦毛', "gender": '（外）（地） | 牝 | 登録抹消 ', "horse_id": '2015110026', "name": 'マッチョベリー', "owner": '栗山 良子', "trainer_id": '/directory/trainer/01010/'}),
+    (HorseItem, {"birthday": '2013年4月26日', "breeding_farm": '米', "coat_color": '芦毛', "gender": '[外] | せん | 登録抹消 ', "horse_id": '2013190003', "name": 'サンダリングブルー', "owner": 'C.ウォッシュボーン', "trainer_id": '/directory/trainer/05730/'}),
+    (TrainerItem, {"belong_to": '\n美浦', "birthday": '1953年2月13日', "first_licensing_year": '1996年', "name": '大江原 哲', "name_kana": 'オオエハラ サトシ ', "trainer_id": '01012'}),
+    (JockeyItem, {"belong_to": '\n美浦(藤沢 和雄)', "birthday": '1998年9月21日', "first_licensing_year": '2017年（平地・障害）', "jockey_id": '01167', "name": '木幡 育也', "name_kana": 'コワタ イクヤ '}),
+    (JockeyItem, {"belong_to": '\n招待(フリー)', "first_licensing_year": '0000年', "jockey_id": '05508', "name": '島崎      和也', "name_kana": ' '}),
+    (OddsWinPlaceItem, {"horse_id": '/directory/horse/2017101602/', "horse_number": '1', "odds_place_max": '43.8', "odds_place_min": '26.0', "odds_win": '161.2', "race_id": '1906050201'}),
+    (OddsWinPlaceItem, {"horse_id": '/directory/horse/2014105805/', "horse_number": '4', "odds_place_max": '****', "odds_place_min": '****', "odds_win": '****', "race_id": '2008010212'}),
+    (OddsWinPlaceItem, {"horse_id": '/directory/horse/1989101565/', "horse_number": '2', "odds_win": '1.4', "race_id": '9406040205'}),
+    (TrainerItem, {"belong_to": '栗東', "birthday": '1968年7月1日', "first_licensing_year": '2008年', "name": '高橋 義忠', "name_kana": 'たかはし よしただ', "trainer_id": '01012'}),
+]
+
+
+def benchmark(repeat):
+    items = [item_cls(values) for item_cls, values in FIXTURES]
+
+    results = {}
+    for item in items:
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            try:
+                normalize_item(item)
+            except DropItem:
+                pass
+        elapsed = time.perf_counter() - start_time
+
+        count, total = results.get(type(item).__name__, (0, 0.0))
+        results[type(item).__name__] = (count + repeat, total + elapsed)
+
+    return results
+
+
+def main():
+    logging.disable(logging.DEBUG)
+
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    results = benchmark(repeat)
+
+    for name, (count, elapsed) in results.items():
+        print(f"{name:20s} {count / elapsed:12.0f} items/sec")
+
+    total_count = sum(count for count, _ in results.values())
+    total_elapsed = sum(elapsed for _, elapsed in results.values())
+    print(f"{'total':20s} {total_count / total_elapsed:12.0f} items/sec")
+
+
+if __name__ == "__main__":
+    main()
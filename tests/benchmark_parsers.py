@@ -0,0 +1,136 @@
+"""Micro-benchmark of the HorseRacingSpider callbacks, with the ItemLoader and the fast parser path.
+
+Pages are read from FIXTURE_DIR (schedule_list.html, race_list.html, race_denma.html, race_result.html and odds.html
+saved from the cache), or generated with the structure of the real pages when no directory is given.
+
+Usage: python -m tests.benchmark_parsers [repeat] [FIXTURE_DIR]
+"""
+
+import logging
+import os
+import sys
+import time
+
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+
+from investment_horse_racing_crawler.scrapy.spiders.horse_racing_spider import HorseRacingSpider
+
+
+FIXTURE_URLS = {
+    "schedule_list": "https://keiba.yahoo.co.jp/schedule/list/2019/?month=12",
+    "race_list": "https://keiba.yahoo.co.jp/race/list/19060502/",
+    "race_denma": "https://keiba.yahoo.co.jp/race/denma/1906050201/",
+    "race_result": "https://keiba.yahoo.co.jp/race/result/1906050201/",
+    "odds": "https://keiba.yahoo.co.jp/odds/tfw/1906050201/",
+}
+
+
+def _menu():
+    # Site navigation, ads and footer links that every page has
+    return "".join(f"<li><a href='/news/{i}/'>news {i}</a></li><li><a href='https://example.com/{i}'>ad</a></li><a name='anchor{i}'></a>" for i in range(150))
+
+
+def generate_fixtures():
+    schedule_list = "<html><body><ul>" + _menu() + "</ul>" \
+        + "".join(f"<a href='/schedule/list/2019/?month={m}'>{m}月</a>" for m in range(1, 13)) \
+        + "<table>" + "".join(f"<tr><td><a href='/race/list/190605{d:02d}/'>race list</a></td></tr>" for d in range(1, 31)) + "</table>" \
+        + "</body></html>"
+
+    race_list = "<html><body><div id='cornerTit'><h4>2019年12月1日（日） 5回中山2日</h4></div><ul>" + _menu() + "</ul><table>" \
+        + "".join(f"<tr><td><a href='/race/result/19060502{r:02d}/'>{r}R</a></td><td><a href='/race/denma/19060502{r:02d}/'>出馬表</a></td></tr>" for r in range(1, 13)) \
+        + "</table></body></html>"
+
+    rows = "".join(
+        f"<tr><td><span>{(n + 1) // 2}</span></td><td><strong>{n}</strong></td>"
+        f"<td><a href='/directory/horse/20171{n:05d}/'>horse {n}</a><span><a href='/directory/trainer/01{n:03d}/'>trainer {n}</a></span></td>"
+        f"<td>488(+12)</td><td><a href='/directory/jocky/01{n + 100:03d}/'>jockey {n}</a>55.0</td><td></td><td>a<br/>b<br/>280万</td></tr>"
+        for n in range(1, 19))
+    race_denma = "<html><body><ul>" + _menu() + "</ul>" \
+        + "<td id='raceNo'>1R</td><p id='raceTitDay'>2019年12月1日（日）<br/>5回中山2日<br/>10:05発走</p>" \
+        + "<div id='raceTitName'><h1>2歳未勝利</h1></div><p id='raceTitMeta'>ダート・右 1200m <img alt='晴'/><img alt='良'/></p>" \
+        + "<table class='denmaLs'><tr><th>header</th></tr>" + rows + "</table></body></html>"
+
+    payoffs = "".join(
+        f"<tr><th>{payoff_type}</th><td>{n}</td><td>1,360円</td><td><span>{n}番人気</span></td></tr>"
+        f"<tr><td>{n + 1}</td><td>310円</td><td><span>{n + 1}番人気</span></td></tr>"
+        for n, payoff_type in enumerate(["単勝", "複勝", "枠連", "馬連", "ワイド", "馬単", "3連複", "3連単"], 1))
+    results = "".join(
+        f"<tr><td>{n}</td><td><span>{(n + 1) // 2}</span></td><td>{n}</td>"
+        f"<td><a href='/directory/horse/20171{n:05d}/'>horse {n}</a><br/><span>牡3/466(+2)/</span></td><td>1.12.{n}<br/>3F</td><td></td>"
+        f"<td><a href='/directory/jocky/01{n + 100:03d}/'>jockey {n}</a><br/><span>55.0</span></td><td>{n}<br/><span>({n}.5)</span></td>"
+        f"<td><a href='/directory/trainer/01{n:03d}/'>trainer {n}</a></td></tr>"
+        for n in range(1, 19))
+    race_result = "<html><body><ul>" + _menu() + "</ul>" \
+        + "<table class='resultYen'>" + payoffs + "</table>" \
+        + "<table id='raceScore'><thead><tr><th>着順</th></tr></thead><tbody>" + results + "</tbody></table></body></html>"
+
+    odds_rows = "".join(
+        f"<tr><td>{(n + 1) // 2}</td><td>{n}</td><td><a href='/directory/horse/20171{n:05d}/'>horse {n}</a></td><td>{n}.2</td><td>{n}.0</td><td>-</td><td>{n}.8</td></tr>"
+        for n in range(1, 19))
+    odds = "<html><body><ul>" + _menu() + "</ul>" \
+        + "<table class='dataLs oddTkwLs'><tbody><tr><th>枠番</th></tr>" + odds_rows + "</tbody></table></body></html>"
+
+    return {"schedule_list": schedule_list, "race_list": race_list, "race_denma": race_denma, "race_result": race_result, "odds": odds}
+
+
+def load_fixtures(fixture_dir):
+    fixtures = {}
+    for name in FIXTURE_URLS:
+        with open(os.path.join(fixture_dir, f"{name}.html"), "rb") as f:
+            fixtures[name] = f.read()
+
+    return fixtures
+
+
+def create_spider(fast_parser):
+    return HorseRacingSpider.from_crawler(get_crawler(HorseRacingSpider, {"FAST_PARSER_ENABLED": fast_parser}))
+
+
+def get_callback(spider, name):
+    return {
+        "schedule_list": spider.parse_schedule_list,
+        "race_list": spider.parse_race_list,
+        "race_denma": spider.parse_race_denma,
+        "race_result": spider.parse_race_result,
+        "odds": spider.parse_odds,
+    }[name]
+
+
+def benchmark(fixtures, repeat, fast_parser):
+    spider = create_spider(fast_parser)
+
+    results = {}
+    for name, body in fixtures.items():
+        url = FIXTURE_URLS[name]
+        callback = get_callback(spider, name)
+
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            # A new response per parse, so the cached parsed document of parsel is not reused
+            response = HtmlResponse(url, body=body, encoding="utf-8", request=Request(url))
+            output_count = len(list(callback(response)))
+        elapsed = time.perf_counter() - start_time
+
+        results[name] = (elapsed / repeat, output_count)
+
+    return results
+
+
+def main():
+    logging.disable(logging.DEBUG)
+
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    fixtures = load_fixtures(sys.argv[2]) if len(sys.argv) > 2 else generate_fixtures()
+
+    for fast_parser in (False, True):
+        print("fast parser" if fast_parser else "item loader")
+
+        results = benchmark(fixtures, repeat, fast_parser)
+
+        for name, (elapsed, output_count) in results.items():
+            print(f"{name:20s} {elapsed * 1000:10.3f} ms/page {output_count / elapsed:12.0f} outputs/sec")
+
+
+if __name__ == "__main__":
+    main()
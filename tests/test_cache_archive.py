@@ -0,0 +1,108 @@
+import io
+import os
+import tempfile
+from unittest import mock
+
+from investment_horse_racing_crawler.scrapy.cache_archive import CacheArchiveSet, CacheArchiveWriter, MmapArchiveReader, S3ArchiveReader, read_archive_index
+from investment_horse_racing_crawler.scrapy.cache_record import encode_record, decode_record
+
+
+class TestCacheArchive:
+    def setUp(self):
+        self.records = {
+            "0a" * 20: encode_record(200, "https://keiba.yahoo.co.jp/race/denma/2005010101/", {}, b"denma"),
+            "0b" * 20: encode_record(200, "https://keiba.yahoo.co.jp/race/result/2005010101/", {}, b"result"),
+        }
+
+        f = io.BytesIO()
+        writer = CacheArchiveWriter(f)
+        for fingerprint, data_obj in self.records.items():
+            writer.add(fingerprint, data_obj)
+        writer.close()
+
+        self.archive_obj = f.getvalue()
+
+    def test_read_archive_index(self):
+        # Execute
+        index = read_archive_index(lambda offset, length: self.archive_obj[offset:offset + length], len(self.archive_obj))
+
+        # Check
+        assert len(index) == 2
+
+        for fingerprint, data_obj in self.records.items():
+            offset, length = index.get(fingerprint)
+            assert self.archive_obj[offset:offset + length] == data_obj
+
+        assert index.get("0c" * 20) is None
+        assert index.get("00" * 20) is None
+
+    def test_read_archive_index_invalid(self):
+        # Execute
+        try:
+            read_archive_index(lambda offset, length: b"x" * length, 100)
+
+            assert False
+        except ValueError:
+            # Check
+            pass
+
+    def test_mmap_archive_reader(self):
+        # Setup
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive_path = os.path.join(tmp_dir, "2020-01.hrca")
+            with open(archive_path, "wb") as f:
+                f.write(self.archive_obj)
+
+            archives = CacheArchiveSet()
+
+            # Execute
+            archives.add("2020-01", lambda: MmapArchiveReader(archive_path), len(self.archive_obj))
+
+            # Check
+            assert decode_record(archives.get("0a" * 20, ["2020-01"]))["body"] == b"denma"
+            assert decode_record(archives.get("0b" * 20, ["2020-01"]))["body"] == b"result"
+            assert archives.get("0c" * 20, ["2020-01"]) is None
+
+            archives.close()
+
+    def test_s3_archive_reader(self):
+        # Setup
+        archive_obj = self.archive_obj
+
+        class S3Client:
+            def get_object(self, Bucket, Key, Range):
+                start, end = Range[len("bytes="):].split("-")
+                return {"Body": io.BytesIO(archive_obj[int(start):int(end) + 1])}
+
+        archives = CacheArchiveSet()
+
+        # Execute
+        archives.add("2020-01", lambda: S3ArchiveReader(S3Client(), "bucket", "cache/archives/2020-01.hrca"), len(self.archive_obj))
+
+        # Check
+        assert decode_record(archives.get("0b" * 20, ["2020-01"]))["body"] == b"result"
+
+    def test_open_on_first_lookup(self):
+        # Setup
+        opened = []
+
+        def _open_reader(month):
+            opened.append(month)
+            return S3ArchiveReader(None, "bucket", f"cache/archives/{month}.hrca")
+
+        archives = CacheArchiveSet()
+        for month in ["2019-12", "2020-01", "2020-02"]:
+            archives.add(month, lambda month=month: _open_reader(month), len(self.archive_obj))
+
+        # Check (nothing is read until a lookup)
+        assert opened == []
+
+        # Execute
+        with mock.patch.object(S3ArchiveReader, "read", lambda reader, offset, length: self.archive_obj[offset:offset + length]):
+            months = archives.get_race_year_months("20")
+            data_obj = archives.get("0a" * 20, months)
+
+        # Check (only the archives of the race year are opened, in order until the record is found)
+        assert sorted(months) == ["2020-01", "2020-02"]
+        assert decode_record(data_obj)["body"] == b"denma"
+        assert opened == [months[0]]
@@ -0,0 +1,61 @@
+import pickle
+
+from investment_horse_racing_crawler.scrapy.cache_record import encode_record, decode_header, decode_record, is_legacy_record
+
+
+class TestCacheRecord:
+    def test_encode_decode(self):
+        # Setup
+        headers = {b"Content-Type": [b"text/html; charset=utf-8"], b"Set-Cookie": [b"a=1", b"b=2"]}
+        body = "<html><body>第1回東京1日</body></html>".encode("utf-8") * 100
+
+        # Execute
+        data_obj = encode_record(200, "https://keiba.yahoo.co.jp/race/denma/2005010101/", headers, body)
+
+        # Check
+        assert not is_legacy_record(data_obj)
+        assert len(data_obj) < len(body)
+
+        data = decode_record(data_obj)
+        assert data["status"] == 200
+        assert data["url"] == "https://keiba.yahoo.co.jp/race/denma/2005010101/"
+        assert data["headers"] == headers
+        assert data["body"] == body
+
+    def test_decode_header(self):
+        # Setup
+        data_obj = encode_record(404, "https://keiba.yahoo.co.jp/race/result/2005010101/", {}, b"not found")
+
+        # Execute
+        header, body_offset = decode_header(data_obj)
+
+        # Check
+        assert header["status"] == 404
+        assert header["url"] == "https://keiba.yahoo.co.jp/race/result/2005010101/"
+        assert header["compression"] == "zlib"
+        assert header["body_length"] == 9
+        assert body_offset < len(data_obj)
+
+    def test_decode_legacy_record(self):
+        # Setup
+        data_obj = pickle.dumps({
+            "status": 200,
+            "url": "https://keiba.yahoo.co.jp/directory/horse/2017101602/",
+            "headers": {b"Content-Type": [b"text/html"]},
+            "body": b"<html></html>",
+        })
+
+        # Execute
+        data = decode_record(data_obj, allow_legacy=True)
+
+        # Check
+        assert is_legacy_record(data_obj)
+        assert data["status"] == 200
+        assert data["body"] == b"<html></html>"
+
+        try:
+            decode_record(data_obj)
+
+            assert False
+        except ValueError:
+            pass
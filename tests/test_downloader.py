@@ -0,0 +1,45 @@
+from collections import deque
+import logging
+
+from scrapy.http import Request
+from scrapy.utils.test import get_crawler
+
+from investment_horse_racing_crawler.scrapy.downloader import CacheAwareDownloader
+
+
+class Slot:
+    def __init__(self, queue_length):
+        self.queue = deque([None] * queue_length)
+
+
+class TestCacheAwareDownloader:
+    def setUp(self):
+        logging.disable(logging.DEBUG)
+
+        self.crawler = get_crawler(settings_dict={"CONCURRENT_REQUESTS": 4, "DOWNLOAD_MAX_QUEUED_FETCHES": 2})
+        self.downloader = CacheAwareDownloader(self.crawler)
+
+    def test_queued_fetches_do_not_count(self):
+        # Setup
+        self.downloader.active = {Request(f"https://keiba.yahoo.co.jp/race/denma/{i}/") for i in range(4)}
+        self.downloader.slots = {"keiba.yahoo.co.jp": Slot(1)}
+
+        # Execute / Check
+        assert not self.downloader.needs_backout()
+        assert self.crawler.stats.get_value("downloader/queued_fetches_max") == 1
+
+    def test_max_queued_fetches(self):
+        # Setup
+        self.downloader.active = {Request(f"https://keiba.yahoo.co.jp/race/denma/{i}/") for i in range(2)}
+        self.downloader.slots = {"keiba.yahoo.co.jp": Slot(2)}
+
+        # Execute / Check
+        assert self.downloader.needs_backout()
+
+    def test_total_concurrency(self):
+        # Setup
+        self.downloader.active = {Request(f"https://keiba.yahoo.co.jp/race/denma/{i}/") for i in range(4)}
+        self.downloader.slots = {}
+
+        # Execute / Check
+        assert self.downloader.needs_backout()
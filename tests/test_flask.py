@@ -1,7 +1,11 @@
+from datetime import datetime
 import logging
+import time
+from unittest import mock
 
 
 from investment_horse_racing_crawler import flask, VERSION
+from investment_horse_racing_crawler.scrapy import CrawlJobRegistry
 
 
 class TestFlask:
@@ -48,6 +52,17 @@ class TestFlask:
 
             db_conn.commit()
 
+    def wait_for_crawl_job(self, job_id):
+        while True:
+            result = self.app.get(f"/api/crawl/{job_id}")
+            assert result.status_code == 200
+
+            job = result.get_json()
+            if job["status"] not in ("pending", "running", "cancelling"):
+                return job
+
+            time.sleep(1)
+
     def test_health(self):
         # Execute
         result = self.app.get("/api/health")
@@ -59,6 +74,23 @@ class TestFlask:
         assert result_data["version"] == VERSION
         assert result_data["database"]
 
+    def test_db_pool(self):
+        # Setup
+        self.app.get("/api/health")
+        self.app.get("/api/health")
+
+        # Execute
+        result = self.app.get("/api/db_pool")
+
+        # Check
+        assert result.status_code == 200
+
+        result_data = result.get_json()
+        assert result_data["checkout_count"] >= 2
+        assert result_data["in_use"] == 0
+        assert result_data["utilization"] == 0.0
+        assert result_data["max_size"] >= result_data["min_size"]
+
     def test_crawl_1(self):
         # Setup
         req_data = {
@@ -78,6 +110,12 @@ class TestFlask:
         result_data = result.get_json()
         assert result_data["result"]
 
+        job = self.wait_for_crawl_job(result_data["job_id"])
+
+        assert job["status"] == "finished"
+        assert job["exit_code"] == 0
+        assert job["progress"]["item_scraped_count"] > 0
+
         with flask.get_db().cursor() as db_cursor:
             db_cursor.execute("select race_id, start_datetime from race_info order by start_datetime, race_id")
             race_infos = db_cursor.fetchall()
@@ -177,6 +215,12 @@ class TestFlask:
         result_data = result.get_json()
         assert result_data["result"]
 
+        job = self.wait_for_crawl_job(result_data["job_id"])
+
+        assert job["status"] == "finished"
+        assert job["exit_code"] == 0
+        assert job["progress"]["item_scraped_count"] > 0
+
         with flask.get_db().cursor() as db_cursor:
             db_cursor.execute("select race_id, start_datetime from race_info order by start_datetime, race_id")
             race_infos = db_cursor.fetchall()
@@ -473,3 +517,70 @@ class TestFlask:
         assert race_infos[0]["start_datetime"] == "2020-02-01 10:01:00"
         assert race_infos[0]["place_name"] == "2回京都1日"
         assert race_infos[0]["race_name"] == "3歳未勝利"
+
+    def test_crawl_cancel(self):
+        # Setup
+        req_data = {
+            "start_url": "https://keiba.yahoo.co.jp/schedule/list/2020/?month=2",
+            "start_date": "2020-02-01",
+            "end_date": "2020-02-02",
+        }
+
+        result = self.app.post("/api/crawl", json=req_data)
+        job_id = result.get_json()["job_id"]
+
+        # Execute
+        result = self.app.delete(f"/api/crawl/{job_id}")
+
+        # Check
+        assert result.status_code == 200
+        assert result.get_json()["result"]
+
+        job = self.wait_for_crawl_job(job_id)
+
+        assert job["status"] == "cancelled"
+
+    def test_crawl_invalid_args(self):
+        # Setup
+        job_count = len(self.app.get("/api/crawl").get_json()["jobs"])
+
+        for req_data in [
+            {"shard_unit": "day"},
+            {"job_name": "../2020"},
+            {"start_date": "2020/02/01"},
+        ]:
+            # Execute
+            result = self.app.post("/api/crawl", json=req_data)
+
+            # Check
+            assert result.status_code == 400
+            assert not result.get_json()["result"]
+
+        assert len(self.app.get("/api/crawl").get_json()["jobs"]) == job_count
+
+    def test_crawl_job_name(self):
+        # Setup
+        crawler_script = mock.Mock()
+        registry = CrawlJobRegistry(crawler_script, max_jobs=0)
+
+        # Execute
+        job_id = registry.submit("https://keiba.yahoo.co.jp/schedule/list/2020/?month=2", datetime(2020, 2, 1), datetime(2020, 2, 2), False, False, job_name="2020-02")
+        registry.cancel(job_id)
+
+        # Check (the job directory is left to the job process)
+        assert registry.get(job_id)["status"] == "cancelled"
+        assert not crawler_script.get_job_dir.called
+
+        try:
+            registry.submit("https://keiba.yahoo.co.jp/schedule/list/2020/?month=2", datetime(2020, 2, 1), datetime(2020, 2, 2), False, False, job_name="../2020")
+
+            assert False
+        except ValueError:
+            pass
+
+    def test_crawl_job_not_found(self):
+        # Execute
+        result = self.app.get("/api/crawl/unknown")
+
+        # Check
+        assert result.status_code == 404
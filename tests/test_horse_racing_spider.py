@@ -0,0 +1,97 @@
+from datetime import datetime
+import logging
+
+from scrapy.http import HtmlResponse, Request
+
+from investment_horse_racing_crawler.scrapy.items import Record
+from investment_horse_racing_crawler.scrapy.spiders.horse_racing_spider import HorseRacingSpider, PRIORITY_DIRECTORY, PRIORITY_FINISHED_RESULT, PRIORITY_LIST, PRIORITY_PAST_RACE, PRIORITY_PENDING_RESULT
+from tests.benchmark_parsers import FIXTURE_URLS, create_spider, generate_fixtures, get_callback
+
+
+class TestHorseRacingSpider:
+    def setUp(self):
+        logging.disable(logging.DEBUG)
+
+    def test_race_id_range(self):
+        # Setup
+        spider = HorseRacingSpider(race_id_from="2005010103", race_id_to="2005010110")
+
+        # Execute / Check
+        assert not spider._in_race_id_range("2005010102")
+        assert spider._in_race_id_range("2005010103")
+        assert spider._in_race_id_range("2005010110")
+        assert not spider._in_race_id_range("2005010111")
+        assert HorseRacingSpider()._in_race_id_range("2005010111")
+
+    def test_get_priority(self):
+        # Setup
+        spider = HorseRacingSpider()
+        now = datetime(2020, 2, 1, 10, 0, 0)
+
+        # Execute / Check
+        assert spider._get_priority("/schedule/list/2020/?month=2", datetime(2020, 3, 1), now=now) == PRIORITY_LIST
+        assert spider._get_priority("/directory/horse/2017101602/", None, now=now) == PRIORITY_DIRECTORY
+
+        assert spider._get_priority("/odds/tfw/2005010101/", datetime(2020, 2, 1, 10, 30, 0), now=now) > spider._get_priority("/odds/tfw/2005010112/", datetime(2020, 2, 1, 15, 30, 0), now=now)
+        assert spider._get_priority("/odds/tfw/2005010112/", datetime(2020, 2, 1, 15, 30, 0), now=now) > spider._get_priority("/race/denma/2005020101/", datetime(2020, 2, 3, 0, 0, 0), now=now)
+        assert spider._get_priority("/odds/tfw/2005010101/", datetime(2020, 2, 1, 10, 30, 0), now=now) < PRIORITY_LIST
+        assert spider._get_priority("/odds/tfw/2005010101/", datetime(2020, 1, 25, 10, 30, 0), now=now) == PRIORITY_PAST_RACE
+
+        assert spider._get_priority("/race/result/2005010101/", datetime(2020, 2, 1, 9, 30, 0), now=now) == PRIORITY_FINISHED_RESULT
+        assert spider._get_priority("/race/result/2005010112/", datetime(2020, 2, 1, 15, 30, 0), now=now) == PRIORITY_PENDING_RESULT
+
+    def test_parse_schedule_list_links(self):
+        # Setup
+        spider = HorseRacingSpider(start_date=datetime(2019, 12, 1), end_date=datetime(2019, 12, 31))
+        body = "<html><body><a name='top'></a><a href='/news/1/'>news</a>" \
+            "<a href='/schedule/list/2019/?month=11'>11</a><a href='/schedule/list/2019/?month=12'>12</a>" \
+            "<a href='/race/list/19060502/'>race list</a></body></html>"
+        response = HtmlResponse("https://keiba.yahoo.co.jp/schedule/list/2019/?month=12", body=body, encoding="utf-8")
+
+        # Execute
+        requests = list(spider.parse_schedule_list(response))
+
+        # Check
+        assert [r.url for r in requests] == [
+            "https://keiba.yahoo.co.jp/schedule/list/2019/?month=12",
+            "https://keiba.yahoo.co.jp/race/list/19060502/",
+        ]
+        assert [r.meta["final_datetime"] for r in requests] == [datetime(2020, 1, 1), datetime(2020, 1, 1)]
+
+    def test_parse_start_page(self):
+        # Setup
+        spider = HorseRacingSpider()
+        response = HtmlResponse("https://keiba.yahoo.co.jp/schedule/list/2019/?month=2", body=b"<html></html>", encoding="utf-8")
+
+        # Execute
+        requests = list(spider.parse(response))
+
+        # Check
+        assert [r.url for r in requests] == ["https://keiba.yahoo.co.jp/schedule/list/2019/?month=2"]
+        assert requests[0].meta["final_datetime"] == datetime(2019, 3, 1)
+
+    def test_get_schedule_final_datetime(self):
+        # Setup
+        spider = HorseRacingSpider()
+        now = datetime(2020, 2, 10, 10, 0, 0)
+
+        # Execute / Check
+        assert spider._get_schedule_final_datetime("/schedule/list/2019/?month=12", now=now) == datetime(2020, 1, 1)
+        assert spider._get_schedule_final_datetime("/schedule/list/", now=now) == datetime(2020, 3, 1)
+
+    def test_fast_parser_equivalence(self):
+        # Setup
+        fixtures = generate_fixtures()
+        item_loader_spider = create_spider(False)
+        fast_parser_spider = create_spider(True)
+
+        for name in ["race_result", "race_denma", "odds"]:
+            url = FIXTURE_URLS[name]
+
+            # Execute
+            expected = list(get_callback(item_loader_spider, name)(HtmlResponse(url, body=fixtures[name], encoding="utf-8", request=Request(url))))
+            actual = list(get_callback(fast_parser_spider, name)(HtmlResponse(url, body=fixtures[name], encoding="utf-8", request=Request(url))))
+
+            # Check
+            assert len([i for i in actual if isinstance(i, Record)]) > 0
+            assert [(type(i), dict(i)) if isinstance(i, Record) else i.url for i in actual] == [(type(i), dict(i)) if isinstance(i, Record) else i.url for i in expected]
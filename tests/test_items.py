@@ -0,0 +1,49 @@
+import pickle
+
+from investment_horse_racing_crawler.scrapy.items import RacePayoffItem, OddsWinPlaceItem
+
+
+class TestRecord:
+    def test_mapping(self):
+        # Setup
+        item = OddsWinPlaceItem()
+
+        # Execute
+        item["race_id"] = "1906050201"
+        item["horse_number"] = "1"
+
+        # Check
+        assert item["race_id"] == "1906050201"
+        assert "horse_number" in item
+        assert "odds_win" not in item
+        assert list(item.keys()) == ["race_id", "horse_number"]
+        assert dict(item) == {"race_id": "1906050201", "horse_number": "1"}
+        assert len(item) == 2
+
+        try:
+            item["odds_win"]
+
+            assert False
+        except KeyError:
+            pass
+
+    def test_unknown_field(self):
+        # Setup
+        item = RacePayoffItem()
+
+        # Execute
+        try:
+            item["unknown"] = "1"
+
+            assert False
+        except KeyError:
+            # Check
+            pass
+
+    def test_copy(self):
+        # Setup
+        item = OddsWinPlaceItem(race_id="1906050201", horse_number="1")
+
+        # Check
+        assert OddsWinPlaceItem(dict(item)) == item
+        assert pickle.loads(pickle.dumps(item)) == item
@@ -0,0 +1,550 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import io
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from scrapy.core.downloader import Downloader
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.request import request_fingerprint
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer
+
+from investment_horse_racing_crawler.scrapy.cache_archive import CacheArchiveSet, CacheArchiveWriter
+from investment_horse_racing_crawler.scrapy.cache_record import encode_record, get_stored_at
+from investment_horse_racing_crawler.scrapy.items import HorseItem
+from investment_horse_racing_crawler.scrapy.middlewares import AdaptiveConcurrencyMiddleware, CacheFreshnessPolicy, KnownEntitySpiderMiddleware, SQLiteCacheTier, S3CacheStorage
+from investment_horse_racing_crawler.scrapy.spiders.horse_racing_spider import HorseRacingSpider
+
+
+class TestKnownEntitySpiderMiddleware:
+    def setUp(self):
+        logging.disable(logging.DEBUG)
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.crawler = get_crawler(HorseRacingSpider)
+
+        self.middleware = KnownEntitySpiderMiddleware(os.path.join(self.tmp_dir.name, "known_entities.sqlite"), 60 * 60, self.crawler.stats)
+        self.middleware.spider_opened(None)
+
+    def tearDown(self):
+        self.middleware.spider_closed(None)
+        self.tmp_dir.cleanup()
+
+    def test_skip_known_entity(self):
+        # Setup
+        spider = HorseRacingSpider()
+        horse_response = HtmlResponse("https://keiba.yahoo.co.jp/directory/horse/2017101602/", status=200)
+        self.middleware.item_scraped(HorseItem(horse_id="2017101602"), horse_response, spider)
+
+        denma_response = HtmlResponse("https://keiba.yahoo.co.jp/race/denma/2005010101/", status=200)
+        result = [
+            Request("https://keiba.yahoo.co.jp/directory/horse/2017101602/"),
+            Request("https://keiba.yahoo.co.jp/directory/jocky/01167/"),
+            Request("https://keiba.yahoo.co.jp/odds/tfw/2005010101/"),
+        ]
+
+        # Execute
+        output = list(self.middleware.process_spider_output(denma_response, result, spider))
+
+        # Check
+        assert [r.url for r in output] == [
+            "https://keiba.yahoo.co.jp/directory/jocky/01167/",
+            "https://keiba.yahoo.co.jp/odds/tfw/2005010101/",
+        ]
+        assert self.crawler.stats.get_value("known_entity/skipped") == 1
+        assert self.crawler.stats.get_value("known_entity/refreshed") == 1
+
+    def test_item_not_scraped(self):
+        # Setup
+        spider = HorseRacingSpider()
+
+        # The page is parsed, but its item fails in the pipelines
+        horse_response = HtmlResponse("https://keiba.yahoo.co.jp/directory/horse/2017101602/", status=200)
+        list(self.middleware.process_spider_output(horse_response, [HorseItem(horse_id="2017101602")], spider))
+
+        result = [Request("https://keiba.yahoo.co.jp/directory/horse/2017101602/")]
+
+        # Execute
+        output = list(self.middleware.process_spider_output(HtmlResponse("https://keiba.yahoo.co.jp/race/denma/2005010101/"), result, spider))
+
+        # Check
+        assert len(output) == 1
+        assert self.crawler.stats.get_value("known_entity/refreshed") is None
+
+    def test_stale_entity(self):
+        # Setup
+        self.middleware.db.execute("insert into entity (url, refreshed_at) values (?, ?)", ("https://keiba.yahoo.co.jp/directory/horse/2017101602/", time.time() - 2 * 60 * 60))
+
+        result = [Request("https://keiba.yahoo.co.jp/directory/horse/2017101602/")]
+
+        # Execute
+        output = list(self.middleware.process_spider_output(HtmlResponse("https://keiba.yahoo.co.jp/race/denma/2005010101/"), result, HorseRacingSpider()))
+
+        # Check
+        assert len(output) == 1
+
+    def test_recache_horse(self):
+        # Setup
+        self.middleware.item_scraped(HorseItem(horse_id="2017101602"), HtmlResponse("https://keiba.yahoo.co.jp/directory/horse/2017101602/"), HorseRacingSpider())
+
+        result = [Request("https://keiba.yahoo.co.jp/directory/horse/2017101602/")]
+
+        # Execute
+        output = list(self.middleware.process_spider_output(HtmlResponse("https://keiba.yahoo.co.jp/race/denma/2005010101/"), result, HorseRacingSpider(recache_horse=True)))
+
+        # Check
+        assert len(output) == 1
+
+
+class TestAdaptiveConcurrencyMiddleware:
+    def setUp(self):
+        logging.disable(logging.DEBUG)
+
+        self.crawler = get_crawler(HorseRacingSpider, {
+            "DOWNLOAD_DELAY": 3,
+            "ADAPTIVE_CONCURRENCY_ENABLED": True,
+            "ADAPTIVE_CONCURRENCY_MAX": 3,
+            "ADAPTIVE_CONCURRENCY_INTERVAL": 0,
+            "ADAPTIVE_CONCURRENCY_MAX_RATE": 3.0,
+            "ADAPTIVE_CONCURRENCY_PATH_CLASSES": [
+                {"name": "odds", "pattern": "/odds/", "max_concurrency": 2, "min_delay": 1.0},
+                {"name": "directory", "pattern": "/directory/", "max_concurrency": 1, "min_delay": 3.0},
+            ],
+        })
+        self.crawler.engine = mock.Mock(downloader=Downloader(self.crawler))
+
+        self.middleware = AdaptiveConcurrencyMiddleware.from_crawler(self.crawler)
+
+    def test_process_request(self):
+        # Setup
+        request = Request("https://keiba.yahoo.co.jp/odds/tfw/2005010101/")
+
+        # Execute
+        self.middleware.process_request(request, None)
+
+        # Check
+        assert request.meta["download_slot"] == "keiba.yahoo.co.jp/odds"
+
+        # The two path classes share the 1 request / DOWNLOAD_DELAY of the site
+        slot = self.crawler.engine.downloader.slots["keiba.yahoo.co.jp/odds"]
+        assert slot.concurrency == 1
+        assert slot.delay == 6
+
+    def test_process_request_no_path_class(self):
+        # Setup
+        request = Request("https://keiba.yahoo.co.jp/schedule/list/")
+
+        # Execute
+        self.middleware.process_request(request, None)
+
+        # Check
+        assert "download_slot" not in request.meta
+
+    def test_increase_decrease(self):
+        # Setup
+        request = Request("https://keiba.yahoo.co.jp/odds/tfw/2005010101/")
+        self.middleware.process_request(request, None)
+        request.meta["download_latency"] = 0.1
+
+        slot = self.crawler.engine.downloader.slots["keiba.yahoo.co.jp/odds"]
+
+        # Execute
+        for _ in range(5):
+            self.middleware.process_response(request, HtmlResponse(request.url, status=200), None)
+
+        # Check
+        assert slot.delay == 1.0
+        assert slot.concurrency == 2
+        assert self.crawler.stats.get_value("adaptive/odds/increase") == 4
+        assert self.crawler.stats.get_value("adaptive/odds/concurrency") == 2
+
+        # Execute
+        self.middleware.process_response(request, HtmlResponse(request.url, status=503), None)
+
+        # Check
+        assert slot.concurrency == 1
+        assert self.crawler.stats.get_value("adaptive/odds/decrease") == 1
+        assert self.crawler.stats.get_value("adaptive/odds/errors") == 1
+
+    def test_increase_max_rate(self):
+        # Setup
+        self.middleware.max_rate = 0.5
+
+        request = Request("https://keiba.yahoo.co.jp/odds/tfw/2005010101/")
+        self.middleware.process_request(request, None)
+        request.meta["download_latency"] = 0.1
+
+        slot = self.crawler.engine.downloader.slots["keiba.yahoo.co.jp/odds"]
+
+        # Execute
+        for _ in range(3):
+            self.middleware.process_response(request, HtmlResponse(request.url, status=200), None)
+
+        # Check (1/3 + 1/6 requests per second, the directory class keeps its share)
+        assert slot.delay == 3
+        assert slot.concurrency == 1
+        assert self.crawler.stats.get_value("adaptive/odds/increase") == 1
+        assert self.crawler.stats.get_value("adaptive/odds/rate_limited") == 2
+
+    def test_default_max_rate(self):
+        # Setup
+        crawler = get_crawler(HorseRacingSpider, {
+            "DOWNLOAD_DELAY": 3,
+            "ADAPTIVE_CONCURRENCY_ENABLED": True,
+            "ADAPTIVE_CONCURRENCY_INTERVAL": 0,
+            "ADAPTIVE_CONCURRENCY_PATH_CLASSES": [
+                {"name": "odds", "pattern": "/odds/", "max_concurrency": 2, "min_delay": 1.0},
+                {"name": "directory", "pattern": "/directory/", "max_concurrency": 1, "min_delay": 3.0},
+            ],
+        })
+        crawler.engine = mock.Mock(downloader=Downloader(crawler))
+
+        middleware = AdaptiveConcurrencyMiddleware.from_crawler(crawler)
+
+        request = Request("https://keiba.yahoo.co.jp/odds/tfw/2005010101/")
+        middleware.process_request(request, None)
+        request.meta["download_latency"] = 0.1
+
+        # Execute
+        middleware.process_response(request, HtmlResponse(request.url, status=200), None)
+
+        # Check (the site stays at 1 request / DOWNLOAD_DELAY)
+        assert middleware.max_rate == 1 / 3
+        assert crawler.engine.downloader.slots["keiba.yahoo.co.jp/odds"].delay == 6
+        assert crawler.stats.get_value("adaptive/odds/rate_limited") == 1
+
+    def test_cached_response(self):
+        # Setup
+        request = Request("https://keiba.yahoo.co.jp/odds/tfw/2005010101/")
+        self.middleware.process_request(request, None)
+
+        # Execute
+        self.middleware.process_response(request, HtmlResponse(request.url, status=503, flags=["cached"]), None)
+
+        # Check
+        assert self.crawler.stats.get_value("adaptive/odds/errors") is None
+
+
+class TestCacheFreshnessPolicy:
+    def setUp(self):
+        logging.disable(logging.DEBUG)
+
+        self.policy = CacheFreshnessPolicy([
+            {"pattern": "/schedule/list/", "max_age": 6 * 60 * 60},
+            {"pattern": "/odds/", "max_age": 10 * 60},
+            {"pattern": "/race/result/", "max_age": 60 * 60, "final_delay": 60 * 60},
+        ], "Asia/Tokyo")
+
+        # 2020-02-01 10:00:00 JST
+        self.now = datetime(2020, 2, 1, 1, 0, 0, tzinfo=timezone.utc).timestamp()
+
+    def test_no_policy(self):
+        # Execute
+        result = self.policy.is_fresh(Request("https://keiba.yahoo.co.jp/directory/horse/2017101602/"), 0, now=self.now)
+
+        # Check
+        assert result
+
+    def test_max_age(self):
+        # Setup
+        request = Request("https://keiba.yahoo.co.jp/schedule/list/2020/?month=2")
+
+        # Execute / Check
+        assert self.policy.is_fresh(request, self.now - 5 * 60 * 60, now=self.now)
+        assert not self.policy.is_fresh(request, self.now - 7 * 60 * 60, now=self.now)
+        assert not self.policy.is_fresh(request, None, now=self.now)
+
+    def test_final_datetime(self):
+        # Setup
+        request = Request("https://keiba.yahoo.co.jp/odds/tfw/2008020101/", meta={"final_datetime": datetime(2020, 2, 1, 9, 50, 0)})
+
+        # Execute / Check
+        assert self.policy.is_fresh(request, self.now - 5 * 60, now=self.now)
+        assert not self.policy.is_fresh(request, self.now - 20 * 60, now=self.now)
+        assert self.policy.is_fresh(request, self.now - 5 * 60, now=self.now + 365 * 24 * 60 * 60)
+        assert not self.policy.is_fresh(request, self.now - 20 * 60, now=self.now + 365 * 24 * 60 * 60)
+
+    def test_final_delay(self):
+        # Setup
+        request = Request("https://keiba.yahoo.co.jp/race/result/2008020101/", meta={"final_datetime": datetime(2020, 2, 1, 9, 50, 0)})
+
+        # Execute / Check
+        assert not self.policy.is_fresh(request, self.now, now=self.now + 2 * 60 * 60)
+        assert self.policy.is_fresh(request, self.now + 60 * 60, now=self.now + 365 * 24 * 60 * 60)
+
+
+class TestSQLiteCacheTier:
+    def setUp(self):
+        logging.disable(logging.DEBUG)
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_get_put(self):
+        # Setup
+        tier = SQLiteCacheTier(os.path.join(self.tmp_dir.name, "cache.sqlite"), 1024)
+        tier.open()
+
+        # Execute
+        tier.put("a", b"aaa")
+
+        # Check
+        assert tier.get("a") == b"aaa"
+        assert tier.get("b") is None
+
+        tier.close()
+
+    def test_evict_least_recently_used(self):
+        # Setup
+        tier = SQLiteCacheTier(os.path.join(self.tmp_dir.name, "cache.sqlite"), 1000)
+        tier.open()
+
+        tier.put("a", b"a" * 300)
+        tier.put("b", b"b" * 300)
+        tier.put("c", b"c" * 300)
+        tier.get("a")
+
+        # Execute
+        tier.put("d", b"d" * 300)
+
+        # Check
+        assert tier.get("a") is not None
+        assert tier.get("b") is None
+        assert tier.get("c") is not None
+        assert tier.get("d") is not None
+        assert tier.total_size == 900
+
+        tier.close()
+
+
+class TestS3CacheStorage:
+    def setUp(self):
+        logging.disable(logging.DEBUG)
+
+        self.crawler = get_crawler(HorseRacingSpider, {
+            "S3_ENDPOINT": "http://s3:9000",
+            "S3_REGION": "us-east-1",
+            "S3_ACCESS_KEY": "access_key",
+            "S3_SECRET_KEY": "secret_key",
+            "S3_BUCKET": "bucket",
+            "S3_FOLDER": "cache",
+        })
+
+        self.storage = S3CacheStorage(self.crawler.settings)
+        self.storage.s3_client = mock.MagicMock()
+        self.storage.stats = self.crawler.stats
+        self.storage.local_tier = None
+
+    def test_retrieve_response_recache_race(self):
+        # Setup
+        spider = HorseRacingSpider.from_crawler(self.crawler, recache_race=True)
+
+        # Execute
+        response = self.storage.retrieve_response(spider, Request("https://keiba.yahoo.co.jp/race/denma/2005010101/"))
+
+        # Check
+        assert response is None
+        assert not self.storage.s3_client.get_object.called
+        assert self.crawler.stats.get_value("httpcache/recache") == 1
+
+    def test_retrieve_response_recache_race_directory(self):
+        # Setup
+        spider = HorseRacingSpider.from_crawler(self.crawler, recache_race=True)
+
+        data_obj = encode_record(200, "https://keiba.yahoo.co.jp/directory/horse/2017101602/", {b"Content-Type": [b"text/html"]}, b"<html></html>")
+        self.storage.s3_client.get_object.return_value = {"Body": io.BytesIO(data_obj)}
+
+        # Execute
+        response = self.storage.retrieve_response(spider, Request("https://keiba.yahoo.co.jp/directory/horse/2017101602/"))
+
+        # Check
+        assert response.body == b"<html></html>"
+        assert self.crawler.stats.get_value("httpcache/recache") is None
+        assert self.crawler.stats.get_value("httpcache/s3/hit") == 1
+
+    def test_prefetch(self):
+        # Setup
+        spider = HorseRacingSpider.from_crawler(self.crawler)
+
+        self.storage.executor = ThreadPoolExecutor(max_workers=1)
+        self.storage.prefetched = OrderedDict()
+        self.storage.prefetched_rpaths = OrderedDict()
+
+        data_obj = encode_record(200, "https://keiba.yahoo.co.jp/odds/tfw/2005010101/", {}, b"<html></html>")
+        self.storage.s3_client.get_object.return_value = {"Body": io.BytesIO(data_obj)}
+
+        request = Request("https://keiba.yahoo.co.jp/odds/tfw/2005010101/")
+
+        # Execute
+        self.storage.prefetch(spider, request)
+        self.storage.prefetch(spider, request)
+
+        # Check
+        assert len(self.storage.prefetched) == 1
+
+        stored_at, data = list(self.storage.prefetched.values())[0].result()
+        assert data["body"] == b"<html></html>"
+        assert self.storage.s3_client.get_object.call_count == 1
+        assert self.crawler.stats.get_value("httpcache/prefetch/submitted") == 1
+
+        self.storage.executor.shutdown()
+
+    @mock.patch("investment_horse_racing_crawler.scrapy.middlewares.reactor")
+    def test_store_response_backpressure(self, reactor):
+        # Setup
+        reactor.callFromThread.side_effect = lambda f, *args: f(*args)
+
+        spider = HorseRacingSpider.from_crawler(self.crawler)
+
+        self.storage.executor = ThreadPoolExecutor(max_workers=1)
+        self.storage.pending_stores = defer.DeferredSemaphore(1)
+
+        # The first store is held in S3
+        put_resumed = threading.Event()
+        self.storage.s3_client.put_object.side_effect = lambda **kwargs: put_resumed.wait(5.0)
+
+        responses = [HtmlResponse(f"https://keiba.yahoo.co.jp/race/denma/200501010{i}/", body=b"<html></html>") for i in range(1, 3)]
+
+        # Execute
+        d1 = self.storage.store_response_deferred(spider, Request(responses[0].url), responses[0])
+        d2 = self.storage.store_response_deferred(spider, Request(responses[1].url), responses[1])
+
+        # Check (the second store waits without blocking)
+        assert d1.called
+        assert not d2.called
+        assert self.crawler.stats.get_value("httpcache/store_backpressure") == 1
+
+        # Execute (2)
+        put_resumed.set()
+
+        # Check
+        deadline = time.monotonic() + 5.0
+        while not d2.called:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+        self.storage.executor.shutdown()
+
+        assert self.storage.s3_client.put_object.call_count == 2
+        assert self.crawler.stats.get_value("httpcache/store_errors") is None
+
+    def test_retrieve_response_archive(self):
+        # Setup
+        spider = HorseRacingSpider.from_crawler(self.crawler)
+        request = Request("https://keiba.yahoo.co.jp/race/denma/2005010101/")
+
+        f = io.BytesIO()
+        writer = CacheArchiveWriter(f)
+        writer.add(request_fingerprint(request), encode_record(200, request.url, {}, b"<html>archived</html>"))
+        writer.close()
+
+        archive_obj = f.getvalue()
+        self.storage.archives = CacheArchiveSet()
+        reader = mock.Mock(read=lambda offset, length: archive_obj[offset:offset + length])
+        other_reader = mock.Mock()
+        self.storage.archives.add("2020-01", lambda: reader, len(archive_obj))
+        self.storage.archives.add("2005-01", lambda: other_reader, len(archive_obj))
+
+        # Execute
+        response = self.storage.retrieve_response(spider, request)
+
+        # Check
+        assert response.body == b"<html>archived</html>"
+        assert not self.storage.s3_client.get_object.called
+        assert self.crawler.stats.get_value("httpcache/archive/hit") == 1
+
+        # The archive of another year is not opened
+        assert not other_reader.read.called
+        assert self.storage.archives.archives["2005-01"].index is None
+
+    def test_get_archive_months(self):
+        # Setup
+        self.storage.archives = CacheArchiveSet()
+        for month in ["2019-11", "2019-12", "2020-01"]:
+            self.storage.archives.add(month, None, 0)
+
+        # Execute / Check
+        assert self.storage._get_archive_months(Request("https://keiba.yahoo.co.jp/schedule/list/2019/?month=2")) == ["2019-02"]
+        assert sorted(self.storage._get_archive_months(Request("https://keiba.yahoo.co.jp/race/list/19060502/"))) == ["2019-11", "2019-12"]
+        assert self.storage._get_archive_months(Request("https://keiba.yahoo.co.jp/odds/tfw/2005010101/")) == ["2020-01"]
+        assert self.storage._get_archive_months(Request("https://keiba.yahoo.co.jp/directory/horse/2017101602/")) == []
+
+    def test_retrieve_response_legacy_record_rejected(self):
+        # Setup
+        spider = HorseRacingSpider.from_crawler(self.crawler)
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.storage.local_tier = SQLiteCacheTier(os.path.join(tmp_dir.name, "cache.sqlite"), 1024 * 1024)
+        self.storage.local_tier.open()
+
+        request = Request("https://keiba.yahoo.co.jp/directory/horse/2017101602/")
+        legacy_data = {"status": 200, "url": request.url, "headers": {}, "body": b"<html>legacy</html>"}
+        self.storage.local_tier.put(self.storage._get_request_path(spider, request), pickle.dumps(legacy_data))
+        self.storage.s3_client.get_object.return_value = {"Body": io.BytesIO(pickle.dumps(legacy_data)), "LastModified": datetime.now(timezone.utc)}
+
+        # Execute
+        with mock.patch("investment_horse_racing_crawler.scrapy.cache_record.pickle.loads") as loads:
+            response = self.storage.retrieve_response(spider, request)
+
+        # Check (never unpickled, and refetched as a cache miss)
+        assert response is None
+        assert not loads.called
+        assert self.crawler.stats.get_value("httpcache/local/legacy_rejected") == 1
+        assert self.crawler.stats.get_value("httpcache/s3/legacy_rejected") == 1
+
+        self.storage.local_tier.close()
+        tmp_dir.cleanup()
+
+    def test_retrieve_response_legacy_local_record(self):
+        # Setup
+        spider = HorseRacingSpider.from_crawler(self.crawler)
+        self.storage.allow_legacy = True
+        self.storage.freshness_policy = CacheFreshnessPolicy([{"pattern": "/race/denma/", "max_age": 60 * 60}], "Asia/Tokyo")
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.storage.local_tier = SQLiteCacheTier(os.path.join(tmp_dir.name, "cache.sqlite"), 1024 * 1024)
+        self.storage.local_tier.open()
+
+        legacy_request = Request("https://keiba.yahoo.co.jp/race/denma/2005010101/")
+        migrated_request = Request("https://keiba.yahoo.co.jp/race/denma/2005010102/")
+
+        legacy_data = {"status": 200, "url": legacy_request.url, "headers": {}, "body": b"<html>legacy</html>"}
+        self.storage.local_tier.put(self.storage._get_request_path(spider, legacy_request), pickle.dumps(legacy_data))
+        self.storage.local_tier.put(self.storage._get_request_path(spider, migrated_request), encode_record(200, migrated_request.url, {}, b"<html>migrated</html>", 0))
+
+        # The S3 records were uploaded a minute ago
+        last_modified = datetime.fromtimestamp(time.time() - 60, timezone.utc)
+        self.storage.s3_client.get_object.side_effect = [
+            {"Body": io.BytesIO(pickle.dumps(legacy_data)), "LastModified": last_modified},
+            {"Body": io.BytesIO(encode_record(200, migrated_request.url, {}, b"<html>migrated</html>")), "LastModified": last_modified},
+        ]
+
+        # Execute
+        legacy_response = self.storage.retrieve_response(spider, legacy_request)
+        migrated_response = self.storage.retrieve_response(spider, migrated_request)
+
+        # Check
+        assert legacy_response.body == b"<html>legacy</html>"
+        assert migrated_response.body == b"<html>migrated</html>"
+        assert self.storage.s3_client.get_object.call_count == 2
+        assert self.crawler.stats.get_value("httpcache/local/stale") == 2
+        assert self.crawler.stats.get_value("httpcache/s3/hit") == 2
+
+        # The local copy of the legacy record is stamped with the upload time, so the next lookup is a local hit
+        assert get_stored_at(self.storage.local_tier.get(self.storage._get_request_path(spider, legacy_request))) == last_modified.timestamp()
+
+        assert self.storage.retrieve_response(spider, legacy_request).body == b"<html>legacy</html>"
+        assert self.storage.s3_client.get_object.call_count == 2
+        assert self.crawler.stats.get_value("httpcache/local/hit") == 1
+
+        self.storage.local_tier.close()
+        tmp_dir.cleanup()
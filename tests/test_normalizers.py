@@ -0,0 +1,123 @@
+from datetime import datetime
+import pickle
+
+from scrapy.exceptions import DropItem
+
+from investment_horse_racing_crawler.scrapy.items import RacePayoffItem, HorseItem, OddsWinPlaceItem
+from investment_horse_racing_crawler.scrapy.normalizers import NormalizedItem, normalize_item, normalize_values
+
+
+class TestNormalizers:
+    def test_normalize_race_payoff_item(self):
+        # Setup
+        item = RacePayoffItem()
+        item["race_id"] = '1906050201'
+        item["payoff_type"] = '3連単'
+        item["horse_number"] = '12－7－9'
+        item["odds"] = '14,480円'
+        item["favorite_order"] = '41番人気'
+
+        # Execute
+        new_item, rows = normalize_item(item)
+
+        # Check
+        assert new_item["payoff_type"] == "trifecta"
+        assert new_item["horse_number_1"] == 12
+        assert new_item["horse_number_2"] == 7
+        assert new_item["horse_number_3"] == 9
+        assert new_item["odds"] == 144.8
+        assert new_item["favorite_order"] == 41
+
+        assert rows == [("race_payoff", ("1906050201_trifecta_12_7_9", "1906050201", "trifecta", 12, 7, 9, 144.8, 41))]
+
+    def test_normalize_race_payoff_item_unknown_payoff_type(self):
+        # Setup
+        item = RacePayoffItem()
+        item["race_id"] = '1906050201'
+        item["payoff_type"] = 'WIN5'
+        item["horse_number"] = '1'
+        item["odds"] = '100円'
+        item["favorite_order"] = '1番人気'
+
+        # Execute
+        try:
+            normalize_item(item)
+
+            assert False
+        except DropItem:
+            pass
+
+    def test_normalize_horse_item(self):
+        # Setup
+        item = HorseItem()
+        item["horse_id"] = '2017101602'
+        item["gender"] = ' 牡 | 登録抹消 '
+        item["name"] = 'エアアルマス'
+        item["birthday"] = '2015年3月1日'
+        item["coat_color"] = '栗毛'
+        item["trainer_id"] = '/directory/trainer/01012/'
+        item["owner"] = 'ラッキーフィールド'
+        item["breeding_farm"] = '社台ファーム'
+
+        # Execute
+        new_item, rows = normalize_item(item)
+
+        # Check
+        assert new_item["gender"] == "牡"
+        assert new_item["birthday"] == datetime(2015, 3, 1, 0, 0, 0)
+        assert new_item["trainer_id"] == "01012"
+        assert new_item["breeder"] is None
+
+        assert rows == [("horse", ("2017101602", "牡", "エアアルマス", datetime(2015, 3, 1, 0, 0, 0), "栗毛", "01012", "ラッキーフィールド", None, "社台ファーム"))]
+
+    def test_normalize_odds_item(self):
+        # Setup
+        item = OddsWinPlaceItem()
+        item["race_id"] = '1906050201'
+        item["horse_number"] = '1'
+        item["horse_id"] = '/directory/horse/2017101602/'
+        item["odds_win"] = '****'
+        item["odds_place_min"] = '26.0'
+
+        # Execute
+        new_item, rows = normalize_item(item)
+
+        # Check
+        assert new_item["win"]["odds"] is None
+        assert new_item["place"]["odds_min"] == 26.0
+        assert new_item["place"]["odds_max"] is None
+
+        assert rows == [
+            ("odds_win", ("1906050201_1", "1906050201", 1, "2017101602", None)),
+            ("odds_place", ("1906050201_1", "1906050201", 1, "2017101602", 26.0, None)),
+        ]
+
+    def test_normalize_unknown_item(self):
+        # Execute
+        try:
+            normalize_item({"race_id": '1906050201'})
+
+            assert False
+        except DropItem:
+            pass
+
+    def test_normalize_values(self):
+        # Setup
+        values = {
+            "race_id": '1906050201',
+            "horse_number": '1',
+            "horse_id": '/directory/horse/2017101602/',
+            "odds_win": '161.2',
+        }
+
+        # Execute
+        normalized = normalize_values(OddsWinPlaceItem, values)
+
+        # Check
+        assert isinstance(normalized, NormalizedItem)
+        assert normalized.item["win"]["odds"] == 161.2
+        assert normalized.rows[0] == ("odds_win", ("1906050201_1", "1906050201", 1, "2017101602", 161.2))
+
+        # The item class name survives the trip back from a worker process
+        assert normalized.item.item_type == "OddsWinPlaceItem"
+        assert pickle.loads(pickle.dumps(normalized)).item.item_type == "OddsWinPlaceItem"
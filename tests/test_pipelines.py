@@ -1,13 +1,41 @@
 import logging
 from datetime import datetime
 import os
+import queue
+import threading
+import time
+from unittest import mock
+
+import psycopg2
 
 from scrapy.crawler import Crawler
-from scrapy.exceptions import DropItem
+from scrapy.exceptions import DropItem, NotConfigured
+from twisted.internet import defer
 
 from investment_horse_racing_crawler.scrapy.spiders.horse_racing_spider import HorseRacingSpider
 from investment_horse_racing_crawler.scrapy.items import RaceInfoItem, RacePayoffItem, RaceResultItem, RaceDenmaItem, HorseItem, TrainerItem, JockeyItem, OddsWinPlaceItem
-from investment_horse_racing_crawler.scrapy.pipelines import PostgreSQLPipeline
+from investment_horse_racing_crawler.scrapy.normalizers import NormalizedItem
+from investment_horse_racing_crawler.scrapy.pipelines import PostgreSQLPipeline, ProcessPoolNormalizePipeline
+from investment_horse_racing_crawler.scrapy.scheduler import scheduler_checkpoint
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def create_trainer_item(trainer_id):
+    item = TrainerItem()
+    item["trainer_id"] = trainer_id
+    item["name_kana"] = 'たかはし よしただ'
+    item["name"] = '高橋 義忠'
+    item["birthday"] = '1968年7月1日'
+    item["belong_to"] = '栗東'
+    item["first_licensing_year"] = '2008年'
+
+    return item
 
 
 class TestPostgreSQLPipeline:
@@ -44,16 +72,16 @@ class TestPostgreSQLPipeline:
     def test_process_race_info_item(self):
         # Setup
         item = RaceInfoItem()
-        item["race_id"] = ['2010010212']
-        item["race_round"] = ['12R']
-        item["start_date"] = ['2020年1月19日（日） ']
-        item["start_time"] = [' 16:01発走']
-        item["place_name"] = [' 1回小倉2日 ']
-        item["race_name"] = ['\n呼子特別']
-        item["course_type_length"] = ['芝・右 2600m ']
-        item["weather"] = ['曇']
-        item["course_condition"] = ['重']
-        item["added_money"] = [' 本賞金：1060、420、270、160、106万円 ']
+        item["race_id"] = '2010010212'
+        item["race_round"] = '12R'
+        item["start_date"] = '2020年1月19日（日） '
+        item["start_time"] = ' 16:01発走'
+        item["place_name"] = ' 1回小倉2日 '
+        item["race_name"] = '\n呼子特別'
+        item["course_type_length"] = '芝・右 2600m '
+        item["weather"] = '曇'
+        item["course_condition"] = '重'
+        item["added_money"] = ' 本賞金：1060、420、270、160、106万円 '
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_info")
@@ -116,11 +144,11 @@ class TestPostgreSQLPipeline:
     def test_process_race_payoff_item_1(self):
         # Setup
         item = RacePayoffItem()
-        item["race_id"] = ['2010010212']
-        item["payoff_type"] = ['単勝']
-        item["horse_number"] = ['4']
-        item["odds"] = ['1,360円']
-        item["favorite_order"] = ['7番人気']
+        item["race_id"] = '2010010212'
+        item["payoff_type"] = '単勝'
+        item["horse_number"] = '4'
+        item["odds"] = '1,360円'
+        item["favorite_order"] = '7番人気'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_payoff")
@@ -176,11 +204,11 @@ class TestPostgreSQLPipeline:
     def test_process_race_payoff_item_2(self):
         # Setup
         item = RacePayoffItem()
-        item["race_id"] = ['2010010212']
-        item["payoff_type"] = ['複勝']
-        item["horse_number"] = ['7']
-        item["odds"] = ['310円']
-        item["favorite_order"] = ['6番人気']
+        item["race_id"] = '2010010212'
+        item["payoff_type"] = '複勝'
+        item["horse_number"] = '7'
+        item["odds"] = '310円'
+        item["favorite_order"] = '6番人気'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_payoff")
@@ -236,10 +264,10 @@ class TestPostgreSQLPipeline:
     def test_process_race_payoff_item_3(self):
         # Setup
         item = RacePayoffItem()
-        item["favorite_order"] = ['-番人気']
-        item["odds"] = ['円']
-        item["payoff_type"] = ['複勝']
-        item["race_id"] = ['9002020101']
+        item["favorite_order"] = '-番人気'
+        item["odds"] = '円'
+        item["payoff_type"] = '複勝'
+        item["race_id"] = '9002020101'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_payoff")
@@ -260,11 +288,11 @@ class TestPostgreSQLPipeline:
     def test_process_race_payoff_item_4(self):
         # Setup
         item = RacePayoffItem()
-        item["favorite_order"] = ['-番人気']
-        item["horse_number"] = ['2']
-        item["odds"] = ['1,630円']
-        item["payoff_type"] = ['単勝']
-        item["race_id"] = ['1702020412']
+        item["favorite_order"] = '-番人気'
+        item["horse_number"] = '2'
+        item["odds"] = '1,630円'
+        item["payoff_type"] = '単勝'
+        item["race_id"] = '1702020412'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_payoff")
@@ -320,11 +348,11 @@ class TestPostgreSQLPipeline:
     def test_process_race_payoff_item_5(self):
         # Setup
         item = RacePayoffItem()
-        item["race_id"] = ['1906050201']
-        item["payoff_type"] = ['枠連']
-        item["horse_number"] = ['4－6']
-        item["odds"] = ['540円']
-        item["favorite_order"] = ['3番人気']
+        item["race_id"] = '1906050201'
+        item["payoff_type"] = '枠連'
+        item["horse_number"] = '4－6'
+        item["odds"] = '540円'
+        item["favorite_order"] = '3番人気'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_payoff")
@@ -380,11 +408,11 @@ class TestPostgreSQLPipeline:
     def test_process_race_payoff_item_6(self):
         # Setup
         item = RacePayoffItem()
-        item["race_id"] = ['1906050201']
-        item["payoff_type"] = ['馬連']
-        item["horse_number"] = ['7－12']
-        item["odds"] = ['1,290円']
-        item["favorite_order"] = ['5番人気']
+        item["race_id"] = '1906050201'
+        item["payoff_type"] = '馬連'
+        item["horse_number"] = '7－12'
+        item["odds"] = '1,290円'
+        item["favorite_order"] = '5番人気'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_payoff")
@@ -440,11 +468,11 @@ class TestPostgreSQLPipeline:
     def test_process_race_payoff_item_7(self):
         # Setup
         item = RacePayoffItem()
-        item["race_id"] = ['1906050201']
-        item["payoff_type"] = ['ワイド']
-        item["horse_number"] = ['7－8']
-        item["odds"] = ['370円']
-        item["favorite_order"] = ['3番人気']
+        item["race_id"] = '1906050201'
+        item["payoff_type"] = 'ワイド'
+        item["horse_number"] = '7－8'
+        item["odds"] = '370円'
+        item["favorite_order"] = '3番人気'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_payoff")
@@ -500,11 +528,11 @@ class TestPostgreSQLPipeline:
     def test_process_race_payoff_item_8(self):
         # Setup
         item = RacePayoffItem()
-        item["race_id"] = ['1906050201']
-        item["payoff_type"] = ['馬単']
-        item["horse_number"] = ['12－7']
-        item["odds"] = ['2,380円']
-        item["favorite_order"] = ['9番人気']
+        item["race_id"] = '1906050201'
+        item["payoff_type"] = '馬単'
+        item["horse_number"] = '12－7'
+        item["odds"] = '2,380円'
+        item["favorite_order"] = '9番人気'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_payoff")
@@ -560,11 +588,11 @@ class TestPostgreSQLPipeline:
     def test_process_race_payoff_item_9(self):
         # Setup
         item = RacePayoffItem()
-        item["race_id"] = ['1906050201']
-        item["payoff_type"] = ['3連複']
-        item["horse_number"] = ['7－8－12']
-        item["odds"] = ['1,770円']
-        item["favorite_order"] = ['4番人気']
+        item["race_id"] = '1906050201'
+        item["payoff_type"] = '3連複'
+        item["horse_number"] = '7－8－12'
+        item["odds"] = '1,770円'
+        item["favorite_order"] = '4番人気'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_payoff")
@@ -620,11 +648,11 @@ class TestPostgreSQLPipeline:
     def test_process_race_payoff_item_10(self):
         # Setup
         item = RacePayoffItem()
-        item["race_id"] = ['1906050201']
-        item["payoff_type"] = ['3連単']
-        item["horse_number"] = ['12－7－8']
-        item["odds"] = ['10,420円']
-        item["favorite_order"] = ['24番人気']
+        item["race_id"] = '1906050201'
+        item["payoff_type"] = '3連単'
+        item["horse_number"] = '12－7－8'
+        item["odds"] = '10,420円'
+        item["favorite_order"] = '24番人気'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_payoff")
@@ -680,22 +708,22 @@ class TestPostgreSQLPipeline:
     def test_process_race_result_item_1(self):
         # Setup
         item = RaceResultItem()
-        item["race_id"] = ['2010010212']
-        item["result"] = ['\n1  ']
-        item["bracket_number"] = ['3']
-        item["horse_number"] = ['\n4  ']
-        item["horse_id"] = ['/directory/horse/2015104408/']
-        item["horse_name"] = ['ワセダインブルー']
-        item["horse_gender_age"] = ['\n牡5/442(-6)/    ']
-        item["horse_weight_and_diff"] = ['\n牡5/442(-6)/    ']
-        item["arrival_time"] = ['\n2.43.6']
-        item["jockey_id"] = ['/directory/jocky/01143/']
-        item["jockey_name"] = ['原田 和真']
-        item["jockey_weight"] = ['57.0']
-        item["favorite_order"] = ['\n7    ']
-        item["odds"] = ['(13.6)']
-        item["trainer_id"] = ['/directory/trainer/01132/']
-        item["trainer_name"] = ['金成 貴史']
+        item["race_id"] = '2010010212'
+        item["result"] = '\n1  '
+        item["bracket_number"] = '3'
+        item["horse_number"] = '\n4  '
+        item["horse_id"] = '/directory/horse/2015104408/'
+        item["horse_name"] = 'ワセダインブルー'
+        item["horse_gender_age"] = '\n牡5/442(-6)/    '
+        item["horse_weight_and_diff"] = '\n牡5/442(-6)/    '
+        item["arrival_time"] = '\n2.43.6'
+        item["jockey_id"] = '/directory/jocky/01143/'
+        item["jockey_name"] = '原田 和真'
+        item["jockey_weight"] = '57.0'
+        item["favorite_order"] = '\n7    '
+        item["odds"] = '(13.6)'
+        item["trainer_id"] = '/directory/trainer/01132/'
+        item["trainer_name"] = '金成 貴史'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_result")
@@ -774,22 +802,22 @@ class TestPostgreSQLPipeline:
     def test_process_race_result_item_2(self):
         # Setup
         item = RaceResultItem()
-        item["race_id"] = ['2010010212']
-        item["result"] = ['\n4  ']
-        item["bracket_number"] = ['8']
-        item["horse_number"] = ['\n13  ']
-        item["horse_id"] = ['/directory/horse/2015106286/']
-        item["horse_name"] = ['サダムラピュタ']
-        item["horse_gender_age"] = ['\nせん5/478(+10)/B    ']
-        item["horse_weight_and_diff"] = ['\nせん5/478(+10)/B    ']
-        item["arrival_time"] = ['\n2.44.9']
-        item["jockey_id"] = ['/directory/jocky/01154/']
-        item["jockey_name"] = ['松若 風馬']
-        item["jockey_weight"] = ['57.0']
-        item["favorite_order"] = ['\n3    ']
-        item["odds"] = ['(6.9)']
-        item["trainer_id"] = ['/directory/trainer/01082/']
-        item["trainer_name"] = ['平田 修']
+        item["race_id"] = '2010010212'
+        item["result"] = '\n4  '
+        item["bracket_number"] = '8'
+        item["horse_number"] = '\n13  '
+        item["horse_id"] = '/directory/horse/2015106286/'
+        item["horse_name"] = 'サダムラピュタ'
+        item["horse_gender_age"] = '\nせん5/478(+10)/B    '
+        item["horse_weight_and_diff"] = '\nせん5/478(+10)/B    '
+        item["arrival_time"] = '\n2.44.9'
+        item["jockey_id"] = '/directory/jocky/01154/'
+        item["jockey_name"] = '松若 風馬'
+        item["jockey_weight"] = '57.0'
+        item["favorite_order"] = '\n3    '
+        item["odds"] = '(6.9)'
+        item["trainer_id"] = '/directory/trainer/01082/'
+        item["trainer_name"] = '平田 修'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_result")
@@ -866,22 +894,22 @@ class TestPostgreSQLPipeline:
     def test_process_race_result_item_3(self):
         # Setup
         item = RaceResultItem()
-        item["arrival_time"] = ['\n1.12.2']
-        item["bracket_number"] = ['2']
-        item["favorite_order"] = ['\n5    ']
-        item["horse_gender_age"] = ['\n牡3/466(+2)/    ']
-        item["horse_id"] = ['/directory/horse/2017104069/']
-        item["horse_name"] = ['メモワールミノル']
-        item["horse_number"] = ['\n3  ']
-        item["horse_weight_and_diff"] = ['\n牡3/466(+2)/    ']
-        item["jockey_id"] = ['/directory/jocky/01179/']
-        item["jockey_name"] = ['菅原 明良']
-        item["jockey_weight"] = ['△54.0']
-        item["odds"] = ['(8.3)']
-        item["race_id"] = ['2006010201']
-        item["result"] = ['\n1  ']
-        item["trainer_id"] = ['/directory/trainer/01153/']
-        item["trainer_name"] = ['中舘 英二']
+        item["arrival_time"] = '\n1.12.2'
+        item["bracket_number"] = '2'
+        item["favorite_order"] = '\n5    '
+        item["horse_gender_age"] = '\n牡3/466(+2)/    '
+        item["horse_id"] = '/directory/horse/2017104069/'
+        item["horse_name"] = 'メモワールミノル'
+        item["horse_number"] = '\n3  '
+        item["horse_weight_and_diff"] = '\n牡3/466(+2)/    '
+        item["jockey_id"] = '/directory/jocky/01179/'
+        item["jockey_name"] = '菅原 明良'
+        item["jockey_weight"] = '△54.0'
+        item["odds"] = '(8.3)'
+        item["race_id"] = '2006010201'
+        item["result"] = '\n1  '
+        item["trainer_id"] = '/directory/trainer/01153/'
+        item["trainer_name"] = '中舘 英二'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_result")
@@ -958,22 +986,22 @@ class TestPostgreSQLPipeline:
     def test_process_race_result_item_4(self):
         # Setup
         item = RaceResultItem()
-        item["arrival_time"] = ['\n1.12.4']
-        item["bracket_number"] = ['3']
-        item["favorite_order"] = ['\n9    ']
-        item["horse_gender_age"] = ['\n牡3/460(+6)/    ']
-        item["horse_id"] = ['/directory/horse/2017101489/']
-        item["horse_name"] = ['ドラゴンズバック']
-        item["horse_number"] = ['\n6  ']
-        item["horse_weight_and_diff"] = ['\n牡3/460(+6)/    ']
-        item["jockey_id"] = ['/directory/jocky/01164/']
-        item["jockey_name"] = ['藤田 菜七子']
-        item["jockey_weight"] = ['▲53.0']
-        item["odds"] = ['(21.8)']
-        item["race_id"] = ['2006010201']
-        item["result"] = ['\n2  ']
-        item["trainer_id"] = ['/directory/trainer/01031/']
-        item["trainer_name"] = ['伊藤 伸一']
+        item["arrival_time"] = '\n1.12.4'
+        item["bracket_number"] = '3'
+        item["favorite_order"] = '\n9    '
+        item["horse_gender_age"] = '\n牡3/460(+6)/    '
+        item["horse_id"] = '/directory/horse/2017101489/'
+        item["horse_name"] = 'ドラゴンズバック'
+        item["horse_number"] = '\n6  '
+        item["horse_weight_and_diff"] = '\n牡3/460(+6)/    '
+        item["jockey_id"] = '/directory/jocky/01164/'
+        item["jockey_name"] = '藤田 菜七子'
+        item["jockey_weight"] = '▲53.0'
+        item["odds"] = '(21.8)'
+        item["race_id"] = '2006010201'
+        item["result"] = '\n2  '
+        item["trainer_id"] = '/directory/trainer/01031/'
+        item["trainer_name"] = '伊藤 伸一'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_result")
@@ -1050,22 +1078,22 @@ class TestPostgreSQLPipeline:
     def test_process_race_result_item_5(self):
         # Setup
         item = RaceResultItem()
-        item["arrival_time"] = ['\n']
-        item["bracket_number"] = ['2']
-        item["favorite_order"] = ['\n     ']
-        item["horse_gender_age"] = ['\n牝5/ - ( - )/    ']
-        item["horse_id"] = ['/directory/horse/2015102358/']
-        item["horse_name"] = ['イチザティアラ']
-        item["horse_number"] = ['\n2  ']
-        item["horse_weight_and_diff"] = ['\n牝5/ - ( - )/    ']
-        item["jockey_id"] = ['/directory/jocky/00894/']
-        item["jockey_name"] = ['小牧 太']
-        item["jockey_weight"] = ['55.0']
-        item["odds"] = ['( - )']
-        item["race_id"] = ['2008010104']
-        item["result"] = ['\n', '  ']
-        item["trainer_id"] = ['/directory/trainer/01040/']
-        item["trainer_name"] = ['服部 利之']
+        item["arrival_time"] = '\n'
+        item["bracket_number"] = '2'
+        item["favorite_order"] = '\n     '
+        item["horse_gender_age"] = '\n牝5/ - ( - )/    '
+        item["horse_id"] = '/directory/horse/2015102358/'
+        item["horse_name"] = 'イチザティアラ'
+        item["horse_number"] = '\n2  '
+        item["horse_weight_and_diff"] = '\n牝5/ - ( - )/    '
+        item["jockey_id"] = '/directory/jocky/00894/'
+        item["jockey_name"] = '小牧 太'
+        item["jockey_weight"] = '55.0'
+        item["odds"] = '( - )'
+        item["race_id"] = '2008010104'
+        item["result"] = '\n'
+        item["trainer_id"] = '/directory/trainer/01040/'
+        item["trainer_name"] = '服部 利之'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_result")
@@ -1142,22 +1170,22 @@ class TestPostgreSQLPipeline:
     def test_process_race_result_item_6(self):
         # Setup
         item = RaceResultItem()
-        item["arrival_time"] = ['\n55.4']
-        item["bracket_number"] = ['7']
-        item["favorite_order"] = ['\n4    ']
-        item["horse_gender_age"] = ['\n牝5/470(+6)/    ']
-        item["horse_id"] = ['/directory/horse/2014102003/']
-        item["horse_name"] = ['ブリッジオーヴァー']
-        item["horse_number"] = ['\n15  ']
-        item["horse_weight_and_diff"] = ['\n牝5/470(+6)/    ']
-        item["jockey_id"] = ['/directory/jocky/01178/']
-        item["jockey_name"] = ['斎藤 新']
-        item["jockey_weight"] = ['52.0']
-        item["odds"] = ['(8.6)']
-        item["race_id"] = ['1904030412']
-        item["result"] = ['\n1  ']
-        item["trainer_id"] = ['/directory/trainer/01164/']
-        item["trainer_name"] = ['安田 翔伍']
+        item["arrival_time"] = '\n55.4'
+        item["bracket_number"] = '7'
+        item["favorite_order"] = '\n4    '
+        item["horse_gender_age"] = '\n牝5/470(+6)/    '
+        item["horse_id"] = '/directory/horse/2014102003/'
+        item["horse_name"] = 'ブリッジオーヴァー'
+        item["horse_number"] = '\n15  '
+        item["horse_weight_and_diff"] = '\n牝5/470(+6)/    '
+        item["jockey_id"] = '/directory/jocky/01178/'
+        item["jockey_name"] = '斎藤 新'
+        item["jockey_weight"] = '52.0'
+        item["odds"] = '(8.6)'
+        item["race_id"] = '1904030412'
+        item["result"] = '\n1  '
+        item["trainer_id"] = '/directory/trainer/01164/'
+        item["trainer_name"] = '安田 翔伍'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_result")
@@ -1234,21 +1262,21 @@ class TestPostgreSQLPipeline:
     def test_process_race_result_item_7(self):
         # Setup
         item = RaceResultItem()
-        item["arrival_time"] = ['\n1.44.2']
-        item["bracket_number"] = ['5']
-        item["favorite_order"] = ['\n4    ']
-        item["horse_gender_age"] = ['\n牝4/446(+4)/    ']
-        item["horse_id"] = ['/directory/horse/1988100963/']
-        item["horse_name"] = ['ジャストフォーユウ']
-        item["horse_number"] = ['\n5  ']
-        item["horse_weight_and_diff"] = ['\n牝4/446(+4)/    ']
-        item["jockey_id"] = ['/directory/jocky/00673/']
-        item["jockey_name"] = ['岸 滋彦']
-        item["jockey_weight"] = ['53.0']
-        item["race_id"] = ['9110040707']
-        item["result"] = ['\n1  ']
-        item["trainer_id"] = ['/directory/trainer/00375/']
-        item["trainer_name"] = ['野村 彰彦']
+        item["arrival_time"] = '\n1.44.2'
+        item["bracket_number"] = '5'
+        item["favorite_order"] = '\n4    '
+        item["horse_gender_age"] = '\n牝4/446(+4)/    '
+        item["horse_id"] = '/directory/horse/1988100963/'
+        item["horse_name"] = 'ジャストフォーユウ'
+        item["horse_number"] = '\n5  '
+        item["horse_weight_and_diff"] = '\n牝4/446(+4)/    '
+        item["jockey_id"] = '/directory/jocky/00673/'
+        item["jockey_name"] = '岸 滋彦'
+        item["jockey_weight"] = '53.0'
+        item["race_id"] = '9110040707'
+        item["result"] = '\n1  '
+        item["trainer_id"] = '/directory/trainer/00375/'
+        item["trainer_name"] = '野村 彰彦'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_result")
@@ -1324,15 +1352,15 @@ class TestPostgreSQLPipeline:
     def test_process_race_denma_item_1(self):
         # Setup
         item = RaceDenmaItem()
-        item["bracket_number"] = ['1']
-        item["horse_id"] = ['/directory/horse/2017100081/']
-        item["horse_number"] = ['2']
-        item["horse_weight_and_diff"] = ['\n488(+12)\n']
-        item["jockey_id"] = ['/directory/jocky/01077/']
-        item["jockey_weight"] = ['55.0 ']
-        item["prize_total_money"] = ['\n280万']
-        item["race_id"] = ['1906050201']
-        item["trainer_id"] = ['/directory/trainer/01106/']
+        item["bracket_number"] = '1'
+        item["horse_id"] = '/directory/horse/2017100081/'
+        item["horse_number"] = '2'
+        item["horse_weight_and_diff"] = '\n488(+12)\n'
+        item["jockey_id"] = '/directory/jocky/01077/'
+        item["jockey_weight"] = '55.0 '
+        item["prize_total_money"] = '\n280万'
+        item["race_id"] = '1906050201'
+        item["trainer_id"] = '/directory/trainer/01106/'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_denma")
@@ -1397,15 +1425,15 @@ class TestPostgreSQLPipeline:
     def test_process_race_denma_item_2(self):
         # Setup
         item = RaceDenmaItem()
-        item["bracket_number"] = ['2']
-        item["horse_id"] = ['/directory/horse/2017109094/']
-        item["horse_number"] = ['3']
-        item["horse_weight_and_diff"] = ['\n436(+12)\n']
-        item["jockey_id"] = ['/directory/jocky/01179/']
-        item["jockey_weight"] = ['51.0 ▲']
-        item["prize_total_money"] = ['\n355万']
-        item["race_id"] = ['1906050201']
-        item["trainer_id"] = ['/directory/trainer/01147/']
+        item["bracket_number"] = '2'
+        item["horse_id"] = '/directory/horse/2017109094/'
+        item["horse_number"] = '3'
+        item["horse_weight_and_diff"] = '\n436(+12)\n'
+        item["jockey_id"] = '/directory/jocky/01179/'
+        item["jockey_weight"] = '51.0 ▲'
+        item["prize_total_money"] = '\n355万'
+        item["race_id"] = '1906050201'
+        item["trainer_id"] = '/directory/trainer/01147/'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_denma")
@@ -1470,15 +1498,15 @@ class TestPostgreSQLPipeline:
     def test_process_race_denma_item_3(self):
         # Setup
         item = RaceDenmaItem()
-        item["bracket_number"] = ['3']
-        item["horse_id"] = ['/directory/horse/2014106160/']
-        item["horse_number"] = ['3']
-        item["horse_weight_and_diff"] = ['\n482(+6)\n']
-        item["jockey_id"] = ['/directory/jocky/00660/']
-        item["jockey_weight"] = ['56.0 ']
-        item["prize_total_money"] = ['\n2億4247万']
-        item["race_id"] = ['2006010911']
-        item["trainer_id"] = ['/directory/trainer/01115/']
+        item["bracket_number"] = '3'
+        item["horse_id"] = '/directory/horse/2014106160/'
+        item["horse_number"] = '3'
+        item["horse_weight_and_diff"] = '\n482(+6)\n'
+        item["jockey_id"] = '/directory/jocky/00660/'
+        item["jockey_weight"] = '56.0 '
+        item["prize_total_money"] = '\n2億4247万'
+        item["race_id"] = '2006010911'
+        item["trainer_id"] = '/directory/trainer/01115/'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_denma")
@@ -1543,14 +1571,14 @@ class TestPostgreSQLPipeline:
     def test_process_race_denma_item_4(self):
         # Setup
         item = RaceDenmaItem()
-        item["bracket_number"] = ['2']
-        item["horse_id"] = ['/directory/horse/2015102358/']
-        item["horse_number"] = ['2']
-        item["horse_weight_and_diff"] = ['\n-( - )']
-        item["jockey_id"] = ['/directory/jocky/00894/']
-        item["jockey_weight"] = ['55.0 ']
-        item["prize_total_money"] = ['\n670万']
-        item["race_id"] = ['2008010104']
+        item["bracket_number"] = '2'
+        item["horse_id"] = '/directory/horse/2015102358/'
+        item["horse_number"] = '2'
+        item["horse_weight_and_diff"] = '\n-( - )'
+        item["jockey_id"] = '/directory/jocky/00894/'
+        item["jockey_weight"] = '55.0 '
+        item["prize_total_money"] = '\n670万'
+        item["race_id"] = '2008010104'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_denma")
@@ -1615,15 +1643,15 @@ class TestPostgreSQLPipeline:
     def test_process_race_denma_item_5(self):
         # Setup
         item = RaceDenmaItem()
-        item["bracket_number"] = ['3']
-        item["horse_id"] = ['/directory/horse/2014105282/']
-        item["horse_number"] = ['6']
-        item["horse_weight_and_diff"] = ['\n438(-2)\n']
-        item["jockey_id"] = ['/directory/jocky/01075/']
-        item["jockey_weight"] = ['55.0 ']
-        item["prize_total_money"] = ['\n2751.5万']
-        item["race_id"] = ['2006010112']
-        item["trainer_id"] = ['/directory/trainer/01097/']
+        item["bracket_number"] = '3'
+        item["horse_id"] = '/directory/horse/2014105282/'
+        item["horse_number"] = '6'
+        item["horse_weight_and_diff"] = '\n438(-2)\n'
+        item["jockey_id"] = '/directory/jocky/01075/'
+        item["jockey_weight"] = '55.0 '
+        item["prize_total_money"] = '\n2751.5万'
+        item["race_id"] = '2006010112'
+        item["trainer_id"] = '/directory/trainer/01097/'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_denma")
@@ -1688,15 +1716,15 @@ class TestPostgreSQLPipeline:
     def test_process_race_denma_item_6(self):
         # Setup
         item = RaceDenmaItem()
-        item["bracket_number"] = ['-']
-        item["horse_id"] = ['/directory/horse/2005102371/']
-        item["horse_number"] = ['-']
-        item["horse_weight_and_diff"] = ['\n-( - )']
-        item["jockey_id"] = ['/directory/jocky/00660/']
-        item["jockey_weight"] = ['55.0 ']
-        item["prize_total_money"] = ['\n1995万']
-        item["race_id"] = ['0901010907']
-        item["trainer_id"] = ['/directory/trainer/00208/']
+        item["bracket_number"] = '-'
+        item["horse_id"] = '/directory/horse/2005102371/'
+        item["horse_number"] = '-'
+        item["horse_weight_and_diff"] = '\n-( - )'
+        item["jockey_id"] = '/directory/jocky/00660/'
+        item["jockey_weight"] = '55.0 '
+        item["prize_total_money"] = '\n1995万'
+        item["race_id"] = '0901010907'
+        item["trainer_id"] = '/directory/trainer/00208/'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from race_denma")
@@ -1761,15 +1789,15 @@ class TestPostgreSQLPipeline:
     def test_process_horse_item_1(self):
         # Setup
         item = HorseItem()
-        item["horse_id"] = ['2017101602']
-        item["gender"] = [' 牡 | 登録抹消 ']
-        item["name"] = ['エリンクロノス']
-        item["birthday"] = ['2017年3月31日']
-        item["coat_color"] = ['栗毛']
-        item["trainer_id"] = ['/directory/trainer/01012/']
-        item["owner"] = ['田頭 勇貴']
-        item["breeder"] = ['大栄牧場']
-        item["breeding_farm"] = ['新冠町']
+        item["horse_id"] = '2017101602'
+        item["gender"] = ' 牡 | 登録抹消 '
+        item["name"] = 'エリンクロノス'
+        item["birthday"] = '2017年3月31日'
+        item["coat_color"] = '栗毛'
+        item["trainer_id"] = '/directory/trainer/01012/'
+        item["owner"] = '田頭 勇貴'
+        item["breeder"] = '大栄牧場'
+        item["breeding_farm"] = '新冠町'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from horse")
@@ -1829,15 +1857,15 @@ class TestPostgreSQLPipeline:
     def test_process_horse_item_2(self):
         # Setup
         item = HorseItem()
-        item["birthday"] = ['2015年2月24日']
-        item["breeder"] = ['三嶋牧場']
-        item["breeding_farm"] = ['浦河町']
-        item["coat_color"] = ['鹿毛']
-        item["gender"] = ['（地） | 牡 | 登録抹消 ']
-        item["horse_id"] = ['2015103355']
-        item["name"] = ['ネクストステップ']
-        item["owner"] = ['吉澤 克己']
-        item["trainer_id"] = ['/directory/trainer/01002/']
+        item["birthday"] = '2015年2月24日'
+        item["breeder"] = '三嶋牧場'
+        item["breeding_farm"] = '浦河町'
+        item["coat_color"] = '鹿毛'
+        item["gender"] = '（地） | 牡 | 登録抹消 '
+        item["horse_id"] = '2015103355'
+        item["name"] = 'ネクストステップ'
+        item["owner"] = '吉澤 克己'
+        item["trainer_id"] = '/directory/trainer/01002/'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from horse")
@@ -1897,15 +1925,15 @@ class TestPostgreSQLPipeline:
     def test_process_horse_item_3(self):
         # Setup
         item = HorseItem()
-        item["birthday"] = ['2015年2月28日']
-        item["breeder"] = ['Lansdowne Thoroughbreds, LLC']
-        item["breeding_farm"] = ['米']
-        item["coat_color"] = ['芦毛']
-        item["gender"] = ['（外）（地） | 牝 | 登録抹消 ']
-        item["horse_id"] = ['2015110026']
-        item["name"] = ['マッチョベリー']
-        item["owner"] = ['栗山 良子']
-        item["trainer_id"] = ['/directory/trainer/01010/']
+        item["birthday"] = '2015年2月28日'
+        item["breeder"] = 'Lansdowne Thoroughbreds, LLC'
+        item["breeding_farm"] = '米'
+        item["coat_color"] = '芦毛'
+        item["gender"] = '（外）（地） | 牝 | 登録抹消 '
+        item["horse_id"] = '2015110026'
+        item["name"] = 'マッチョベリー'
+        item["owner"] = '栗山 良子'
+        item["trainer_id"] = '/directory/trainer/01010/'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from horse")
@@ -1965,14 +1993,14 @@ class TestPostgreSQLPipeline:
     def test_process_horse_item_4(self):
         # Setup
         item = HorseItem()
-        item["birthday"] = ['2013年4月26日']
-        item["breeding_farm"] = ['米']
-        item["coat_color"] = ['芦毛']
-        item["gender"] = ['[外] | せん | 登録抹消 ']
-        item["horse_id"] = ['2013190003']
-        item["name"] = ['サンダリングブルー']
-        item["owner"] = ['C.ウォッシュボーン']
-        item["trainer_id"] = ['/directory/trainer/05730/']
+        item["birthday"] = '2013年4月26日'
+        item["breeding_farm"] = '米'
+        item["coat_color"] = '芦毛'
+        item["gender"] = '[外] | せん | 登録抹消 '
+        item["horse_id"] = '2013190003'
+        item["name"] = 'サンダリングブルー'
+        item["owner"] = 'C.ウォッシュボーン'
+        item["trainer_id"] = '/directory/trainer/05730/'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from horse")
@@ -2032,12 +2060,12 @@ class TestPostgreSQLPipeline:
     def test_process_trainer_item(self):
         # Setup
         item = TrainerItem()
-        item["trainer_id"] = ['01012']
-        item["name_kana"] = ['オオエハラ サトシ ']
-        item["name"] = ['大江原 哲']
-        item["birthday"] = ['1953年2月13日']
-        item["belong_to"] = ['\n美浦']
-        item["first_licensing_year"] = ['1996年']
+        item["trainer_id"] = '01012'
+        item["name_kana"] = 'オオエハラ サトシ '
+        item["name"] = '大江原 哲'
+        item["birthday"] = '1953年2月13日'
+        item["belong_to"] = '\n美浦'
+        item["first_licensing_year"] = '1996年'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from trainer")
@@ -2088,12 +2116,12 @@ class TestPostgreSQLPipeline:
     def test_process_jockey_item_1(self):
         # Setup
         item = JockeyItem()
-        item["jockey_id"] = ['01167']
-        item["name_kana"] = ['コワタ イクヤ ']
-        item["name"] = ['木幡 育也']
-        item["birthday"] = ['1998年9月21日']
-        item["belong_to"] = ['\n美浦(藤沢 和雄)']
-        item["first_licensing_year"] = ['2017年（平地・障害）']
+        item["jockey_id"] = '01167'
+        item["name_kana"] = 'コワタ イクヤ '
+        item["name"] = '木幡 育也'
+        item["birthday"] = '1998年9月21日'
+        item["belong_to"] = '\n美浦(藤沢 和雄)'
+        item["first_licensing_year"] = '2017年（平地・障害）'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from jockey")
@@ -2144,11 +2172,11 @@ class TestPostgreSQLPipeline:
     def test_process_jockey_item_2(self):
         # Setup
         item = JockeyItem()
-        item["belong_to"] = ['\n招待(フリー)']
-        item["first_licensing_year"] = ['0000年']
-        item["jockey_id"] = ['05508']
-        item["name"] = ['島崎      和也']
-        item["name_kana"] = [' ']
+        item["belong_to"] = '\n招待(フリー)'
+        item["first_licensing_year"] = '0000年'
+        item["jockey_id"] = '05508'
+        item["name"] = '島崎      和也'
+        item["name_kana"] = ' '
 
         # Before check
         self.pipeline.db_cursor.execute("select * from jockey")
@@ -2199,12 +2227,12 @@ class TestPostgreSQLPipeline:
     def test_process_odds_win_place_item_1(self):
         # Setup
         item = OddsWinPlaceItem()
-        item["race_id"] = ['1906050201']
-        item["horse_number"] = ['1']
-        item["horse_id"] = ['/directory/horse/2017101602/']
-        item["odds_win"] = ['161.2']
-        item["odds_place_min"] = ['26.0']
-        item["odds_place_max"] = ['43.8']
+        item["race_id"] = '1906050201'
+        item["horse_number"] = '1'
+        item["horse_id"] = '/directory/horse/2017101602/'
+        item["odds_win"] = '161.2'
+        item["odds_place_min"] = '26.0'
+        item["odds_place_max"] = '43.8'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from odds_win")
@@ -2288,12 +2316,12 @@ class TestPostgreSQLPipeline:
     def test_process_odds_win_place_item_2(self):
         # Setup
         item = OddsWinPlaceItem()
-        item["horse_id"] = ['/directory/horse/2014105805/']
-        item["horse_number"] = ['4']
-        item["odds_place_max"] = ['****']
-        item["odds_place_min"] = ['****']
-        item["odds_win"] = ['****']
-        item["race_id"] = ['2008010212']
+        item["horse_id"] = '/directory/horse/2014105805/'
+        item["horse_number"] = '4'
+        item["odds_place_max"] = '****'
+        item["odds_place_min"] = '****'
+        item["odds_win"] = '****'
+        item["race_id"] = '2008010212'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from odds_win")
@@ -2377,10 +2405,10 @@ class TestPostgreSQLPipeline:
     def test_process_odds_win_place_item_3(self):
         # Setup
         item = OddsWinPlaceItem()
-        item["horse_id"] = ['/directory/horse/1989101565/']
-        item["horse_number"] = ['2']
-        item["odds_win"] = ['1.4']
-        item["race_id"] = ['9406040205']
+        item["horse_id"] = '/directory/horse/1989101565/'
+        item["horse_number"] = '2'
+        item["odds_win"] = '1.4'
+        item["race_id"] = '9406040205'
 
         # Before check
         self.pipeline.db_cursor.execute("select * from odds_win")
@@ -2460,3 +2488,576 @@ class TestPostgreSQLPipeline:
         assert odds_place["horse_id"] == "1989101565"
         assert odds_place["odds_min"] is None
         assert odds_place["odds_max"] is None
+
+    def test_process_item_batch(self):
+        # Setup
+        settings = {
+            "DB_HOST": os.getenv("DB_HOST"),
+            "DB_PORT": os.getenv("DB_PORT"),
+            "DB_DATABASE": os.getenv("DB_DATABASE"),
+            "DB_USERNAME": os.getenv("DB_USERNAME"),
+            "DB_PASSWORD": os.getenv("DB_PASSWORD"),
+            "DB_BATCH_SIZE": 3,
+        }
+        crawler = Crawler(HorseRacingSpider, settings)
+        pipeline = PostgreSQLPipeline.from_crawler(crawler)
+        pipeline.open_spider(None)
+
+        items = []
+        for horse_number in range(1, 4):
+            item = OddsWinPlaceItem()
+            item["race_id"] = '1906050201'
+            item["horse_number"] = str(horse_number)
+            item["horse_id"] = f'/directory/horse/201710160{horse_number}/'
+            item["odds_win"] = '161.2'
+            item["odds_place_min"] = '26.0'
+            item["odds_place_max"] = '43.8'
+            items.append(item)
+
+        # Execute
+        pipeline.process_item(items[0], None)
+
+        # Check db (buffered)
+        self.pipeline.db_cursor.execute("select * from odds_win")
+        assert len(self.pipeline.db_cursor.fetchall()) == 0
+
+        # Execute (2)
+        pipeline.process_item(items[1], None)
+
+        # Check db (flushed by batch size)
+        self.pipeline.db_cursor.execute("select * from odds_win")
+        assert len(self.pipeline.db_cursor.fetchall()) == 2
+
+        self.pipeline.db_cursor.execute("select * from odds_place")
+        assert len(self.pipeline.db_cursor.fetchall()) == 2
+
+        # Execute (3)
+        pipeline.process_item(items[2], None)
+        pipeline.close_spider(None)
+
+        # Check db (flushed by close)
+        self.pipeline.db_cursor.execute("select * from odds_win")
+        assert len(self.pipeline.db_cursor.fetchall()) == 3
+
+        self.pipeline.db_cursor.execute("select * from odds_place")
+        assert len(self.pipeline.db_cursor.fetchall()) == 3
+
+        # Check stats
+        assert crawler.stats.get_value("postgresql/flush_count") == 2
+        assert crawler.stats.get_value("postgresql/flush_rows") == 6
+        assert crawler.stats.get_value("postgresql/rows_per_flush_max") == 4
+
+    def test_process_item_unchanged(self):
+        # Setup
+        settings = {
+            "DB_HOST": os.getenv("DB_HOST"),
+            "DB_PORT": os.getenv("DB_PORT"),
+            "DB_DATABASE": os.getenv("DB_DATABASE"),
+            "DB_USERNAME": os.getenv("DB_USERNAME"),
+            "DB_PASSWORD": os.getenv("DB_PASSWORD"),
+        }
+        crawler = Crawler(HorseRacingSpider, settings)
+        pipeline = PostgreSQLPipeline.from_crawler(crawler)
+        pipeline.open_spider(None)
+
+        item = TrainerItem()
+        item["trainer_id"] = '01012'
+        item["name_kana"] = 'たかはし よしただ'
+        item["name"] = '高橋 義忠'
+        item["birthday"] = '1968年7月1日'
+        item["belong_to"] = '栗東'
+        item["first_licensing_year"] = '2008年'
+
+        # Execute
+        pipeline.process_item(item, None)
+        pipeline.process_item(item, None)
+
+        item["belong_to"] = '美浦'
+        pipeline.process_item(item, None)
+
+        pipeline.close_spider(None)
+
+        # Check db
+        self.pipeline.db_cursor.execute("select * from trainer")
+
+        trainers = self.pipeline.db_cursor.fetchall()
+        assert len(trainers) == 1
+        assert trainers[0]["belong_to"] == "美浦"
+
+        # Check stats
+        assert crawler.stats.get_value("postgresql/flush_rows/trainer") == 3
+        assert crawler.stats.get_value("postgresql/unchanged_rows/trainer") == 1
+
+    def test_process_item_bad_row(self):
+        # Setup
+        settings = {
+            "DB_HOST": os.getenv("DB_HOST"),
+            "DB_PORT": os.getenv("DB_PORT"),
+            "DB_DATABASE": os.getenv("DB_DATABASE"),
+            "DB_USERNAME": os.getenv("DB_USERNAME"),
+            "DB_PASSWORD": os.getenv("DB_PASSWORD"),
+            "DB_BATCH_SIZE": 3,
+        }
+        crawler = Crawler(HorseRacingSpider, settings)
+        pipeline = PostgreSQLPipeline.from_crawler(crawler)
+        pipeline.open_spider(None)
+
+        items = []
+        for trainer_id in ["01012", "01013", "01014"]:
+            item = TrainerItem()
+            item["trainer_id"] = trainer_id
+            item["name_kana"] = 'たかはし よしただ'
+            item["name"] = '高橋 義忠'
+            item["birthday"] = '1968年7月1日'
+            item["belong_to"] = '栗東'
+            item["first_licensing_year"] = '2008年'
+            items.append(item)
+
+        # Longer than the column
+        items[1]["name"] = "あ" * 300
+
+        # Execute
+        for item in items:
+            pipeline.process_item(item, None)
+
+        # Check db
+        self.pipeline.db_cursor.execute("select trainer_id from trainer order by trainer_id")
+        assert [r["trainer_id"] for r in self.pipeline.db_cursor.fetchall()] == ["01012", "01014"]
+
+        assert pipeline.buffered_count == 0
+
+        # Check stats
+        assert crawler.stats.get_value("postgresql/flush_split") == 1
+        assert crawler.stats.get_value("postgresql/bad_rows/trainer") == 1
+        assert crawler.stats.get_value("postgresql/flush_rows/trainer") == 3
+        assert crawler.stats.get_value("postgresql/unchanged_rows/trainer") == 0
+
+        pipeline.close_spider(None)
+
+    def test_flush_fail(self):
+        # Setup
+        settings = {
+            "DB_HOST": os.getenv("DB_HOST"),
+            "DB_PORT": os.getenv("DB_PORT"),
+            "DB_DATABASE": os.getenv("DB_DATABASE"),
+            "DB_USERNAME": os.getenv("DB_USERNAME"),
+            "DB_PASSWORD": os.getenv("DB_PASSWORD"),
+            "DB_BATCH_SIZE": 100,
+        }
+        crawler = Crawler(HorseRacingSpider, settings)
+        pipeline = PostgreSQLPipeline.from_crawler(crawler)
+        pipeline.open_spider(None)
+
+        item = TrainerItem()
+        item["trainer_id"] = '01012'
+        item["name_kana"] = 'たかはし よしただ'
+        item["name"] = '高橋 義忠'
+        item["birthday"] = '1968年7月1日'
+        item["belong_to"] = '栗東'
+        item["first_licensing_year"] = '2008年'
+
+        pipeline.process_item(item, None)
+
+        # Execute
+        with mock.patch("investment_horse_racing_crawler.scrapy.pipelines.execute_values", side_effect=psycopg2.OperationalError("server closed the connection")):
+            try:
+                pipeline.flush()
+                assert False
+            except psycopg2.OperationalError:
+                pass
+
+        # Check
+        assert pipeline.buffered_count == 1
+
+        # Execute (2)
+        pipeline.flush()
+
+        # Check db (written by the next flush)
+        self.pipeline.db_cursor.execute("select * from trainer")
+        assert len(self.pipeline.db_cursor.fetchall()) == 1
+
+        assert pipeline.buffered_count == 0
+
+        pipeline.close_spider(None)
+
+    def test_process_item_flush_fail(self):
+        # Setup
+        crawler, pipeline = self.create_writer_pipeline(DB_BATCH_SIZE=1)
+        spider = HorseRacingSpider()
+        pipeline.open_spider(spider)
+
+        # Execute
+        with mock.patch("investment_horse_racing_crawler.scrapy.pipelines.execute_values", side_effect=psycopg2.OperationalError("server closed the connection")) as execute_values:
+            try:
+                pipeline.process_item(create_trainer_item("01012"), spider)
+                assert False
+            except psycopg2.OperationalError:
+                pass
+
+            result = pipeline.process_item(create_trainer_item("01013"), spider)
+
+        # Check (the spider is closed, and later items are neither buffered nor flushed again)
+        crawler.engine.close_spider.assert_called_once_with(spider, "postgresql_flush_error")
+        assert execute_values.call_count == 1
+        assert pipeline.buffered_count == 1
+
+        failures = []
+        result.addErrback(failures.append)
+        assert failures[0].check(psycopg2.OperationalError)
+
+        # Execute (2)
+        pipeline.close_spider(spider)
+
+        # Check db (the buffered row is written by the last flush)
+        self.pipeline.db_cursor.execute("select trainer_id from trainer")
+        assert [r["trainer_id"] for r in self.pipeline.db_cursor.fetchall()] == ["01012"]
+
+    def create_writer_pipeline(self, **settings):
+        crawler = Crawler(HorseRacingSpider, dict({
+            "DB_HOST": os.getenv("DB_HOST"),
+            "DB_PORT": os.getenv("DB_PORT"),
+            "DB_DATABASE": os.getenv("DB_DATABASE"),
+            "DB_USERNAME": os.getenv("DB_USERNAME"),
+            "DB_PASSWORD": os.getenv("DB_PASSWORD"),
+        }, **settings))
+        crawler.engine = mock.Mock()
+
+        return crawler, PostgreSQLPipeline.from_crawler(crawler)
+
+    def test_writer_thread(self):
+        # Setup
+        crawler, pipeline = self.create_writer_pipeline(DB_BATCH_SIZE=100, DB_WRITER_QUEUE_SIZE=10)
+        pipeline.open_spider(None)
+
+        # Execute
+        results = [pipeline.process_item(create_trainer_item(trainer_id), None) for trainer_id in ["01012", "01013", "01014"]]
+
+        # Check return (queued without waiting for the database)
+        assert [r["trainer_id"] for r in results] == ["01012", "01013", "01014"]
+
+        # Execute (2)
+        pipeline.close_spider(None)
+
+        # Check db (drained and flushed by close)
+        assert not pipeline.writer_thread.is_alive()
+
+        self.pipeline.db_cursor.execute("select * from trainer")
+        assert len(self.pipeline.db_cursor.fetchall()) == 3
+
+        assert crawler.stats.get_value("postgresql/flush_count") == 1
+
+    @mock.patch("investment_horse_racing_crawler.scrapy.pipelines.reactor")
+    def test_writer_backpressure(self, reactor):
+        # Setup
+        reactor.callFromThread.side_effect = lambda f, *args: f(*args)
+
+        crawler, pipeline = self.create_writer_pipeline(DB_BATCH_SIZE=100, DB_WRITER_QUEUE_SIZE=1)
+        pipeline.open_spider(None)
+
+        # The writer thread is held in its first write
+        write_started = threading.Event()
+        write_resumed = threading.Event()
+        write_normalized = pipeline._write_normalized
+
+        def _blocked_write_normalized(normalized):
+            write_started.set()
+            write_resumed.wait(5.0)
+            write_normalized(normalized)
+
+        pipeline._write_normalized = _blocked_write_normalized
+
+        pipeline.process_item(create_trainer_item("01012"), None)
+        wait_until(write_started.is_set)
+
+        pipeline.process_item(create_trainer_item("01013"), None)
+
+        # Execute
+        result = pipeline.process_item(create_trainer_item("01014"), None)
+
+        # Check (held back while the queue is full)
+        assert isinstance(result, defer.Deferred)
+        assert not result.called
+        assert crawler.stats.get_value("postgresql/writer/backpressure") == 1
+
+        # Execute (2)
+        write_resumed.set()
+
+        # Check (handed over once the writer thread makes room)
+        wait_until(lambda: result.called)
+        assert result.result["trainer_id"] == "01014"
+
+        pipeline.close_spider(None)
+
+        self.pipeline.db_cursor.execute("select * from trainer")
+        assert len(self.pipeline.db_cursor.fetchall()) == 3
+
+    def test_scheduler_checkpoint(self):
+        # Setup
+        crawler, pipeline = self.create_writer_pipeline(DB_BATCH_SIZE=100)
+        pipeline.open_spider(None)
+
+        pipeline.process_item(create_trainer_item("01012"), None)
+
+        # Execute
+        d = crawler.signals.send_catch_log_deferred(signal=scheduler_checkpoint, spider=None)
+
+        # Check db (committed before the checkpoint is published)
+        assert d.called
+
+        self.pipeline.db_cursor.execute("select * from trainer")
+        assert len(self.pipeline.db_cursor.fetchall()) == 1
+
+        pipeline.close_spider(None)
+
+    @mock.patch("investment_horse_racing_crawler.scrapy.pipelines.reactor")
+    def test_scheduler_checkpoint_writer_thread(self, reactor):
+        # Setup
+        reactor.callFromThread.side_effect = lambda f, *args: f(*args)
+
+        crawler, pipeline = self.create_writer_pipeline(DB_BATCH_SIZE=100, DB_WRITER_QUEUE_SIZE=10)
+        pipeline.open_spider(None)
+
+        pipeline.process_item(create_trainer_item("01012"), None)
+        pipeline.process_item(create_trainer_item("01013"), None)
+
+        # Execute
+        d = pipeline.scheduler_checkpoint(None)
+
+        # Check db (the rows queued before the checkpoint are committed by the writer thread)
+        wait_until(lambda: d.called)
+
+        self.pipeline.db_cursor.execute("select * from trainer")
+        assert len(self.pipeline.db_cursor.fetchall()) == 2
+
+        pipeline.close_spider(None)
+
+    @mock.patch("investment_horse_racing_crawler.scrapy.pipelines.reactor")
+    def test_writer_error(self, reactor):
+        # Setup
+        reactor.callFromThread.side_effect = lambda f, *args: f(*args)
+
+        crawler, pipeline = self.create_writer_pipeline(DB_BATCH_SIZE=1, DB_WRITER_QUEUE_SIZE=10)
+        spider = HorseRacingSpider()
+        pipeline.open_spider(spider)
+
+        # Execute
+        with mock.patch("investment_horse_racing_crawler.scrapy.pipelines.execute_values", side_effect=psycopg2.OperationalError("server closed the connection")):
+            pipeline.process_item(create_trainer_item("01012"), spider)
+            pipeline.writer_thread.join(5.0)
+
+        # Check (the writer thread stops and closes the spider)
+        assert not pipeline.writer_thread.is_alive()
+        assert crawler.stats.get_value("postgresql/writer/errors") == 1
+        crawler.engine.close_spider.assert_called_once_with(spider, "postgresql_writer_error")
+
+        result = pipeline.process_item(create_trainer_item("01013"), spider)
+        assert isinstance(result, defer.Deferred)
+
+        failures = []
+        result.addErrback(failures.append)
+        assert failures[0].check(psycopg2.OperationalError)
+
+        # Execute (2)
+        pipeline.close_spider(spider)
+
+        # Check db (the buffered row is written by the last flush)
+        self.pipeline.db_cursor.execute("select trainer_id from trainer")
+        assert [r["trainer_id"] for r in self.pipeline.db_cursor.fetchall()] == ["01012"]
+
+    def test_process_item_bulk_ingest(self):
+        # Setup
+        settings = {
+            "DB_HOST": os.getenv("DB_HOST"),
+            "DB_PORT": os.getenv("DB_PORT"),
+            "DB_DATABASE": os.getenv("DB_DATABASE"),
+            "DB_USERNAME": os.getenv("DB_USERNAME"),
+            "DB_PASSWORD": os.getenv("DB_PASSWORD"),
+        }
+        crawler = Crawler(HorseRacingSpider, settings)
+        spider = HorseRacingSpider(bulk_ingest=True)
+        pipeline = PostgreSQLPipeline.from_crawler(crawler)
+        pipeline.open_spider(spider)
+
+        item_1 = RaceInfoItem()
+        item_1["race_id"] = '2010010212'
+        item_1["race_round"] = '12R'
+        item_1["start_date"] = '2020年1月19日（日） '
+        item_1["start_time"] = ' 16:01発走'
+        item_1["place_name"] = ' 1回小倉2日 '
+        item_1["race_name"] = '\n呼子特別'
+        item_1["course_type_length"] = '芝・右 2600m '
+        item_1["weather"] = '曇'
+        item_1["course_condition"] = '重'
+        item_1["added_money"] = ' 本賞金：1060、420、270、160、106万円 '
+
+        item_2 = JockeyItem()
+        item_2["jockey_id"] = '05339'
+        item_2["name_kana"] = ''
+        item_2["name"] = 'C.ルメール'
+        item_2["belong_to"] = '栗東（フリー）'
+        item_2["first_licensing_year"] = '0年（初騎乗）'
+
+        item_3 = RaceInfoItem(item_1)
+        item_3["race_id"] = '2010020212'
+        item_3["start_date"] = '2020年2月2日（日） '
+
+        # Execute
+        pipeline.process_item(item_1, spider)
+        pipeline.process_item(item_2, spider)
+
+        # Check db (staged)
+        self.pipeline.db_cursor.execute("select * from race_info")
+        assert len(self.pipeline.db_cursor.fetchall()) == 0
+
+        # Execute (2)
+        pipeline.process_item(item_3, spider)
+
+        # Check db (merged at the end of month)
+        self.pipeline.db_cursor.execute("select * from race_info")
+        race_infos = self.pipeline.db_cursor.fetchall()
+        assert len(race_infos) == 1
+        assert race_infos[0]["race_id"] == "2010010212"
+
+        self.pipeline.db_cursor.execute("select * from jockey")
+        jockeys = self.pipeline.db_cursor.fetchall()
+        assert len(jockeys) == 1
+        assert jockeys[0]["name_kana"] is None
+        assert jockeys[0]["birthday"] is None
+        assert jockeys[0]["first_licensing_year"] is None
+
+        # Execute (3)
+        pipeline.close_spider(spider)
+
+        # Check db (merged by close)
+        self.pipeline.db_cursor.execute("select * from race_info order by race_id")
+        race_infos = self.pipeline.db_cursor.fetchall()
+        assert len(race_infos) == 2
+        assert race_infos[1]["race_id"] == "2010020212"
+        assert race_infos[1]["start_datetime"] == datetime(2020, 2, 2, 16, 1, 0)
+
+        # Check stats
+        assert crawler.stats.get_value("postgresql/bulk/race_info/rows_per_second") > 0
+
+
+class TestProcessPoolNormalizePipeline:
+    def setUp(self):
+        logging.disable(logging.DEBUG)
+
+        # Calls from the pool threads are queued, and run on the test thread as the reactor would
+        self.reactor_calls = queue.Queue()
+        self.reactor_patcher = mock.patch("investment_horse_racing_crawler.scrapy.pipelines.reactor")
+        reactor = self.reactor_patcher.start()
+        reactor.callFromThread.side_effect = lambda f, *args: self.reactor_calls.put((f, args))
+        reactor.callLater.side_effect = lambda delay, f, *args: self.reactor_calls.put((f, args))
+
+        crawler = Crawler(HorseRacingSpider, {"NORMALIZE_PROCESS_POOL_SIZE": 2})
+        self.stats = crawler.stats
+        self.pipeline = ProcessPoolNormalizePipeline.from_crawler(crawler)
+        self.pipeline.open_spider(None)
+
+    def tearDown(self):
+        self.pipeline.executor.shutdown(wait=True)
+        self.reactor_patcher.stop()
+
+    def get_reactor_calls(self, count):
+        return [self.reactor_calls.get(timeout=30.0) for _ in range(count)]
+
+    def run_reactor_calls(self, calls):
+        for f, args in calls:
+            f(*args)
+
+        # Then the calls scheduled by these calls
+        while not self.reactor_calls.empty():
+            f, args = self.reactor_calls.get_nowait()
+            f(*args)
+
+    def create_odds_item(self, horse_number):
+        item = OddsWinPlaceItem()
+        item["race_id"] = '1906050201'
+        item["horse_number"] = str(horse_number)
+        item["horse_id"] = f'/directory/horse/201710160{horse_number}/'
+        item["odds_win"] = '161.2'
+
+        return item
+
+    def test_not_configured(self):
+        # Execute
+        try:
+            ProcessPoolNormalizePipeline.from_crawler(Crawler(HorseRacingSpider, {"NORMALIZE_PROCESS_POOL_SIZE": 0}))
+            assert False
+        except NotConfigured:
+            pass
+
+    def test_process_item(self):
+        # Setup
+        results = []
+
+        # Execute
+        d = self.pipeline.process_item(self.create_odds_item(1), None)
+        d.addCallback(results.append)
+
+        # Check (a Deferred fired on the reactor once the worker is done)
+        assert isinstance(d, defer.Deferred)
+        assert len(results) == 0
+
+        self.run_reactor_calls(self.get_reactor_calls(1))
+
+        normalized = results[0]
+        assert isinstance(normalized, NormalizedItem)
+        assert normalized.item.item_type == "OddsWinPlaceItem"
+        assert normalized.rows[0] == ("odds_win", ("1906050201_1", "1906050201", 1, "2017101601", 161.2))
+
+        assert self.stats.get_value("normalize_pool/submitted") == 1
+        assert len(self.pipeline.locks) == 0
+
+    def test_process_item_order(self):
+        # Setup
+        results = []
+
+        # Execute
+        for horse_number in range(1, 4):
+            d = self.pipeline.process_item(self.create_odds_item(horse_number), None)
+            d.addCallback(lambda normalized: results.append(normalized.item["win"]["horse_number"]))
+
+        # The workers finish in the reverse order
+        self.run_reactor_calls(sorted(self.get_reactor_calls(3), key=lambda call: call[1][1].result().item["win"]["horse_number"], reverse=True))
+
+        # Check (handed over in the order the items of the race were scraped)
+        assert results == [1, 2, 3]
+        assert len(self.pipeline.locks) == 0
+
+    def test_process_item_drop(self):
+        # Setup
+        item = RaceInfoItem()
+        item["race_id"] = '2010010212'
+        item["race_round"] = 'XR'
+
+        failures = []
+
+        # Execute
+        d = self.pipeline.process_item(item, None)
+        d.addErrback(failures.append)
+
+        self.run_reactor_calls(self.get_reactor_calls(1))
+
+        # Check (DropItem raised in the worker process is raised on the reactor)
+        assert failures[0].check(DropItem)
+        assert len(self.pipeline.locks) == 0
+
+    def test_close_spider(self):
+        # Setup
+        d = self.pipeline.process_item(self.create_odds_item(1), None)
+
+        # Execute
+        self.pipeline.close_spider(None)
+
+        # Check (the pending item is finished, and the pool takes no more work)
+        self.run_reactor_calls(self.get_reactor_calls(1))
+
+        assert d.result.item["win"]["horse_number"] == 1
+
+        try:
+            self.pipeline.executor.submit(pow, 2, 2)
+            assert False
+        except RuntimeError:
+            pass
@@ -0,0 +1,262 @@
+import logging
+import os
+import tempfile
+from unittest import mock
+
+from scrapy.dupefilters import RFPDupeFilter
+from scrapy.http import Request
+from scrapy.squeues import PickleFifoDiskQueue
+from scrapy.utils.request import request_fingerprint
+from scrapy.utils.test import get_crawler
+
+from investment_horse_racing_crawler.scrapy.scheduler import BloomDupeFilter, BloomFilter, CheckpointScheduler, scheduler_checkpoint
+from investment_horse_racing_crawler.scrapy.spiders.horse_racing_spider import HorseRacingSpider
+
+
+class SmallChunkFifoDiskQueue(PickleFifoDiskQueue):
+    def __init__(self, crawler, key):
+        super(SmallChunkFifoDiskQueue, self).__init__(crawler, key)
+
+        # The chunk size of a new queue is saved in its state, so a resumed queue keeps it
+        if len(self) == 0:
+            self.chunksize = self.info["chunksize"] = 2
+
+
+class TestBloomFilter:
+    def test_add(self):
+        # Setup
+        bloom = BloomFilter(1000, 0.001)
+        fingerprints = [request_fingerprint(Request(f"https://keiba.yahoo.co.jp/race/denma/{i}/")) for i in range(1000)]
+
+        # Execute
+        first = [bloom.add(fp) for fp in fingerprints]
+        second = [bloom.add(fp) for fp in fingerprints]
+
+        # Check
+        assert sum(first) <= 5
+        assert all(second)
+        assert bloom.item_count >= 995
+
+    def test_save_load(self):
+        # Setup
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "requests.bloom")
+
+            bloom = BloomFilter(1000, 0.001)
+            bloom.add("0a" * 20)
+            bloom.save(path)
+
+            # Execute
+            loaded = BloomFilter(1000, 0.001)
+            loaded.load(path)
+
+            # Check
+            assert loaded.add("0a" * 20)
+            assert not loaded.add("0b" * 20)
+            assert loaded.item_count == 2
+
+            try:
+                BloomFilter(2000, 0.001).load(path)
+
+                assert False
+            except ValueError:
+                pass
+
+    def test_load_truncated(self):
+        # Setup
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "requests.bloom")
+
+            BloomFilter(1000, 0.001).save(path)
+            with open(path, "r+b") as f:
+                f.truncate(os.path.getsize(path) - 1)
+
+            # Execute
+            try:
+                BloomFilter(1000, 0.001).load(path)
+
+                assert False
+            except ValueError:
+                pass
+
+
+class TestCheckpointScheduler:
+    def setUp(self):
+        logging.disable(logging.DEBUG)
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def create_scheduler(self, disk_queue="scrapy.squeues.PickleFifoDiskQueue"):
+        crawler = get_crawler(HorseRacingSpider, {
+            "JOBDIR": self.tmp_dir.name,
+            "SCHEDULER_CHECKPOINT_INTERVAL": 0,
+            "SCHEDULER_PRIORITY_QUEUE": "scrapy.pqueues.ScrapyPriorityQueue",
+            "SCHEDULER_DISK_QUEUE": disk_queue,
+            "JOB_DUPEFILTER_CLASS": "investment_horse_racing_crawler.scrapy.scheduler.BloomDupeFilter",
+            "DUPEFILTER_BLOOM_CAPACITY": 1000,
+        })
+        spider = HorseRacingSpider.from_crawler(crawler)
+
+        scheduler = CheckpointScheduler.from_crawler(crawler)
+        scheduler.open(spider)
+
+        return scheduler
+
+    def test_dupefilter(self):
+        # Setup
+        crawler = get_crawler(HorseRacingSpider, {
+            "JOB_DUPEFILTER_CLASS": "investment_horse_racing_crawler.scrapy.scheduler.BloomDupeFilter",
+        })
+
+        # Execute
+        scheduler = CheckpointScheduler.from_crawler(crawler)
+        job_scheduler = self.create_scheduler()
+
+        # Check
+        assert type(scheduler.df) is RFPDupeFilter
+        assert type(job_scheduler.df) is BloomDupeFilter
+
+    def test_resume_from_checkpoint(self):
+        # Setup
+        scheduler = self.create_scheduler()
+
+        scheduler.enqueue_request(Request("https://keiba.yahoo.co.jp/race/denma/2005010101/"))
+        scheduler.enqueue_request(Request("https://keiba.yahoo.co.jp/race/denma/2005010102/"))
+
+        # Execute
+        scheduler.checkpoint()
+
+        # The process dies without closing the scheduler
+        resumed_scheduler = self.create_scheduler()
+
+        # Check
+        assert len(resumed_scheduler) == 2
+        assert not resumed_scheduler.enqueue_request(Request("https://keiba.yahoo.co.jp/race/denma/2005010101/"))
+        assert resumed_scheduler.enqueue_request(Request("https://keiba.yahoo.co.jp/race/denma/2005010103/"))
+
+    def test_resume_with_requests_after_checkpoint(self):
+        # Setup
+        scheduler = self.create_scheduler()
+
+        scheduler.enqueue_request(Request("https://keiba.yahoo.co.jp/race/denma/2005010101/"))
+        scheduler.checkpoint()
+        scheduler.enqueue_request(Request("https://keiba.yahoo.co.jp/race/denma/2005010102/"))
+
+        # Execute
+        # The process dies without closing the scheduler
+        resumed_scheduler = self.create_scheduler()
+
+        resumed_scheduler.enqueue_request(Request("https://keiba.yahoo.co.jp/race/denma/2005010103/"))
+
+        # Check
+        # The request enqueued after the checkpoint is not seen by the restored dupefilter, so it is found again by its parent page
+        assert resumed_scheduler.enqueue_request(Request("https://keiba.yahoo.co.jp/race/denma/2005010102/"))
+
+        urls = []
+        while True:
+            request = resumed_scheduler.next_request()
+            if request is None:
+                break
+            urls.append(request.url)
+
+        assert urls == [
+            "https://keiba.yahoo.co.jp/race/denma/2005010101/",
+            "https://keiba.yahoo.co.jp/race/denma/2005010103/",
+            "https://keiba.yahoo.co.jp/race/denma/2005010102/",
+        ]
+
+    def test_resume_after_chunk_removed(self):
+        # Setup
+        scheduler = self.create_scheduler("tests.test_scheduler.SmallChunkFifoDiskQueue")
+
+        for race_id in ["2005010101", "2005010102", "2005010103"]:
+            scheduler.enqueue_request(Request(f"https://keiba.yahoo.co.jp/race/denma/{race_id}/"))
+        scheduler.checkpoint()
+
+        # Popping the first chunk removes its file
+        scheduler.next_request()
+        scheduler.next_request()
+
+        # Execute
+        # The process dies without closing the scheduler
+        resumed_scheduler = self.create_scheduler("tests.test_scheduler.SmallChunkFifoDiskQueue")
+
+        # Check
+        assert len(resumed_scheduler) == 3
+        assert [resumed_scheduler.next_request().url for _ in range(3)] == [
+            "https://keiba.yahoo.co.jp/race/denma/2005010101/",
+            "https://keiba.yahoo.co.jp/race/denma/2005010102/",
+            "https://keiba.yahoo.co.jp/race/denma/2005010103/",
+        ]
+
+    def test_resume_with_inflight_requests(self):
+        # Setup
+        scheduler = self.create_scheduler()
+        scheduler.crawler.engine = mock.Mock()
+        scheduler.crawler.engine.slot.inprogress = set()
+
+        for race_id in ["2005010101", "2005010102", "2005010103"]:
+            scheduler.enqueue_request(Request(f"https://keiba.yahoo.co.jp/race/denma/{race_id}/"))
+
+        # The first request is still downloading, and the second one is done
+        scheduler.crawler.engine.slot.inprogress.add(scheduler.next_request())
+        scheduler.next_request()
+
+        # Execute
+        scheduler.checkpoint()
+
+        # The process dies without closing the scheduler
+        resumed_scheduler = self.create_scheduler()
+
+        # Check
+        assert len(resumed_scheduler) == 2
+        assert [resumed_scheduler.next_request().url for _ in range(2)] == [
+            "https://keiba.yahoo.co.jp/race/denma/2005010103/",
+            "https://keiba.yahoo.co.jp/race/denma/2005010101/",
+        ]
+        assert not resumed_scheduler.enqueue_request(Request("https://keiba.yahoo.co.jp/race/denma/2005010101/"))
+
+    def test_checkpoint_handler_fail(self):
+        # Setup
+        scheduler = self.create_scheduler()
+
+        scheduler.enqueue_request(Request("https://keiba.yahoo.co.jp/race/denma/2005010101/"))
+        scheduler.checkpoint()
+
+        def _flush_fail(spider):
+            raise RuntimeError("flush failed")
+
+        scheduler.crawler.signals.connect(_flush_fail, signal=scheduler_checkpoint, weak=False)
+        scheduler.enqueue_request(Request("https://keiba.yahoo.co.jp/race/denma/2005010102/"))
+
+        # Execute
+        scheduler.checkpoint()
+
+        # The process dies without closing the scheduler
+        resumed_scheduler = self.create_scheduler()
+
+        # Check (resumed from the first checkpoint, since the items of the second one were not written)
+        assert scheduler.stats.get_value("scheduler/checkpoint/discarded") == 1
+        assert len(resumed_scheduler) == 1
+        assert resumed_scheduler.enqueue_request(Request("https://keiba.yahoo.co.jp/race/denma/2005010102/"))
+
+    def test_resume_after_close(self):
+        # Setup
+        scheduler = self.create_scheduler()
+
+        scheduler.enqueue_request(Request("https://keiba.yahoo.co.jp/race/denma/2005010101/"))
+        scheduler.enqueue_request(Request("https://keiba.yahoo.co.jp/race/denma/2005010102/"))
+        scheduler.next_request()
+
+        # Execute
+        scheduler.close("shutdown")
+
+        resumed_scheduler = self.create_scheduler()
+
+        # Check
+        assert len(resumed_scheduler) == 1
+        assert resumed_scheduler.next_request().url == "https://keiba.yahoo.co.jp/race/denma/2005010102/"
+        assert not resumed_scheduler.enqueue_request(Request("https://keiba.yahoo.co.jp/race/denma/2005010101/"))
@@ -0,0 +1,73 @@
+from datetime import datetime
+import logging
+
+from scrapy.http import Request
+from scrapy.utils.test import get_crawler
+
+from investment_horse_racing_crawler.scrapy import split_date_range
+from investment_horse_racing_crawler.scrapy.middlewares import ShardDedupSpiderMiddleware
+from investment_horse_racing_crawler.scrapy.spiders.horse_racing_spider import HorseRacingSpider
+
+
+class TestSharding:
+    def setUp(self):
+        logging.disable(logging.DEBUG)
+
+    def test_split_date_range_month(self):
+        # Execute
+        shards = split_date_range(datetime(2019, 12, 15), datetime(2020, 3, 10), "month")
+
+        # Check
+        assert shards == [
+            (datetime(2019, 12, 15), datetime(2020, 1, 1)),
+            (datetime(2020, 1, 1), datetime(2020, 2, 1)),
+            (datetime(2020, 2, 1), datetime(2020, 3, 1)),
+            (datetime(2020, 3, 1), datetime(2020, 3, 10)),
+        ]
+
+    def test_split_date_range_week(self):
+        # Execute
+        shards = split_date_range(datetime(2020, 2, 1), datetime(2020, 2, 20), "week")
+
+        # Check
+        assert shards == [
+            (datetime(2020, 2, 1), datetime(2020, 2, 8)),
+            (datetime(2020, 2, 8), datetime(2020, 2, 15)),
+            (datetime(2020, 2, 15), datetime(2020, 2, 20)),
+        ]
+
+    def test_split_date_range_unknown_unit(self):
+        # Execute
+        try:
+            split_date_range(datetime(2020, 2, 1), datetime(2020, 2, 20), "day")
+
+            assert False
+        except ValueError:
+            # Check
+            pass
+
+    def test_shard_dedup(self):
+        # Setup
+        crawler = get_crawler(HorseRacingSpider)
+        middleware = ShardDedupSpiderMiddleware.from_crawler(crawler)
+
+        shard_claims = {"https://keiba.yahoo.co.jp/directory/horse/2017101602/": 1}
+        spider = HorseRacingSpider(shard_id=0, shard_claims=shard_claims)
+
+        result = [
+            Request("https://keiba.yahoo.co.jp/directory/horse/2017101602/"),
+            Request("https://keiba.yahoo.co.jp/directory/jocky/01167/"),
+            Request("https://keiba.yahoo.co.jp/odds/tfw/1906050201/"),
+        ]
+
+        # Execute
+        output = list(middleware.process_spider_output(None, result, spider))
+
+        # Check
+        assert [r.url for r in output] == [
+            "https://keiba.yahoo.co.jp/directory/jocky/01167/",
+            "https://keiba.yahoo.co.jp/odds/tfw/1906050201/",
+        ]
+        assert shard_claims["https://keiba.yahoo.co.jp/directory/jocky/01167/"] == 0
+        assert crawler.stats.get_value("shard_dedup/skipped") == 1
+        assert crawler.stats.get_value("shard_dedup/claimed") == 1